@@ -0,0 +1,305 @@
+"""
+Benchmarks of the alignment algorithm and of the whole pipeline.
+
+Usage:
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --output new.json --baseline results.json
+
+The results are written as JSON. If a baseline produced by an earlier run is given,
+the benchmarks that became slower or used more memory than `--threshold` allows
+are reported as regressions, and the script exits with status 1.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from afaligner.c_dtwbd_wrapper import c_FastDTWBD
+from afaligner import dtwbd
+
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+RESOURCES_DIR = os.path.join(BASE_DIR, '..', 'tests', 'resources')
+
+# (n, m) pairs and radii of the c_FastDTWBD benchmarks
+SIZES = [(1000, 1000), (5000, 6000), (20000, 25000), (100000, 120000)]
+RADII = [10, 50, 100]
+QUICK_SIZES = [(1000, 1000), (5000, 6000)]
+QUICK_RADII = [10, 100]
+
+# Sizes of the comparison with the Python implementation, which is quadratic and slow
+REFERENCE_SIZES = [(50, 60), (100, 120), (200, 240)]
+
+# dtypes of the sequences of the c_FastDTWBD benchmarks.
+# float32 benchmarks are named with the _f32 suffix, so that float64 ones keep their names.
+DTYPES = ['float64', 'float32']
+
+
+def generate_sequences(
+    n, m, l=12, distortion=0.1, head=0, tail=0, seed=0,
+):
+    """
+    Returns sequences `s` of n frames and `t` of m frames of `l` MFCC-like features.
+
+    `t` imitates recorded speech: a random signal that changes smoothly over a few frames.
+    `s` imitates synthesized speech of the same text: `t` played with a randomly varying rate,
+    so that it fits into n - `head` - `tail` frames, plus a normal noise of `distortion` scale.
+    `head` and `tail` frames of `s` are random and do not match `t`.
+    """
+    rng = np.random.default_rng(seed)
+    window = 8
+    raw = rng.normal(size=(m + window - 1, l))
+    t = np.lib.stride_tricks.sliding_window_view(raw, window, axis=0).mean(axis=2) * 2
+
+    matched = n - head - tail
+    rates = rng.uniform(0.5, 1.5, size=matched)
+    positions = np.cumsum(rates)
+    positions = (positions - positions[0]) / (positions[-1] - positions[0]) * (m - 1)
+    s = t[np.round(positions).astype(np.intp)] + rng.normal(scale=distortion, size=(matched, l))
+    s = np.concatenate([
+        rng.normal(size=(head, l)) * 2,
+        s,
+        rng.normal(size=(tail, l)) * 2,
+    ])
+
+    return s, t
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the current process in bytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return peak_rss
+
+
+def run_dtw_case(case):
+    """
+    Times c_FastDTWBD() on synthetic sequences of `dtype`.
+    Runs in a fresh process, so that the peak RSS is that of the case.
+    """
+    n, m, radius, threads, repeats, dtype = case
+    s, t = generate_sequences(n, m, head=n // 10, tail=n // 20)
+    s, t = s.astype(dtype), t.astype(dtype)
+    times = []
+    stats = {}
+    for _ in range(repeats):
+        stats = {}
+        start = time.perf_counter()
+        distance, path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=radius, threads=threads, stats=stats)
+        times.append(time.perf_counter() - start)
+
+    return {
+        'name': f'dtw_n{n}_m{m}_r{radius}_t{threads}' + ('_f32' if dtype == 'float32' else ''),
+        'n': n,
+        'm': m,
+        'radius': radius,
+        'threads': threads,
+        'dtype': dtype,
+        'features_bytes': s.nbytes + t.nbytes,
+        'time': min(times),
+        'times': times,
+        'cells': stats['cells'],
+        'pruned_cells': stats['pruned_cells'],
+        'peak_bytes': stats['peak_bytes'],
+        'peak_rss': get_peak_rss(),
+        'path_len': len(path),
+        'path_hash': hashlib.sha256(path.tobytes()).hexdigest(),
+        'distance': distance,
+    }
+
+
+def bench_dtw(sizes, radii, threads=1, repeats=3, dtypes=DTYPES):
+    """
+    Runs run_dtw_case() for every (n, m) from `sizes`, every radius from `radii` and every dtype from `dtypes`.
+    Results of float32 cases tell whether the path is the same as the float64 one.
+    """
+    cases = [
+        (n, m, radius, threads, repeats, dtype)
+        for n, m in sizes for radius in radii for dtype in dtypes
+    ]
+    results = []
+    float64_results = {}
+    # A process per case to measure its peak RSS
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_dtw_case, (case,))
+        line = (
+            f"{result['name']}: {result['time']:.3f} s, {result['peak_rss'] / 2**20:.1f} MiB, "
+            f"workspace {result['peak_bytes'] / 2**20:.1f} MiB"
+        )
+        float64_result = float64_results.get(case[:4])
+        if result['dtype'] == 'float64':
+            float64_results[case[:4]] = result
+        elif float64_result is not None:
+            result['path_matches_float64'] = result['path_hash'] == float64_result['path_hash']
+            line += f", path matches float64: {result['path_matches_float64']}"
+        print(line, flush=True)
+        results.append(result)
+    return results
+
+
+def bench_reference(sizes):
+    """
+    Compares c_FastDTWBD() with the Python implementation from dtwbd.py.
+    The radius is larger than the sequences, so both run the exact DTWBD
+    and should find paths of the same distance.
+    """
+    results = []
+    for n, m in sizes:
+        s, t = generate_sequences(n, m, head=n // 10, tail=n // 20)
+
+        start = time.perf_counter()
+        c_distance, _ = c_FastDTWBD(s, t, skip_penalty=0.75, radius=max(n, m))
+        c_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        python_distance, _ = dtwbd.FastDTWBD(s, t, skip_penalty=0.75, radius=max(n, m))
+        python_time = time.perf_counter() - start
+
+        result = {
+            'name': f'reference_n{n}_m{m}',
+            'n': n,
+            'm': m,
+            'time': c_time,
+            'python_time': python_time,
+            'speedup': python_time / c_time,
+            'distances_match': bool(np.isclose(c_distance, python_distance)),
+        }
+        print(f"{result['name']}: {result['speedup']:.0f}x faster, distances match: {result['distances_match']}", flush=True)
+        results.append(result)
+    return results
+
+
+def bench_end_to_end(repeats=1):
+    """
+    Aligns the Shakespeare test files with float64 and float32 MFCCs
+    and measures the stages of align().
+    The float32 result tells whether the sync map is the same as the float64 one.
+    """
+    from afaligner import align
+    from afaligner.metrics import Metrics
+
+    results = []
+    sync_maps = {}
+    for float32_features in [False, True]:
+        times = []
+        for _ in range(repeats):
+            metrics = Metrics()
+            start = time.perf_counter()
+            sync_maps[float32_features] = align(
+                os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+                os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+                metrics=metrics,
+                float32_features=float32_features,
+            )
+            times.append(time.perf_counter() - start)
+
+        stage_times = {}
+        for stage in metrics.stages:
+            stage_times[stage['stage']] = stage_times.get(stage['stage'], 0) + stage['wall_time']
+
+        result = {
+            'name': 'end_to_end_shakespeare' + ('_f32' if float32_features else ''),
+            'time': min(times),
+            'times': times,
+            'stages': stage_times,
+            'peak_bytes': max((a.get('peak_bytes', 0) for a in metrics.alignments), default=0),
+        }
+        line = f"{result['name']}: {result['time']:.3f} s"
+        # The float32 run follows the float64 one in the same process, so its peak RSS is not known
+        if not float32_features:
+            result['peak_rss'] = get_peak_rss()
+        else:
+            result['sync_map_matches_float64'] = sync_maps[True] == sync_maps[False]
+            line += f", sync map matches float64: {result['sync_map_matches_float64']}"
+        print(line, flush=True)
+        results.append(result)
+
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Returns descriptions of the benchmarks whose time or peak RSS
+    exceeds the baseline value by more than `threshold`, e.g. 0.1 for 10%.
+    Benchmarks missing in the baseline are not compared.
+    """
+    baseline_results = {
+        result['name']: result for results in baseline['benchmarks'].values() for result in results
+    }
+    regressions = []
+    for group in results['benchmarks'].values():
+        for result in group:
+            baseline_result = baseline_results.get(result['name'])
+            if baseline_result is None:
+                continue
+            for key in ['time', 'peak_rss']:
+                if key not in result or key not in baseline_result:
+                    continue
+                if result[key] > baseline_result[key] * (1 + threshold):
+                    regressions.append(
+                        f"{result['name']}: {key} {result[key]:.4g} > {baseline_result[key]:.4g}"
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of afaligner.')
+    parser.add_argument('--output', help='path to write the JSON results to')
+    parser.add_argument('--baseline', help='path to the JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression, defaults to 0.1')
+    parser.add_argument('--quick', action='store_true', help='run only small DTW benchmarks')
+    parser.add_argument('--threads', type=int, default=1, help='dtw threads, defaults to 1')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of every DTW benchmark, defaults to 3')
+    parser.add_argument('--skip-end-to-end', action='store_true', help='do not align the test files')
+    args = parser.parse_args()
+
+    sizes, radii = (QUICK_SIZES, QUICK_RADII) if args.quick else (SIZES, RADII)
+    benchmarks = {
+        'dtw': bench_dtw(sizes, radii, args.threads, args.repeats),
+        'reference': bench_reference(REFERENCE_SIZES[:2] if args.quick else REFERENCE_SIZES),
+    }
+    if not args.skip_end_to_end:
+        benchmarks['end_to_end'] = bench_end_to_end()
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+        },
+        'benchmarks': benchmarks,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
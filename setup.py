@@ -19,6 +19,11 @@ class build_ext(_build_ext):
     """
     def build_extension(self, ext):
         self._ctypes = isinstance(ext, CTypesLibrary)
+        # The flags of the extension are for GCC and Clang.
+        # MSVC gets its own optimization flag, and the library is built without POSIX threads.
+        if self.compiler.compiler_type == 'msvc':
+            ext.extra_compile_args = ['/O2']
+            ext.extra_link_args = []
         return super().build_extension(ext)
 
     def get_ext_filename(self, ext_name):
@@ -62,7 +67,14 @@ setup(
     ],
     ext_modules=[CTypesLibrary(
         'afaligner.c_modules.dtwbd',
-        sources=['src/afaligner/c_modules/dtwbd.c']
+        sources=['src/afaligner/c_modules/dtwbd.c'],
+        # -O3 enables loop vectorization of the distance computation,
+        # -fno-math-errno allows sqrt() to be vectorized as well
+        extra_compile_args=['-O3', '-fno-math-errno', '-pthread'],
+        extra_link_args=['-pthread'],
     )],
-    cmdclass={'build_ext': build_ext}
+    cmdclass={'build_ext': build_ext},
+    entry_points={
+        'console_scripts': ['afaligner-batch=afaligner.batch:main'],
+    },
 )
@@ -1,19 +1,21 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 from datetime import timedelta
+import functools
 import json
-import math
 import os.path
 import shutil
 import subprocess
+import tempfile
+import threading
 
-from aeneas.audiofilemfcc import AudioFileMFCC
-from aeneas.language import Language
-from aeneas.synthesizer import Synthesizer
-from aeneas.textfile import TextFile, TextFileFormat
-from aeneas.exacttiming import TimeValue
 import numpy as np
-import jinja2
 
-from afaligner.c_dtwbd_wrapper import c_FastDTWBD
+from afaligner.c_dtwbd_wrapper import DTWBDWorkspace, c_FastDTWBD, c_FastDTWBD_batch
+from afaligner.feature_cache import FeatureCache, get_cache_key, hash_file
+from afaligner.metrics import Metrics, call_measured, measure
+from afaligner.sync_map import SyncMap, SyncMapBuilder, get_number_of_digits_to_name
 
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -22,8 +24,12 @@ BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 def align(
     text_dir, audio_dir, output_dir=None, output_format='smil',
     sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
-    skip_penalty=None, radius=None,
-    times_as_timedelta=False, language=Language.ENG,
+    skip_penalty=None, radius=None, dtw_threads=1, global_alignment=False, coarse_factor=1, vad=False,
+    segment_length=None, preprocessing_workers=None, prefetch=2,
+    feature_cache_dir=None, feature_cache_max_bytes=None,
+    times_as_timedelta=False, language=None,
+    previous_sync_map=None, previous_file_hashes=None,
+    metrics=None, tmp_dir=None, columnar=False, float32_features=False,
 ):
     """
     This function performs an automatic synchronization of text and audio.
@@ -55,7 +61,70 @@ def align(
     If False, the times are strings of the format
     f'{hours:d}:{minutes:0>2d}:{seconds:0>2d}.{ms:0>3d}'
     
-    `language` - language of the text. One of aenas.language.Language. Defaults to `Language.ENG`
+    `language` - language of the text. One of aenas.language.Language. If None, `Language.ENG` is used.
+
+    `dtw_threads` – number of threads used by the alignment algorithm. Defaults to 1.
+    The result does not depend on it.
+
+    `global_alignment` – if True, all text files are aligned with all audio files at once.
+    It is faster when there are many text files per audio file or vice versa.
+    See build_sync_map_globally(). Defaults to False.
+
+    `coarse_factor` – if greater than 1, files are aligned with every `coarse_factor`
+    MFCC frames averaged into one, e.g. 2 for 80 ms frames or 4 for 160 ms frames.
+    Fragment boundaries are then refined at the original 40 ms frames around each anchor.
+    The alignment takes roughly `coarse_factor`**2 times less work. Defaults to 1.
+
+    `vad` – if True, long pauses in synthesized and recorded audio are shortened
+    before the alignment, which makes it faster on narration with long pauses.
+    The times in the sync map refer to the original audio. See get_speech_frames(). Defaults to False.
+
+    `segment_length` – if given, text longer than `segment_length` seconds is aligned
+    in overlapping segments of this length found by a coarse pass, see get_segmented_path().
+    Segments are aligned on `dtw_threads` threads, and memory used by each thread
+    is bounded by the segment length. Suitable for multi-hour recordings, e.g. 600 for 10-minute segments.
+    Segments should be much longer than the longest pause in the audio,
+    then the result is close to the unsegmented alignment. If None, files are aligned as a whole.
+
+    `preprocessing_workers` – number of processes that synthesize text and
+    compute MFCCs of upcoming files while the current ones are being aligned.
+    If None, files are processed one by one in the current process.
+
+    `prefetch` – maximum number of text files and of audio files
+    prepared ahead by `preprocessing_workers`. Bounds memory used by the prepared files.
+
+    `feature_cache_dir` – directory to cache MFCCs of audio files and of text fragments in.
+    MFCCs of audio files are looked up by the audio file contents and MFCC parameters,
+    so a cache hit skips audio decoding and MFCC extraction.
+    MFCCs of text fragments are looked up by the fragment text, its language and
+    synthesizer settings, so only new or changed fragments are synthesized.
+    If None, nothing is cached.
+
+    `feature_cache_max_bytes` – maximum size of the feature cache.
+    Least recently used entries are evicted to keep within it. If None, the size is unbounded.
+
+    `previous_sync_map`, `previous_file_hashes` – a sync map returned by a previous call
+    and the result of get_file_hashes() for the files it was built from.
+    If given, only the files affected by changes are realigned. See align_incremental().
+
+    `metrics` – Metrics instance to record the wall and CPU time of every stage for every file,
+    the sizes of the sequences aligned, cells evaluated at every FastDTWBD level,
+    peak workspace bytes and the number of tail realignments.
+    Stages are 'synthesis', 'text_mfcc', 'audio_decoding', 'audio_mfcc', 'alignment',
+    'anchor_refinement' and 'output'. See afaligner.metrics.Metrics. If None, nothing is measured.
+
+    `tmp_dir` – directory to create a directory for temporary files in.
+    The directory is unique to the call and is removed when the call ends.
+    Defaults to `output_dir` or, if it is None, to the parent directory of `text_dir`.
+
+    `columnar` – if True, a SyncMap is returned instead of a dict.
+    It stores fragments in arrays and takes several times less memory,
+    which matters for word-level sync maps of long books. See afaligner.sync_map.SyncMap.
+
+    `float32_features` – if True, MFCCs are stored as float32 instead of float64,
+    in memory, between processes and in the feature cache, and are aligned by the float variant
+    of the alignment algorithm. It halves the memory of the MFCCs and speeds up the alignment.
+    Path costs are still summed in float64, and the sync map is normally the same. Defaults to False.
 
     Output:
 
@@ -70,7 +139,177 @@ def align(
     }
 
     If `output_dir` is not None, outputs sync map formatted according to `output_format`.
+    Times are written as strings even if `times_as_timedelta` is True.
 
+    """
+    with Aligner(
+        preprocessing_workers=preprocessing_workers,
+        prefetch=prefetch,
+        feature_cache_dir=feature_cache_dir,
+        feature_cache_max_bytes=feature_cache_max_bytes,
+    ) as aligner:
+        return aligner.align(
+            text_dir, audio_dir, output_dir=output_dir, output_format=output_format,
+            sync_map_text_path_prefix=sync_map_text_path_prefix,
+            sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+            skip_penalty=skip_penalty, radius=radius, dtw_threads=dtw_threads,
+            global_alignment=global_alignment, coarse_factor=coarse_factor, vad=vad,
+            segment_length=segment_length,
+            times_as_timedelta=times_as_timedelta, language=language,
+            previous_sync_map=previous_sync_map, previous_file_hashes=previous_file_hashes,
+            metrics=metrics, tmp_dir=tmp_dir, columnar=columnar, float32_features=float32_features,
+        )
+
+
+class Aligner:
+    """
+    Alignment session that keeps its resources between align() calls.
+
+    align() starts preprocessing workers, opens the feature cache and allocates
+    the buffers of the alignment algorithm on every call.
+    An Aligner does it once and reuses them for every Aligner.align() call,
+    as does the synthesizer, which is kept for the life of the process.
+    It suits long-running processes that align many books, e.g. job queue workers.
+
+    `preprocessing_workers`, `prefetch`, `feature_cache_dir`, `feature_cache_max_bytes` –
+    same as for align(). Preprocessing workers are started on the first call.
+
+    Use preload() to move the startup costs out of the first call.
+    An Aligner must not be used by several threads at the same time.
+    Call close() or use it as a context manager to stop the workers.
+    """
+
+    def __init__(
+        self, preprocessing_workers=None, prefetch=2,
+        feature_cache_dir=None, feature_cache_max_bytes=None,
+    ):
+        self.preprocessing_workers = preprocessing_workers
+        self.prefetch = prefetch
+        self.feature_cache = None
+        if feature_cache_dir is not None:
+            self.feature_cache = FeatureCache(feature_cache_dir, max_bytes=feature_cache_max_bytes)
+        self._executor = None
+        self._dtw_workspace = None
+
+    def preload(self):
+        """
+        Imports aeneas, creates the synthesizer, loads the C library
+        and starts preprocessing workers.
+        """
+        get_synthesizer()
+        self._get_dtw_workspace()
+        self._get_executor()
+
+    def align(
+        self, text_dir, audio_dir, output_dir=None, output_format='smil',
+        sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
+        skip_penalty=None, radius=None, dtw_threads=1, global_alignment=False, coarse_factor=1, vad=False,
+        segment_length=None, times_as_timedelta=False, language=None,
+        previous_sync_map=None, previous_file_hashes=None,
+        metrics=None, tmp_dir=None, columnar=False, float32_features=False,
+    ):
+        """
+        Same as align().
+        """
+        if previous_sync_map is not None:
+            check_file_hashes(previous_file_hashes)
+
+        text_paths = get_paths(text_dir)
+        audio_paths = get_paths(audio_dir)
+
+        tmp_dir = make_tmp_dir(text_dir, output_dir, tmp_dir)
+        try:
+            build_parameters = get_build_parameters(
+                sync_map_text_path_prefix, sync_map_audio_path_prefix,
+                skip_penalty, radius, dtw_threads, global_alignment, coarse_factor, vad,
+                segment_length, times_as_timedelta, language, metrics,
+                self._get_executor(), self.prefetch, self.feature_cache, self._get_dtw_workspace(),
+                float32_features,
+            )
+            if previous_sync_map is None:
+                sync_map = build_sync_map(text_paths, audio_paths, tmp_dir, **build_parameters)
+            else:
+                sync_map = build_sync_map_incrementally(
+                    text_paths, audio_paths, tmp_dir,
+                    previous_sync_map, previous_file_hashes,
+                    **build_parameters,
+                )
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if output_dir is not None:
+            with measure(metrics, 'output'):
+                output_sync_map(sync_map, output_dir, output_format)
+
+        return sync_map if columnar else sync_map.to_dict()
+
+    def align_stream(
+        self, text_dir, audio_dir, output_dir=None, output_format='smil',
+        sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
+        skip_penalty=None, radius=None, dtw_threads=1, global_alignment=False, coarse_factor=1, vad=False,
+        segment_length=None, times_as_timedelta=False, language=None,
+        metrics=None, tmp_dir=None, columnar=False, float32_features=False,
+    ):
+        """
+        Same as align_stream().
+        """
+        text_paths = get_paths(text_dir)
+        audio_paths = get_paths(audio_dir)
+
+        tmp_dir = make_tmp_dir(text_dir, output_dir, tmp_dir)
+        try:
+            build_parameters = get_build_parameters(
+                sync_map_text_path_prefix, sync_map_audio_path_prefix,
+                skip_penalty, radius, dtw_threads, global_alignment, coarse_factor, vad,
+                segment_length, times_as_timedelta, language, metrics,
+                self._get_executor(), self.prefetch, self.feature_cache, self._get_dtw_workspace(),
+                float32_features,
+            )
+            for sync_map in iter_sync_map(text_paths, audio_paths, tmp_dir, **build_parameters):
+                if sync_map is None:
+                    return
+
+                if output_dir is not None:
+                    with measure(metrics, 'output', text_file=next(iter(sync_map))):
+                        output_sync_map(sync_map, output_dir, output_format)
+
+                yield sync_map if columnar else sync_map.to_dict()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._dtw_workspace is not None:
+            self._dtw_workspace.close()
+            self._dtw_workspace = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_executor(self):
+        if self._executor is None and self.preprocessing_workers:
+            self._executor = ProcessPoolExecutor(self.preprocessing_workers)
+        return self._executor
+
+    def _get_dtw_workspace(self):
+        if self._dtw_workspace is None:
+            self._dtw_workspace = DTWBDWorkspace()
+        return self._dtw_workspace
+
+
+def get_build_parameters(
+    sync_map_text_path_prefix, sync_map_audio_path_prefix,
+    skip_penalty, radius, dtw_threads, global_alignment, coarse_factor, vad,
+    segment_length, times_as_timedelta, language, metrics,
+    executor=None, prefetch=2, feature_cache=None, dtw_workspace=None, float32_features=False,
+):
+    """
+    Returns parameters of build_sync_map() for the parameters of align().
     """
     if skip_penalty is None:
         skip_penalty = 0.75
@@ -78,36 +317,341 @@ def align(
     if radius is None:
         radius = 100
 
-    if output_dir is not None:
-        tmp_dir = os.path.join(output_dir, 'tmp')
-    else:
-        parent_dir = os.path.dirname(os.path.dirname(os.path.join(text_dir, '')))
-        tmp_dir = os.path.join(parent_dir, 'tmp')
+    if language is None:
+        from aeneas.language import Language
+        language = Language.ENG
 
-    os.makedirs(tmp_dir, exist_ok=True)
-    
-    text_paths = (os.path.join(text_dir, f) for f in sorted(os.listdir(text_dir)) if not f.startswith('.'))
-    audio_paths = (os.path.join(audio_dir, f) for f in sorted(os.listdir(audio_dir)) if not f.startswith('.'))
+    segment_frames = None
+    if segment_length is not None:
+        segment_frames = max(int(segment_length / 0.040), 1)
 
-    sync_map = build_sync_map(
-        text_paths, audio_paths, tmp_dir,
+    return dict(
         sync_map_text_path_prefix=sync_map_text_path_prefix,
         sync_map_audio_path_prefix=sync_map_audio_path_prefix,
         skip_penalty=skip_penalty,
         radius=radius,
+        dtw_threads=dtw_threads,
+        global_alignment=global_alignment,
+        coarse_factor=coarse_factor,
+        vad=vad,
+        segment_frames=segment_frames,
+        executor=executor,
+        prefetch=prefetch,
+        feature_cache=feature_cache,
         times_as_timedelta=times_as_timedelta,
         language=language,
+        metrics=metrics,
+        dtw_workspace=dtw_workspace,
+        float32_features=float32_features,
     )
 
-    if output_dir is not None:
-        if output_format == 'smil':
-            output_smil(sync_map, output_dir)
-        elif output_format == 'json':
-            output_json(sync_map, output_dir)
 
-    shutil.rmtree(tmp_dir)
+def align_incremental(text_dir, audio_dir, previous_sync_map, previous_file_hashes, **kwargs):
+    """
+    Same as align(), but reuses `previous_sync_map` for the files that did not change.
+    
+    `previous_sync_map` – a sync map returned by align() or align_incremental()
+    called with the same `sync_map_text_path_prefix`, `sync_map_audio_path_prefix`
+    and `times_as_timedelta`.
+
+    `previous_file_hashes` – the result of get_file_hashes() called
+    for the files `previous_sync_map` was built from.
+    Store it together with the sync map to realign files later.
+    Raises ValueError if it is not of this form.
+
+    Other parameters are the same as for align().
+
+    The result is the same as the result of align() for the groups of files
+    that were not realigned. Text files that share an audio file are in one group,
+    so if the whole book is read in one audio file, a change realigns the whole book.
+    See build_sync_map_incrementally() for details.
+    """
+    return align(
+        text_dir, audio_dir,
+        previous_sync_map=previous_sync_map,
+        previous_file_hashes=previous_file_hashes,
+        **kwargs
+    )
+
+
+def align_stream(
+    text_dir, audio_dir, output_dir=None, output_format='smil',
+    sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
+    skip_penalty=None, radius=None, dtw_threads=1, global_alignment=False, coarse_factor=1, vad=False,
+    segment_length=None, preprocessing_workers=None, prefetch=2,
+    feature_cache_dir=None, feature_cache_max_bytes=None,
+    times_as_timedelta=False, language=None,
+    metrics=None, tmp_dir=None, columnar=False, float32_features=False,
+):
+    """
+    Same as align(), but yields a sync map of one text file as soon as all its fragments are mapped,
+    so that the files can be published before the whole book is aligned. E.g.
+
+    for sync_map in align_stream(text_dir, audio_dir, output_dir):
+        publish(sync_map)
+
+    If `output_dir` is not None, the output file of the text file is written before it is yielded.
+    Merged, the yielded sync maps give the result of align(). If the alignment is terminated,
+    text files yielded before stay mapped, unlike align() that returns an empty sync map.
+
+    Memory used by the alignment is bounded by the files being aligned,
+    the data of the text files yielded is released. See iter_sync_map().
+
+    Parameters are the same as for align(), except for `previous_sync_map` and `previous_file_hashes`.
+    """
+    with Aligner(
+        preprocessing_workers=preprocessing_workers,
+        prefetch=prefetch,
+        feature_cache_dir=feature_cache_dir,
+        feature_cache_max_bytes=feature_cache_max_bytes,
+    ) as aligner:
+        yield from aligner.align_stream(
+            text_dir, audio_dir, output_dir=output_dir, output_format=output_format,
+            sync_map_text_path_prefix=sync_map_text_path_prefix,
+            sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+            skip_penalty=skip_penalty, radius=radius, dtw_threads=dtw_threads,
+            global_alignment=global_alignment, coarse_factor=coarse_factor, vad=vad,
+            segment_length=segment_length,
+            times_as_timedelta=times_as_timedelta, language=language,
+            metrics=metrics, tmp_dir=tmp_dir, columnar=columnar, float32_features=float32_features,
+        )
+
+
+# Parameters of align() that can vary between the settings of align_sweep()
+SWEEP_PARAMETERS = {'skip_penalty', 'radius', 'global_alignment', 'coarse_factor', 'vad', 'segment_length'}
+
+
+def align_sweep(
+    text_dir, audio_dir, parameters,
+    sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
+    dtw_threads=1, preprocessing_workers=None, prefetch=2,
+    feature_cache_dir=None, feature_cache_max_bytes=None,
+    times_as_timedelta=False, language=None, columnar=False, float32_features=False,
+):
+    """
+    Aligns the same files with several settings of the alignment parameters.
+    Text is synthesized and MFCCs of text and audio are computed once for all settings,
+    so a sweep takes roughly the time of one align() call plus the alignment time of every setting.
+    MFCCs of all the files are kept in memory during the sweep.
+
+    `parameters` – a list of settings, each a dict of align() parameters to use,
+    e.g. [{'skip_penalty': 0.5}, {'skip_penalty': 0.75, 'radius': 200}].
+    Parameters that a setting lacks or sets to None have their align() defaults.
+    Allowed parameters are listed in SWEEP_PARAMETERS.
+
+    Other parameters are the same as for align().
+
+    Returns a list of (sync_map, stats) in the order of `parameters`,
+    where `sync_map` is what align() returns with the setting and `stats` is a dict of:
+    'path_cost' – total cost of the warping paths found, see get_path_cost(),
+    'fragments', 'matched_fragments' – number of text fragments and of those mapped to audio,
+    the latter is 0 if the alignment is terminated,
+    'audio_time', 'matched_audio_time' – duration of audio and of audio mapped from text in seconds.
+    Costs are comparable between settings with the same `skip_penalty` only.
+    """
+    for setting in parameters:
+        unknown = set(setting) - SWEEP_PARAMETERS
+        if unknown:
+            raise ValueError(f'Parameters {sorted(unknown)} cannot be swept.')
+
+    if language is None:
+        from aeneas.language import Language
+        language = Language.ENG
+
+    text_paths = get_paths(text_dir)
+    audio_paths = get_paths(audio_dir)
+
+    feature_cache = None
+    if feature_cache_dir is not None:
+        feature_cache = FeatureCache(feature_cache_dir, max_bytes=feature_cache_max_bytes)
+
+    tmp_dir = make_tmp_dir(text_dir)
+
+    with contextlib.ExitStack() as stack:
+        stack.callback(shutil.rmtree, tmp_dir, ignore_errors=True)
+
+        executor = None
+        if preprocessing_workers:
+            executor = stack.enter_context(ProcessPoolExecutor(preprocessing_workers))
+
+        prepared_texts, prepared_audios = prepare_files(
+            text_paths, audio_paths, tmp_dir, language, executor, prefetch, feature_cache,
+            float32_features=float32_features,
+        )
+        prepared_texts = list(prepared_texts)
+        prepared_audios = list(prepared_audios)
+
+    results = []
+    for setting in parameters:
+        # Parameters that a setting lacks or sets to None have the defaults of align()
+        build_parameters = get_build_parameters(
+            sync_map_text_path_prefix, sync_map_audio_path_prefix,
+            setting.get('skip_penalty'), setting.get('radius'), dtw_threads,
+            setting.get('global_alignment', False), setting.get('coarse_factor', 1), setting.get('vad', False),
+            setting.get('segment_length'), times_as_timedelta, language, None,
+            float32_features=float32_features,
+        )
+        stats = {
+            'path_cost': 0.0,
+            'fragments': sum(len(fragments) for fragments, _, _ in prepared_texts),
+            'matched_fragments': 0,
+            'audio_time': sum(len(sequence) for sequence in prepared_audios) * 0.040,
+            'matched_audio_time': 0.0,
+        }
+        sync_map = build_sync_map(
+            text_paths, audio_paths, tmp_dir,
+            prepared_texts=prepared_texts,
+            prepared_audios=prepared_audios,
+            stats=stats,
+            **build_parameters,
+        )
+        if not sync_map:
+            stats.update(matched_fragments=0, matched_audio_time=0.0)
+        results.append((sync_map if columnar else sync_map.to_dict(), stats))
+
+    return results
+
+
+def get_file_hashes(text_dir, audio_dir):
+    """
+    Returns hashes of text and audio files of the form: {
+        'text': {'text.xhtml': '<sha256>', ...},
+        'audio': {'audio.mp3': '<sha256>', ...},
+    }
+    """
+    return {
+        'text': _get_file_hashes(get_paths(text_dir)),
+        'audio': _get_file_hashes(get_paths(audio_dir)),
+    }
+
+
+def _get_file_hashes(paths):
+    return {get_name_from_path(path): hash_file(path) for path in paths}
+
+
+def check_file_hashes(file_hashes):
+    """
+    Raises ValueError if `file_hashes` is not of the form returned by get_file_hashes().
+    """
+    if not (
+        isinstance(file_hashes, dict)
+        and all(isinstance(file_hashes.get(kind), dict) for kind in ['text', 'audio'])
+    ):
+        raise ValueError(
+            'previous_file_hashes must be the result of get_file_hashes() '
+            'for the files previous_sync_map was built from.'
+        )
+
+
+def build_sync_map_incrementally(
+    text_paths, audio_paths, tmp_dir,
+    previous_sync_map, previous_file_hashes,
+    sync_map_text_path_prefix, sync_map_audio_path_prefix,
+    **kwargs
+):
+    """
+    Builds a sync map reusing `previous_sync_map` for the files that did not change.
+
+    Text and audio files are split into groups, so that in `previous_sync_map`
+    text files of each group are mapped only to audio files of the same group,
+    and every audio file of the group is mapped to.
+    Such boundaries are where build_sync_map() normally proceeds to the next text and audio files,
+    so groups are aligned independently of each other, and reusing the mapping of a group
+    gives the same result as realigning it.
+    A group is realigned with build_sync_map() if it contains a new or changed file
+    or a file that was mapped to a removed file. Other groups keep their previous mapping.
+
+    A group is realigned as a whole, and audio files are never split between groups.
+    Text files mapped to the same audio file are in the same group, so when one audio file
+    holds the whole book, any change realigns the whole book. Realigning only the part
+    of the audio file between the unchanged neighbouring text files would not give
+    the same result as align(), because the path through them could change too.
+
+    `previous_sync_map` can be a dict or a SyncMap. Returns a SyncMap.
+    """
+    if not isinstance(previous_sync_map, SyncMap):
+        previous_sync_map = SyncMap.from_dict(previous_sync_map)
+
+    text_paths = list(text_paths)
+    audio_paths = list(audio_paths)
+    text_keys = [os.path.join(sync_map_text_path_prefix, get_name_from_path(p)) for p in text_paths]
+    audio_keys = [os.path.join(sync_map_audio_path_prefix, get_name_from_path(p)) for p in audio_paths]
+    audio_indices = {key: k for k, key in enumerate(audio_keys)}
 
-    return sync_map
+    file_hashes = {
+        'text': _get_file_hashes(text_paths),
+        'audio': _get_file_hashes(audio_paths),
+    }
+    changed_texts = {
+        k for k, path in enumerate(text_paths)
+        if file_hashes['text'][get_name_from_path(path)] != previous_file_hashes['text'].get(get_name_from_path(path))
+        or text_keys[k] not in previous_sync_map
+    }
+    changed_audios = {
+        k for k, path in enumerate(audio_paths)
+        if file_hashes['audio'][get_name_from_path(path)] != previous_file_hashes['audio'].get(get_name_from_path(path))
+    }
+
+    # Text files mapped to removed audio files and audio files mapped from removed text files
+    # should be realigned too.
+    removed_audio_keys = {
+        os.path.join(sync_map_audio_path_prefix, name)
+        for name in previous_file_hashes['audio'] if name not in file_hashes['audio']
+    }
+    for text_key, fragment_map in previous_sync_map.items():
+        audio_files = {info['audio_file'] for info in fragment_map.values()}
+        if text_key not in text_keys:
+            changed_audios.update(audio_indices[a] for a in audio_files if a in audio_indices)
+        elif audio_files & removed_audio_keys:
+            changed_texts.add(text_keys.index(text_key))
+
+    # Range of audio files each text file is mapped to
+    audio_ranges = []
+    for text_key in text_keys:
+        indices = [
+            audio_indices[info['audio_file']]
+            for info in previous_sync_map.get(text_key, {}).values()
+            if info['audio_file'] in audio_indices
+        ]
+        audio_ranges.append((min(indices), max(indices)) if indices else None)
+
+    # Groups are given by ranges of text files and audio files.
+    # A text file with unknown audio range is merged with both neighbouring groups.
+    groups = []
+    group_text_from = 0
+    group_audio_from = 0
+    group_audio_to = 0
+    for k, audio_range in enumerate(audio_ranges):
+        if (
+            k > group_text_from and audio_range is not None and audio_ranges[k-1] is not None
+            and audio_range[0] == group_audio_to
+        ):
+            groups.append((group_text_from, k, group_audio_from, group_audio_to))
+            group_text_from = k
+            group_audio_from = group_audio_to
+        if audio_range is not None:
+            group_audio_to = max(group_audio_to, audio_range[1] + 1)
+    groups.append((group_text_from, len(text_paths), group_audio_from, len(audio_paths)))
+
+    sync_maps = []
+    for text_from, text_to, audio_from, audio_to in groups:
+        if (
+            changed_texts.intersection(range(text_from, text_to)) or
+            changed_audios.intersection(range(audio_from, audio_to))
+        ):
+            group_sync_map = build_sync_map(
+                text_paths[text_from:text_to], audio_paths[audio_from:audio_to], tmp_dir,
+                sync_map_text_path_prefix=sync_map_text_path_prefix,
+                sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+                **kwargs
+            )
+            if not group_sync_map:
+                return group_sync_map
+            sync_maps.append(group_sync_map)
+        else:
+            sync_maps.append(previous_sync_map.select(text_keys[text_from:text_to]))
+
+    return SyncMap.concatenate(sync_maps, kwargs['times_as_timedelta'])
 
 
 def build_sync_map(
@@ -116,6 +660,20 @@ def build_sync_map(
     skip_penalty, radius,
     times_as_timedelta,
     language,
+    dtw_threads=1,
+    global_alignment=False,
+    coarse_factor=1,
+    vad=False,
+    segment_frames=None,
+    executor=None,
+    prefetch=2,
+    feature_cache=None,
+    prepared_texts=None,
+    prepared_audios=None,
+    stats=None,
+    metrics=None,
+    dtw_workspace=None,
+    float32_features=False,
 ):
     """
     This is an algorithm for building a sync map.
@@ -149,58 +707,195 @@ def build_sync_map(
     If there is an extra content in the end of recorded sequence, align it with the next text file.
     If both sequences have extra content in the end, align text tail with the next audio file.
     If none of the above, align next text and audio files.
+
+    Steps 1 and 2 do not depend on the alignment, so if `executor` is given,
+    they are performed in it for up to `prefetch` upcoming files
+    while the current files are being aligned.
+    If `feature_cache` is given, MFCCs of audio files and of text fragments are looked up in it first.
+
+    If `global_alignment` is True, build_sync_map_globally() is used instead of steps 3-6.
+
+    If `coarse_factor` is greater than 1, the warping path in step 3 is found
+    at a lower frame rate by get_path(), and in step 5 the anchors are refined
+    at the original frame rate by refine_matched_frames().
+
+    If `vad` is True, pauses are shortened before step 3, see get_path().
+
+    If `segment_frames` is given, the warping path in step 3 of long files is found
+    in segments, see get_segmented_path().
+
+    `prepared_texts` and `prepared_audios` – results of prepare_text() and prepare_audio()
+    for `text_paths` and `audio_paths`. If given, steps 1 and 2 are skipped.
+
+    `stats` – if a dict is given, the cost of the warping paths found and the number of fragments
+    and the duration of audio mapped are added to its values, see align_sweep().
+
+    `metrics` – if Metrics are given, the stages and the alignments are measured, see align().
+
+    `dtw_workspace` – DTWBDWorkspace to allocate the buffers of the alignment algorithm from.
+    If None, a new one is used.
+
+    `float32_features` – if True, MFCCs are prepared as float32, see align().
+
+    Returns a SyncMap, see SyncMap.to_dict() for the sync map of the form returned by align().
     """
+    if not global_alignment:
+        sync_maps = list(iter_sync_map(
+            text_paths, audio_paths, tmp_dir,
+            sync_map_text_path_prefix=sync_map_text_path_prefix,
+            sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+            skip_penalty=skip_penalty,
+            radius=radius,
+            times_as_timedelta=times_as_timedelta,
+            language=language,
+            dtw_threads=dtw_threads,
+            coarse_factor=coarse_factor,
+            vad=vad,
+            segment_frames=segment_frames,
+            executor=executor,
+            prefetch=prefetch,
+            feature_cache=feature_cache,
+            prepared_texts=prepared_texts,
+            prepared_audios=prepared_audios,
+            stats=stats,
+            metrics=metrics,
+            dtw_workspace=dtw_workspace,
+            float32_features=float32_features,
+        ))
+        if sync_maps and sync_maps[-1] is None:
+            return SyncMap.from_dict({})
+        return SyncMap.concatenate(sync_maps, times_as_timedelta)
 
-    synthesizer = Synthesizer()
-    parse_parameters = {'is_text_unparsed_id_regex': 'f[0-9]+'}
-    
-    sync_map = {}
+    return build_sync_map_globally(
+            text_paths, audio_paths, tmp_dir,
+            sync_map_text_path_prefix=sync_map_text_path_prefix,
+            sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+            skip_penalty=skip_penalty,
+            radius=radius,
+            times_as_timedelta=times_as_timedelta,
+            language=language,
+            dtw_threads=dtw_threads,
+            coarse_factor=coarse_factor,
+            vad=vad,
+            segment_frames=segment_frames,
+            executor=executor,
+            prefetch=prefetch,
+            feature_cache=feature_cache,
+            prepared_texts=prepared_texts,
+            prepared_audios=prepared_audios,
+            stats=stats,
+            metrics=metrics,
+            dtw_workspace=dtw_workspace,
+            float32_features=float32_features,
+        )
+
+
+def iter_sync_map(
+    text_paths, audio_paths, tmp_dir,
+    sync_map_text_path_prefix, sync_map_audio_path_prefix,
+    skip_penalty, radius,
+    times_as_timedelta,
+    language,
+    dtw_threads=1,
+    global_alignment=False,
+    coarse_factor=1,
+    vad=False,
+    segment_frames=None,
+    executor=None,
+    prefetch=2,
+    feature_cache=None,
+    prepared_texts=None,
+    prepared_audios=None,
+    stats=None,
+    metrics=None,
+    dtw_workspace=None,
+    float32_features=False,
+):
+    """
+    Same as build_sync_map(), but yields a SyncMap of every text file
+    as soon as all its fragments are mapped. Concatenated, they give the result of build_sync_map().
+
+    MFCCs and anchors of a text file are released before its sync map is yielded,
+    as are MFCCs of an audio file that is not aligned any further.
+    Files are prepared as they are needed, so memory is bounded by the current text and audio files
+    and `prefetch` files prepared ahead.
+
+    If the alignment is terminated, yields None and stops.
+    With `global_alignment` all the files are aligned before the first text file is yielded.
+    """
+    if global_alignment:
+        sync_map = build_sync_map_globally(
+            text_paths, audio_paths, tmp_dir,
+            sync_map_text_path_prefix=sync_map_text_path_prefix,
+            sync_map_audio_path_prefix=sync_map_audio_path_prefix,
+            skip_penalty=skip_penalty,
+            radius=radius,
+            times_as_timedelta=times_as_timedelta,
+            language=language,
+            dtw_threads=dtw_threads,
+            coarse_factor=coarse_factor,
+            vad=vad,
+            segment_frames=segment_frames,
+            executor=executor,
+            prefetch=prefetch,
+            feature_cache=feature_cache,
+            prepared_texts=prepared_texts,
+            prepared_audios=prepared_audios,
+            stats=stats,
+            metrics=metrics,
+            dtw_workspace=dtw_workspace,
+            float32_features=float32_features,
+        )
+        if not sync_map and text_paths:
+            yield None
+        for text_file in sync_map:
+            yield sync_map.select([text_file])
+        return
+
+    text_paths = list(text_paths)
+    audio_paths = list(audio_paths)
+    if prepared_texts is None or prepared_audios is None:
+        prepared_texts, prepared_audios = prepare_files(
+            text_paths, audio_paths, tmp_dir, language, executor, prefetch, feature_cache, metrics,
+            float32_features,
+        )
+    texts = zip(text_paths, prepared_texts)
+    audios = enumerate(zip(audio_paths, prepared_audios))
+
+    output_audio_names = [
+        os.path.join(sync_map_audio_path_prefix, get_name_from_path(p)) for p in audio_paths
+    ]
+    # Fragments of the current text file
+    sync_map = None
     process_next_text = True
     process_next_audio = True
 
+    # Files and their tails are aligned one after another,
+    # so the buffers of the alignment algorithm are allocated once.
+    if dtw_workspace is None:
+        dtw_workspace = DTWBDWorkspace()
+
     while True:
         if process_next_text:
             try:
-                text_path = next(text_paths)
+                text_path, (fragments, anchors, text_mfcc_sequence) = next(texts)
             except StopIteration:
                 break
 
             text_name = get_name_from_path(text_path)
-            output_text_name = os.path.join(sync_map_text_path_prefix, text_name)
-            textfile = TextFile(text_path, file_format=TextFileFormat.UNPARSED, parameters=parse_parameters)
-            textfile.set_language(language)
-            text_wav_path = os.path.join(tmp_dir, f'{drop_extension(text_name)}_text.wav')
-            sync_map[output_text_name] = {}
-
-            # Produce synthesized audio, get anchors
-            anchors,_,_ = synthesizer.synthesize(textfile, text_wav_path)
-            
-            # Get fragments, convert anchors timings to the frames indicies
-            fragments = [a[1] for a in anchors]
-            anchors = np.array([int(a[0] / TimeValue('0.040')) for a in anchors])
-
-            # MFCC frames sequence memory layout is a n x l 2D array,
-            # where n - number of frames and l - number of MFFCs
-            # i.e it is c-contiguous, but after dropping the first coefficient it siezes to be c-contiguous.
-            # Should decide whether to make a copy or to work around the first coefficient.
-            text_mfcc_sequence = np.ascontiguousarray(
-                AudioFileMFCC(text_wav_path).all_mfcc.T[:, 1:]
+            sync_map = SyncMapBuilder(
+                [os.path.join(sync_map_text_path_prefix, text_name)], output_audio_names, times_as_timedelta,
             )
             
         if process_next_audio:
             try:
-                audio_path = next(audio_paths)
+                audio_index, (audio_path, audio_mfcc_sequence) = next(audios)
             except StopIteration:
-                break
+                # Texts that are left are not mapped
+                yield sync_map.build()
+                return
 
             audio_name = get_name_from_path(audio_path)
-            output_audio_name = os.path.join(sync_map_audio_path_prefix, audio_name)
-            audio_wav_path = os.path.join(tmp_dir, f'{drop_extension(audio_name)}_audio.wav')
-            subprocess.run(['ffmpeg', '-n', '-i', audio_path, '-rf64', 'auto', audio_wav_path])
-
-            audio_mfcc_sequence = np.ascontiguousarray(
-                AudioFileMFCC(audio_wav_path).all_mfcc.T[:, 1:]
-            )
             
             # Keep track to calculate frames timings
             audio_start_frame = 0
@@ -208,7 +903,17 @@ def build_sync_map(
         n = len(text_mfcc_sequence)
         m = len(audio_mfcc_sequence)
 
-        _, path = c_FastDTWBD(text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius=radius)
+        dtw_stats = {} if metrics is not None else None
+        with measure(metrics, 'alignment', text_file=text_name, audio_file=audio_name):
+            path = get_path(
+                text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+                dtw_threads, dtw_workspace, coarse_factor, vad, segment_frames, dtw_stats,
+            )
+        if metrics is not None:
+            metrics.add_alignment(text_file=text_name, audio_file=audio_name, n=n, m=m, **dtw_stats)
+
+        if stats is not None:
+            add_stats(stats, path_cost=get_path_cost(text_mfcc_sequence, audio_mfcc_sequence, path, skip_penalty))
         
         if len(path) == 0:
             print(
@@ -216,7 +921,8 @@ def build_sync_map(
                 f'Alignment is terminated. '
                 f'Adjust skip_penalty or input files.'
             )
-            return {}
+            yield None
+            return
         
         # Project path to the text and audio sequences
         text_path_frames = path[:,0]
@@ -242,19 +948,27 @@ def build_sync_map(
         
         # Get anchors' frames in audio sequence, calculate their timings
         anchors_matched_frames = audio_path_frames[text_path_anchor_indices]
+        if coarse_factor > 1:
+            with measure(metrics, 'anchor_refinement', text_file=text_name, audio_file=audio_name):
+                anchors_matched_frames = refine_matched_frames(
+                    text_mfcc_sequence, audio_mfcc_sequence,
+                    anchors_to_map, anchors_matched_frames,
+                    skip_penalty, coarse_factor, dtw_threads,
+                )
+            anchors_matched_frames = np.minimum(
+                np.maximum.accumulate(anchors_matched_frames), audio_path_frames[-1]
+            )
         timings = (np.append(anchors_matched_frames, audio_path_frames[-1]) + audio_start_frame) * 0.040
         
         # Map fragment_ids to timings, update mapping of the current text file
-        fragment_map = {
-            f: {
-                'audio_file': output_audio_name,
-                'begin_time': format_time(bt, times_as_timedelta),
-                'end_time': format_time(et, times_as_timedelta),
-            }
-            for f, bt, et in zip(fragments_to_map, timings[:-1], timings[1:])
-        }
+        sync_map.add(0, fragments_to_map, audio_index, timings[:-1], timings[1:])
 
-        sync_map[output_text_name].update(fragment_map)
+        if stats is not None:
+            add_stats(
+                stats,
+                matched_fragments=len(fragments_to_map),
+                matched_audio_time=float(timings[-1] - timings[0]),
+            )
         
         # Decide whether to process next file or to align the tail of the current one
 
@@ -264,6 +978,8 @@ def build_sync_map(
         else:
             # Otherwise align tail of the current text
             process_next_text = False
+            if metrics is not None:
+                metrics.count('text_tail_realignments')
             text_mfcc_sequence = text_mfcc_sequence[last_matched_text_frame:]
             fragments = fragments[map_anchors_to:]
             anchors = anchors[map_anchors_to:] - last_matched_text_frame
@@ -277,10 +993,826 @@ def build_sync_map(
         else:
             # Otherwise align tail of the current audio
             process_next_audio = False
+            if metrics is not None:
+                metrics.count('audio_tail_realignments')
             audio_mfcc_sequence = audio_mfcc_sequence[last_matched_audio_frame:]
             audio_start_frame += last_matched_audio_frame
+
+        if process_next_text:
+            # Release the files that are done with before the consumer gets the result
+            fragments = anchors = text_mfcc_sequence = None
+            if process_next_audio:
+                audio_mfcc_sequence = None
+            path = text_path_frames = audio_path_frames = None
+            yield sync_map.build()
+
+
+def build_sync_map_globally(
+    text_paths, audio_paths, tmp_dir,
+    sync_map_text_path_prefix, sync_map_audio_path_prefix,
+    skip_penalty, radius,
+    times_as_timedelta,
+    language,
+    dtw_threads=1,
+    coarse_factor=1,
+    vad=False,
+    segment_frames=None,
+    executor=None,
+    prefetch=2,
+    feature_cache=None,
+    prepared_texts=None,
+    prepared_audios=None,
+    stats=None,
+    metrics=None,
+    dtw_workspace=None,
+    float32_features=False,
+):
+    """
+    Same as build_sync_map(), but instead of aligning files one by one
+    and realigning the tails, aligns the concatenation of all text MFCC sequences
+    with the concatenation of all audio MFCC sequences in a single pass.
+    Anchors and the warping path are then mapped back to the files.
+
+    Realigning the tails takes time proportional to the number of files
+    times the length of the longest file, e.g. when many short text files
+    are mapped to a long audio file, every text is aligned with the rest of the audio.
+    A single pass takes time proportional to the total length.
+    On the other hand, MFCCs of all the files are kept in memory at once.
+
+    A fragment is mapped to the audio file its beginning is matched to.
+    If it ends in the next audio file, its end time is the end of the audio file.
+    """
+    text_paths = list(text_paths)
+    audio_paths = list(audio_paths)
+    if prepared_texts is None or prepared_audios is None:
+        prepared_texts, prepared_audios = prepare_files(
+            text_paths, audio_paths, tmp_dir, language, executor, prefetch, feature_cache, metrics,
+            float32_features,
+        )
+    texts = list(prepared_texts)
+    audios = list(prepared_audios)
+
+    sync_map = SyncMapBuilder(
+        [os.path.join(sync_map_text_path_prefix, get_name_from_path(p)) for p in text_paths],
+        [os.path.join(sync_map_audio_path_prefix, get_name_from_path(p)) for p in audio_paths],
+        times_as_timedelta,
+    )
+    if not texts or not audios:
+        return sync_map.build()
+
+    text_lengths = [len(sequence) for _, _, sequence in texts]
+    text_offsets = np.cumsum([0] + text_lengths)
+    audio_offsets = np.cumsum([0] + [len(sequence) for sequence in audios])
+
+    # Fragments of all texts: text file index, fragment id, first and last frames
+    fragments_texts = np.concatenate([
+        np.full(len(fragments), k, dtype=np.intp) for k, (fragments, _, _) in enumerate(texts)
+    ])
+    fragments_ids = [f for fragments, _, _ in texts for f in fragments]
+    fragments_begins = np.concatenate([
+        np.asarray(anchors, dtype=np.intp) + text_offsets[k]
+        for k, (_, anchors, _) in enumerate(texts)
+    ])
+    # A fragment ends where the next one begins or where its text ends
+    fragments_ends = np.empty_like(fragments_begins)
+    fragments_ends[:-1] = fragments_begins[1:]
+    last_in_text = np.ones(len(fragments_texts), dtype=bool)
+    last_in_text[:-1] = fragments_texts[1:] != fragments_texts[:-1]
+    fragments_ends[last_in_text] = text_offsets[fragments_texts[last_in_text] + 1]
+
+    text_mfcc_sequence = np.concatenate([sequence for _, _, sequence in texts])
+    audio_mfcc_sequence = np.concatenate(audios)
+    dtw_stats = {} if metrics is not None else None
+    with measure(metrics, 'alignment'):
+        path = get_path(
+            text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+            dtw_threads, dtw_workspace, coarse_factor, vad, segment_frames, dtw_stats,
+        )
+    if metrics is not None:
+        metrics.add_alignment(
+            text_file=None, audio_file=None,
+            n=len(text_mfcc_sequence), m=len(audio_mfcc_sequence), **dtw_stats,
+        )
+
+    if stats is not None:
+        add_stats(stats, path_cost=get_path_cost(text_mfcc_sequence, audio_mfcc_sequence, path, skip_penalty))
+
+    if len(path) == 0:
+        print(
+            f'No match between text and audio. '
+            f'Alignment is terminated. '
+            f'Adjust skip_penalty or input files.'
+        )
+        return SyncMap.from_dict({})
+
+    text_path_frames = path[:,0]
+    audio_path_frames = path[:,1]
+
+    # Map only those fragments that intersect matched frames
+    map_from = np.searchsorted(fragments_ends, text_path_frames[0], side='right')
+    map_to = np.searchsorted(fragments_begins, text_path_frames[-1], side='right')
+
+    # Get fragments' boundaries in audio sequence
+    path_indices = np.searchsorted(text_path_frames, fragments_begins[map_from:map_to])
+    begin_frames = audio_path_frames[np.minimum(path_indices, len(path) - 1)]
+    path_indices = np.searchsorted(text_path_frames, fragments_ends[map_from:map_to])
+    end_frames = audio_path_frames[np.minimum(path_indices, len(path) - 1)]
+    if coarse_factor > 1:
+        with measure(metrics, 'anchor_refinement'):
+            begin_frames, end_frames = np.split(refine_matched_frames(
+                text_mfcc_sequence, audio_mfcc_sequence,
+                np.concatenate([fragments_begins[map_from:map_to], fragments_ends[map_from:map_to]]),
+                np.concatenate([begin_frames, end_frames]),
+                skip_penalty, coarse_factor, dtw_threads,
+            ), 2)
+        begin_frames = np.maximum.accumulate(begin_frames)
+        end_frames = np.maximum(begin_frames, end_frames)
+
+    # Map boundaries to audio files
+    audio_indices = np.searchsorted(audio_offsets, begin_frames, side='right') - 1
+    end_frames = np.minimum(end_frames, audio_offsets[audio_indices + 1] - 1)
+    begin_timings = (begin_frames - audio_offsets[audio_indices]) * 0.040
+    end_timings = (end_frames - audio_offsets[audio_indices]) * 0.040
+
+    sync_map.add(
+        fragments_texts[map_from:map_to], fragments_ids[map_from:map_to],
+        audio_indices, begin_timings, end_timings,
+    )
+
+    if stats is not None:
+        add_stats(
+            stats,
+            matched_fragments=int(map_to - map_from),
+            matched_audio_time=float(np.sum(end_timings - begin_timings)),
+        )
+
+    return sync_map.build()
+
+
+def get_path(
+    text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+    dtw_threads=1, dtw_workspace=None, coarse_factor=1, vad=False, segment_frames=None, stats=None,
+):
+    """
+    Returns the warping path of the text and audio MFCC sequences.
+    The first coefficient of the frames is the energy, it is not used for the alignment.
+
+    If `vad` is True, only the frames returned by get_speech_frames() are aligned,
+    and the path is mapped back to the original frames.
+    Dropped frames are skipped by the path, except for the frames in the end of the sequences,
+    which are matched to the end of the other sequence if it is matched too.
+
+    If `segment_frames` is given and either sequence is longer,
+    the path is found by get_segmented_path().
+
+    If `coarse_factor` is greater than 1, the sequences are aligned
+    with every `coarse_factor` frames averaged into one.
+    The path is projected back to the original frames by project_path().
+    The result is precise up to `coarse_factor` frames.
+
+    `stats` – dict to add the counters of c_FastDTWBD() to.
+    The segments aligned by get_segmented_path() are not counted.
+    """
+    n = len(text_mfcc_sequence)
+    m = len(audio_mfcc_sequence)
+
+    if vad:
+        text_frames = get_speech_frames(text_mfcc_sequence)
+        audio_frames = get_speech_frames(audio_mfcc_sequence)
+        path = get_path(
+            text_mfcc_sequence[text_frames], audio_mfcc_sequence[audio_frames],
+            skip_penalty, radius, dtw_threads, dtw_workspace, coarse_factor,
+            segment_frames=segment_frames, stats=stats,
+        )
+
+        if len(path) == 0:
+            return path
+
+        text_path_frames = text_frames[path[:,0]]
+        audio_path_frames = audio_frames[path[:,1]]
+        end_cell = (
+            n - 1 if path[-1,0] == len(text_frames) - 1 else text_path_frames[-1],
+            m - 1 if path[-1,1] == len(audio_frames) - 1 else audio_path_frames[-1],
+        )
+        path = np.stack([text_path_frames, audio_path_frames], axis=1).astype('uintp')
+        if end_cell != tuple(path[-1]):
+            path = np.append(path, np.array([end_cell], dtype='uintp'), axis=0)
+        return path
+
+    if segment_frames is not None and max(n, m) > segment_frames:
+        return get_segmented_path(
+            text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+            segment_frames, dtw_threads, coarse_factor,
+        )
+
+    if coarse_factor <= 1:
+        _, path = c_FastDTWBD(
+            text_mfcc_sequence[:,1:], audio_mfcc_sequence[:,1:], skip_penalty,
+            radius=radius, threads=dtw_threads, workspace=dtw_workspace, stats=stats,
+        )
+        return path
+
+    _, coarse_path = c_FastDTWBD(
+        get_coarse_sequence(text_mfcc_sequence[:,1:], coarse_factor),
+        get_coarse_sequence(audio_mfcc_sequence[:,1:], coarse_factor),
+        skip_penalty, radius=radius, threads=dtw_threads, workspace=dtw_workspace, stats=stats,
+    )
+
+    return project_path(coarse_path, coarse_factor, n, m)
+
+
+def get_path_cost(text_mfcc_sequence, audio_mfcc_sequence, path, skip_penalty):
+    """
+    Returns the cost of the warping path the way DTWBD measures it:
+    the sum of distances between the matched frames
+    plus `skip_penalty` for every frame skipped in the beginning and in the end of the sequences.
+    The cost of an empty path is `skip_penalty` for every frame.
+    """
+    n = len(text_mfcc_sequence)
+    m = len(audio_mfcc_sequence)
+
+    if len(path) == 0:
+        return skip_penalty * (n + m)
+
+    text_path_frames = path[:,0].astype(np.intp)
+    audio_path_frames = path[:,1].astype(np.intp)
+    distances = np.linalg.norm(
+        text_mfcc_sequence[text_path_frames, 1:] - audio_mfcc_sequence[audio_path_frames, 1:], axis=1
+    )
+    skipped_frames = (
+        text_path_frames[0] + audio_path_frames[0] +
+        (n - 1 - text_path_frames[-1]) + (m - 1 - audio_path_frames[-1])
+    )
+    return float(np.sum(distances, dtype=np.float64) + skip_penalty * skipped_frames)
+
+
+def project_path(coarse_path, coarse_factor, n, m):
+    """
+    Projects the path of the sequences with every `coarse_factor` frames averaged
+    to the original sequences of `n` and `m` frames.
+    Every text frame from the first matched to the last matched one is present in the path,
+    and the text frames of an averaged frame are spread evenly over the audio frames
+    it is matched to.
+    """
+    if len(coarse_path) == 0:
+        return coarse_path
+
+    coarse_text_frames = coarse_path[:,0].astype(np.intp)
+    coarse_audio_frames = coarse_path[:,1].astype(np.intp)
+
+    # Frames that do not fill the last averaged frame belong to it
+    def get_frames_range(coarse_frames, length):
+        frames_from = coarse_frames * coarse_factor
+        frames_to = np.where(
+            coarse_frames == length // coarse_factor - 1, length, frames_from + coarse_factor
+        )
+        return frames_from, frames_to
+
+    text_from, text_to = get_frames_range(coarse_text_frames[[0, -1]], n)
+    text_path_frames = np.arange(text_from[0], text_to[1])
+    coarse_text = np.minimum(text_path_frames // coarse_factor, coarse_text_frames[-1])
+
+    # Range of audio frames every text frame's averaged frame is matched to
+    first_cells = np.searchsorted(coarse_text_frames, coarse_text, side='left')
+    last_cells = np.searchsorted(coarse_text_frames, coarse_text, side='right') - 1
+    audio_from, _ = get_frames_range(coarse_audio_frames[first_cells], m)
+    _, audio_to = get_frames_range(coarse_audio_frames[last_cells], m)
+    block_from, block_to = get_frames_range(coarse_text, n)
+
+    audio_path_frames = audio_from + (
+        (text_path_frames - block_from) * (audio_to - audio_from) // (block_to - block_from)
+    )
+    audio_path_frames = np.maximum.accumulate(audio_path_frames)
+    if coarse_audio_frames[-1] == m // coarse_factor - 1:
+        audio_path_frames[-1] = m - 1
+
+    return np.stack([text_path_frames, audio_path_frames], axis=1).astype('uintp')
+
+
+# Segments are found by aligning the sequences with this many frames averaged
+SEGMENT_COARSE_FACTOR = 8
+
+
+def get_segmented_path(
+    text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+    segment_frames, dtw_threads=1, coarse_factor=1,
+):
+    """
+    Returns the warping path of long sequences found segment by segment.
+
+    First, the sequences are aligned with SEGMENT_COARSE_FACTOR frames averaged into one.
+    The text frames matched by this path are split into segments of `segment_frames` frames.
+    A segment ends earlier if its text frames are matched to more than `segment_frames` audio frames,
+    so long audio is split too. The path gives the audio frames matched to every segment.
+    Every segment is extended by a quarter of its length in both directions in both sequences
+    and aligned independently, all segments in one c_FastDTWBD_batch() call
+    on `dtw_threads` threads. The cells of every segment's path that lie
+    outside the segment's own text frames are dropped, and the rest are joined.
+    Memory used by every thread is bounded by the size of the extended segments.
+    Content more than a segment before the beginning or after the end of the rough path
+    is left unmatched.
+
+    Segments overlap, so an error in the beginning or in the end of a segment's path,
+    where it has to start or end not knowing the neighbouring segments,
+    falls on the frames that are dropped. The result is close to the path
+    found without segments if the overlap exceeds the errors of the coarse path
+    and the longest pause. On synthetic sequences with 4 s pauses, segments of 40 s
+    reproduce the unsegmented path exactly, while segments of 12 s lose fragments.
+    The test_segmented_alignment test compares the two on the test recordings.
+    """
+    n = len(text_mfcc_sequence)
+    m = len(audio_mfcc_sequence)
+    overlap = segment_frames // 4
+
+    rough_path = get_path(
+        text_mfcc_sequence, audio_mfcc_sequence, skip_penalty, radius,
+        dtw_threads, coarse_factor=max(coarse_factor, SEGMENT_COARSE_FACTOR),
+    )
+
+    if len(rough_path) == 0:
+        return rough_path
+
+    rough_text_frames = rough_path[:,0].astype(np.intp)
+    rough_audio_frames = rough_path[:,1].astype(np.intp)
+
+    # Segments' own text frames. The first and the last segments get all frames before and after
+    # the rough path, so that heads and tails are detected by the segments' alignment.
+    bounds = [int(rough_text_frames[0])]
+    while True:
+        bound = bounds[-1] + segment_frames
+        # The first cell of the rough path a segment further in the audio
+        k = np.searchsorted(rough_text_frames, bounds[-1])
+        k = np.searchsorted(rough_audio_frames, rough_audio_frames[k] + segment_frames)
+        if k < len(rough_path):
+            bound = min(bound, max(int(rough_text_frames[k]), bounds[-1] + 1))
+        if bound > rough_text_frames[-1]:
+            break
+        bounds.append(bound)
+    bounds[0] = 0
+    bounds.append(n)
+
+    segments = []
+    for own_from, own_to in zip(bounds[:-1], bounds[1:]):
+        text_from = max(own_from - overlap, 0)
+        text_to = min(own_to + overlap, n)
+        rough_indices = np.searchsorted(rough_text_frames, [text_from, text_to - 1])
+        rough_indices = np.minimum(rough_indices, len(rough_path) - 1)
+        audio_from = max(rough_audio_frames[rough_indices[0]] - overlap, 0)
+        audio_to = min(rough_audio_frames[rough_indices[1]] + overlap + 1, m)
+        # The rough path may start late or end early, e.g. at a long pause,
+        # so the outer segments reach a segment further than it
+        if own_from == 0:
+            text_from = max(rough_text_frames[0] - segment_frames, 0)
+            audio_from = max(rough_audio_frames[0] - segment_frames, 0)
+        if own_to == n:
+            text_to = min(rough_text_frames[-1] + 1 + segment_frames, n)
+            audio_to = min(rough_audio_frames[-1] + 1 + segment_frames, m)
+        segments.append((own_from, own_to, text_from, text_to, audio_from, audio_to))
+
+    pairs = [
+        (
+            text_mfcc_sequence[text_from:text_to, 1:],
+            audio_mfcc_sequence[audio_from:audio_to, 1:],
+        )
+        for _, _, text_from, text_to, audio_from, audio_to in segments
+    ]
+    if coarse_factor > 1:
+        pairs = [
+            (get_coarse_sequence(s, coarse_factor), get_coarse_sequence(t, coarse_factor))
+            for s, t in pairs
+        ]
+    results = c_FastDTWBD_batch(pairs, skip_penalty, radius=radius, threads=dtw_threads)
+
+    paths = []
+    for (own_from, own_to, text_from, text_to, audio_from, audio_to), (_, path) in zip(segments, results):
+        if coarse_factor > 1:
+            path = project_path(path, coarse_factor, text_to - text_from, audio_to - audio_from)
+        path = path.astype(np.intp) + [text_from, audio_from]
+        paths.append(path[(path[:,0] >= own_from) & (path[:,0] < own_to)])
+
+    path = np.concatenate(paths)
+    if len(path) > 0:
+        path[:,1] = np.maximum.accumulate(path[:,1])
+
+    return path.astype('uintp')
+
+
+def get_coarse_sequence(sequence, coarse_factor):
+    """
+    Returns the sequence with every `coarse_factor` consecutive frames averaged into one.
+    The last frames that do not make up a whole group are dropped.
+    """
+    coarse_len = len(sequence) // coarse_factor
+    return sequence[:coarse_len * coarse_factor].reshape(coarse_len, coarse_factor, sequence.shape[1]).mean(axis=1)
+
+
+# A frame is a non-speech frame if its log energy exceeds the minimum by less than the threshold.
+VAD_LOG_ENERGY_THRESHOLD = 0.699
+# Runs of non-speech frames are shortened to this number of frames (200 ms)
+VAD_MAX_NONSPEECH_FRAMES = 5
+
+
+def get_speech_frames(mfcc_sequence):
+    """
+    Returns indices of the frames to align: speech frames and
+    VAD_MAX_NONSPEECH_FRAMES frames of every run of non-speech frames,
+    half of them in the beginning of the run and half in the end.
+    Since the middle of a pause is dropped, a fragment boundary inside the pause
+    is mapped to its beginning or to its end.
+    Non-speech frames are detected by the energy, which is the first coefficient,
+    the same way as aeneas VAD does.
+    Short pauses are kept since synthesized speech has them too.
+    """
+    energy = mfcc_sequence[:,0]
+    if len(energy) == 0:
+        return np.arange(0)
+
+    speech = energy >= energy.min() + VAD_LOG_ENERGY_THRESHOLD
+    frames = np.arange(len(energy))
+    last_speech_frames = np.maximum.accumulate(np.where(speech, frames, -1))
+    next_speech_frames = np.minimum.accumulate(np.where(speech, frames, len(energy))[::-1])[::-1]
+    keep_before = VAD_MAX_NONSPEECH_FRAMES - VAD_MAX_NONSPEECH_FRAMES // 2
+    keep_after = VAD_MAX_NONSPEECH_FRAMES // 2
+    return np.flatnonzero(
+        (frames - last_speech_frames <= keep_before) |
+        (next_speech_frames - frames <= keep_after)
+    )
+
+
+def refine_matched_frames(
+    text_mfcc_sequence, audio_mfcc_sequence, text_frames, audio_frames,
+    skip_penalty, coarse_factor, dtw_threads=1,
+):
+    """
+    Refines the audio frames matched to the text frames by a path from get_path().
     
-    return sync_map
+    For every text frame, its neighbourhood of 4 * `coarse_factor` frames in both directions
+    is aligned with the neighbourhood of the matched audio frame at the original frame rate,
+    which is 5 * `coarse_factor` frames in both directions to cover the error of the coarse path.
+    Neighbourhoods are small, so they are aligned by DTWBD without windows, all in one batch.
+    If the text frame is not matched in its neighbourhood, the audio frame is kept.
+    """
+    text_radius = 4 * coarse_factor
+    audio_radius = 5 * coarse_factor
+    n = len(text_mfcc_sequence)
+    m = len(audio_mfcc_sequence)
+    text_frames = np.asarray(text_frames, dtype=np.intp)
+    audio_frames = np.asarray(audio_frames, dtype=np.intp)
+
+    to_refine = np.flatnonzero(text_frames < n)
+    text_froms = np.maximum(text_frames[to_refine] - text_radius, 0)
+    audio_froms = np.clip(audio_frames[to_refine] - audio_radius, 0, m)
+    pairs = [
+        (
+            text_mfcc_sequence[text_from:text_frame + text_radius, 1:],
+            audio_mfcc_sequence[audio_from:audio_frame + audio_radius, 1:],
+        )
+        for text_from, text_frame, audio_from, audio_frame in zip(
+            text_froms, text_frames[to_refine], audio_froms, audio_frames[to_refine]
+        )
+    ]
+    results = c_FastDTWBD_batch(
+        pairs, skip_penalty, radius=text_radius + audio_radius, threads=dtw_threads
+    )
+
+    refined_frames = audio_frames.copy()
+    for k, text_from, audio_from, (_, path) in zip(to_refine, text_froms, audio_froms, results):
+        local_frame = text_frames[k] - text_from
+        path_index = np.searchsorted(path[:,0], local_frame)
+        if path_index < len(path) and path[path_index,0] == local_frame:
+            refined_frames[k] = audio_from + path[path_index,1]
+
+    return refined_frames
+
+
+def prepare_files(
+    text_paths, audio_paths, tmp_dir, language,
+    executor=None, prefetch=2, feature_cache=None, metrics=None, float32_features=False,
+):
+    """
+    Returns iterators over the results of prepare_text() for `text_paths`
+    and of prepare_audio() for `audio_paths`, see prefetch_map().
+    If `metrics` is given, the stages of preparing every file are added to it,
+    including the files prepared in `executor`.
+    """
+    prepare_text_func = functools.partial(
+        prepare_text, tmp_dir=tmp_dir, language=language, feature_cache=feature_cache,
+        float32_features=float32_features,
+    )
+    prepare_audio_func = functools.partial(
+        prepare_audio, feature_cache=feature_cache, float32_features=float32_features,
+    )
+
+    if metrics is None:
+        return (
+            prefetch_map(prepare_text_func, text_paths, executor, prefetch),
+            prefetch_map(prepare_audio_func, audio_paths, executor, prefetch),
+        )
+
+    return (
+        metrics.collect(prefetch_map(
+            functools.partial(call_measured, prepare_text_func), text_paths, executor, prefetch,
+        )),
+        metrics.collect(prefetch_map(
+            functools.partial(call_measured, prepare_audio_func), audio_paths, executor, prefetch,
+        )),
+    )
+
+
+def prepare_text(text_path, tmp_dir, language, feature_cache=None, metrics=None, float32_features=False):
+    """
+    Synthesizes text file and produces a list of anchors.
+    Returns a list of fragment ids, an array of anchors as frames indices
+    and a sequence of MFCC frames of synthesized audio.
+
+    If `feature_cache` is given, MFCC frames are cached per fragment,
+    and only the fragments that are not in the cache are synthesized.
+    If `metrics` is given, synthesis and MFCC extraction are measured.
+    If `float32_features` is True, MFCC frames are float32.
+    """
+    from aeneas.textfile import TextFile, TextFileFormat
+
+    parse_parameters = {'is_text_unparsed_id_regex': 'f[0-9]+'}
+    text_name = get_name_from_path(text_path)
+    textfile = TextFile(text_path, file_format=TextFileFormat.UNPARSED, parameters=parse_parameters)
+    textfile.set_language(language)
+    text_wav_path = os.path.join(tmp_dir, f'{drop_extension(text_name)}_text.wav')
+
+    if feature_cache is not None:
+        return synthesize_with_cache(textfile, text_wav_path, feature_cache, metrics, float32_features)
+
+    return synthesize(textfile, text_wav_path, metrics, float32_features)
+
+
+def synthesize_with_cache(textfile, text_wav_path, feature_cache, metrics=None, float32_features=False):
+    """
+    Same as synthesize(), but takes MFCC frames of every fragment from `feature_cache`
+    and synthesizes only the missing fragments.
+    The MFCC sequence of the text is a concatenation of fragments' sequences.
+    """
+    from aeneas.runtimeconfiguration import RuntimeConfiguration
+    from aeneas.textfile import TextFile
+
+    if not textfile.fragments:
+        return synthesize(textfile, text_wav_path, metrics, float32_features)
+
+    synthesizer = get_synthesizer()
+    synthesizer_parameters = {
+        **get_mfcc_parameters(synthesizer.rconf, float32_features),
+        **{key: str(synthesizer.rconf[key]) for key in [RuntimeConfiguration.TTS, RuntimeConfiguration.TTS_PATH]},
+    }
+    fragments = textfile.fragments
+    cache_keys = [
+        get_cache_key('fragment_mfcc', f.filtered_text, f.language, synthesizer_parameters)
+        for f in fragments
+    ]
+    fragment_sequences = [feature_cache.get(key) for key in cache_keys]
+
+    missing = [i for i, sequence in enumerate(fragment_sequences) if sequence is None]
+    if missing:
+        missing_textfile = TextFile()
+        for i in missing:
+            missing_textfile.add_fragment(fragments[i])
+        _, anchors, text_mfcc_sequence = synthesize(missing_textfile, text_wav_path, metrics, float32_features)
+        bounds = np.append(anchors, len(text_mfcc_sequence))
+        for k, i in enumerate(missing):
+            fragment_sequences[i] = text_mfcc_sequence[bounds[k]:bounds[k+1]]
+            feature_cache.put(cache_keys[i], fragment_sequences[i])
+
+    anchors = np.cumsum([0] + [len(sequence) for sequence in fragment_sequences[:-1]])
+    text_mfcc_sequence = np.concatenate(fragment_sequences)
+
+    return [f.identifier for f in fragments], anchors, text_mfcc_sequence
+
+
+def synthesize(textfile, text_wav_path, metrics=None, float32_features=False):
+    """
+    Synthesizes `textfile` to `text_wav_path`.
+    Returns a list of fragment ids, an array of anchors as frames indices
+    and a sequence of MFCC frames of synthesized audio, float32 if `float32_features` is True.
+    """
+    from aeneas.audiofilemfcc import AudioFileMFCC
+    from aeneas.exacttiming import TimeValue
+
+    file_name = get_name_from_path(text_wav_path)
+
+    # Produce synthesized audio, get anchors
+    with measure(metrics, 'synthesis', file=file_name):
+        with _synthesizer_lock:
+            anchors,_,_ = get_synthesizer().synthesize(textfile, text_wav_path)
+
+    # Get fragments, convert anchors timings to the frames indicies
+    fragments = [a[1] for a in anchors]
+    anchors = np.array([int(a[0] / TimeValue('0.040')) for a in anchors])
+
+    # MFCC frames sequence is a n x (l+1) 2D array,
+    # where n - number of frames and l - number of MFFCs.
+    # The first coefficient is the energy. It is used to detect speech and dropped for the alignment.
+    # The sequence is a transposed view of the (l+1) x n array,
+    # c_FastDTWBD() accepts strided arrays, so no copy is made.
+    # A float32 copy keeps the layout.
+    with measure(metrics, 'text_mfcc', file=file_name):
+        text_mfcc_sequence = AudioFileMFCC(text_wav_path).all_mfcc.T
+        if float32_features:
+            text_mfcc_sequence = text_mfcc_sequence.astype(np.float32)
+
+    return fragments, anchors, text_mfcc_sequence
+
+
+def prepare_audio(audio_path, feature_cache=None, metrics=None, float32_features=False):
+    """
+    Returns a sequence of MFCC frames of recorded audio.
+    The audio is decoded in memory, no intermediate WAV file is written.
+    If `feature_cache` is given, the sequence is taken from it or stored in it.
+    If `metrics` is given, decoding and MFCC extraction are measured.
+    If `float32_features` is True, MFCC frames are float32.
+    """
+    audio_name = get_name_from_path(audio_path)
+
+    if feature_cache is not None:
+        cache_key = get_audio_cache_key(audio_path, float32_features)
+        audio_mfcc_sequence = feature_cache.get(cache_key)
+        if audio_mfcc_sequence is not None:
+            return audio_mfcc_sequence
+
+    sample_rate = get_sample_rate()
+    with measure(metrics, 'audio_decoding', file=audio_name):
+        samples = decode_audio(audio_path, sample_rate)
+
+    with measure(metrics, 'audio_mfcc', file=audio_name):
+        audio_mfcc_sequence = get_audio_mfcc(samples, sample_rate, float32_features)
+
+    if feature_cache is not None:
+        feature_cache.put(cache_key, audio_mfcc_sequence)
+
+    return audio_mfcc_sequence
+
+
+AUDIO_CHUNK_LENGTH = 2 ** 20
+
+
+def get_audio_mfcc(samples, sample_rate, float32_features=False):
+    """
+    Returns a sequence of MFCC frames of mono int16 samples returned by decode_audio(),
+    float32 if `float32_features` is True.
+    Samples are converted to float64 by chunks of `AUDIO_CHUNK_LENGTH`,
+    so only the aeneas audio file holds them as float64.
+    """
+    from aeneas.audiofile import AudioFile
+    from aeneas.audiofilemfcc import AudioFileMFCC
+    from aeneas.runtimeconfiguration import RuntimeConfiguration
+
+    rconf = RuntimeConfiguration()
+    audio_file = AudioFile(rconf=rconf)
+    audio_file.audio_format = 'pcm16'
+    audio_file.audio_channels = 1
+    audio_file.audio_sample_rate = sample_rate
+    # add_samples() allocates twice the memory it needs unless it is preallocated
+    audio_file.preallocate_memory(len(samples))
+    for start in range(0, len(samples), AUDIO_CHUNK_LENGTH):
+        audio_file.add_samples(samples[start:start + AUDIO_CHUNK_LENGTH] / 32768)
+    audio_mfcc_sequence = AudioFileMFCC(audio_file=audio_file, rconf=rconf).all_mfcc.T
+    if float32_features:
+        audio_mfcc_sequence = audio_mfcc_sequence.astype(np.float32)
+    return audio_mfcc_sequence
+
+
+def get_audio_cache_key(audio_path, float32_features=False):
+    """
+    Returns the feature cache key of MFCCs of the audio file.
+    """
+    from aeneas.runtimeconfiguration import RuntimeConfiguration
+
+    return get_cache_key(
+        'audio_mfcc', hash_file(audio_path), get_mfcc_parameters(RuntimeConfiguration(), float32_features)
+    )
+
+
+def get_sample_rate():
+    """
+    Returns the sample rate audio is decoded at.
+    """
+    from aeneas.runtimeconfiguration import RuntimeConfiguration
+
+    return RuntimeConfiguration()[RuntimeConfiguration.FFMPEG_SAMPLE_RATE]
+
+
+def get_mfcc_parameters(rconf, float32_features=False):
+    """
+    Returns parameters of `rconf` that affect MFCC extraction.
+    float32 MFCCs are cached apart from float64 ones, so the dtype is a parameter too.
+    """
+    from aeneas.runtimeconfiguration import RuntimeConfiguration
+
+    keys = [
+        RuntimeConfiguration.FFMPEG_SAMPLE_RATE,
+        RuntimeConfiguration.MFCC_FILTERS,
+        RuntimeConfiguration.MFCC_SIZE,
+        RuntimeConfiguration.MFCC_FFT_ORDER,
+        RuntimeConfiguration.MFCC_LOWER_FREQUENCY,
+        RuntimeConfiguration.MFCC_UPPER_FREQUENCY,
+        RuntimeConfiguration.MFCC_EMPHASIS_FACTOR,
+        RuntimeConfiguration.MFCC_WINDOW_LENGTH,
+        RuntimeConfiguration.MFCC_WINDOW_SHIFT,
+    ]
+    parameters = {key: str(rconf[key]) for key in keys}
+    if float32_features:
+        parameters['dtype'] = 'float32'
+    return parameters
+
+
+def decode_audio(audio_path, sample_rate):
+    """
+    Decodes audio file to mono 16-bit PCM at `sample_rate` using ffmpeg.
+    ffmpeg writes raw samples to a pipe.
+    Returns samples as an int16 array that shares memory with the output of ffmpeg.
+    """
+    completed = subprocess.run(
+        get_decoding_command(audio_path, sample_rate),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return np.frombuffer(completed.stdout, dtype='<i2')
+
+
+def get_decoding_command(audio_path, sample_rate):
+    return [
+        'ffmpeg', '-nostdin', '-i', audio_path, '-vn',
+        '-ac', '1', '-ar', str(sample_rate), '-f', 's16le', 'pipe:1',
+    ]
+
+
+_synthesizer = None
+# The synthesizer is not thread-safe, so threads that share it synthesize one at a time
+_synthesizer_lock = threading.RLock()
+
+
+def get_synthesizer():
+    """
+    Returns a synthesizer shared by all calls in the current process.
+    Synthesis must hold `_synthesizer_lock`.
+    """
+    global _synthesizer
+    with _synthesizer_lock:
+        if _synthesizer is None:
+            from aeneas.synthesizer import Synthesizer
+            _synthesizer = Synthesizer()
+    return _synthesizer
+
+
+def prefetch_map(func, iterable, executor=None, prefetch=2):
+    """
+    Lazy equivalent of map(func, iterable).
+    If `executor` is given, results for up to `prefetch` items
+    following the last consumed one are computed ahead in the executor.
+    """
+    if executor is None:
+        yield from map(func, iterable)
+        return
+
+    futures = deque()
+    try:
+        for item in iterable:
+            futures.append(executor.submit(func, item))
+            if len(futures) > prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def add_stats(stats, **values):
+    """
+    Adds `values` to the values of the `stats` dict.
+    """
+    for name, value in values.items():
+        stats[name] = stats.get(name, 0) + value
+
+
+def make_tmp_dir(text_dir, output_dir=None, parent_dir=None):
+    """
+    Creates a directory for temporary files and returns its path.
+    It is created in `parent_dir`, or in `output_dir` if `parent_dir` is None,
+    or in the parent directory of `text_dir` if both are None.
+    The name of the directory is unique, so concurrent calls never share temporary files.
+    """
+    if parent_dir is None:
+        if output_dir is not None:
+            parent_dir = output_dir
+        else:
+            parent_dir = os.path.dirname(os.path.dirname(os.path.join(text_dir, '')))
+
+    os.makedirs(parent_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix='tmp-', dir=parent_dir)
+
+
+def get_paths(dir_path):
+    """
+    Returns sorted paths of files in the directory, hidden files excluded.
+    """
+    return [os.path.join(dir_path, f) for f in sorted(os.listdir(dir_path)) if not f.startswith('.')]
 
 
 def get_name_from_path(path):
@@ -306,12 +1838,37 @@ def timedelta_to_str(tdelta):
     return f'{hours:d}:{minutes:0>2d}:{seconds:0>2d}.{ms:0>3d}'
 
 
+_smil_template = None
+
+
+def get_smil_template():
+    """
+    Returns the SMIL template compiled once per process.
+    """
+    global _smil_template
+    if _smil_template is None:
+        import jinja2
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, 'templates/')),
+            autoescape=True
+        )
+        _smil_template = env.get_template('template.smil')
+    return _smil_template
+
+
+def output_sync_map(sync_map, output_dir, output_format):
+    if output_format == 'smil':
+        output_smil(sync_map, output_dir)
+    elif output_format == 'json':
+        output_json(sync_map, output_dir)
+
+
 def output_smil(sync_map, output_dir):
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(os.path.join(BASE_DIR, 'templates/')),
-        autoescape=True
-    )
-    template = env.get_template('template.smil')
+    if isinstance(sync_map, SyncMap):
+        sync_map.write_smil(output_dir)
+        return
+
+    template = get_smil_template()
 
     for text_path, fragments in sync_map.items():
         parallels = []
@@ -340,14 +1897,11 @@ def output_smil(sync_map, output_dir):
             f.write(smil)
 
 
-def get_number_of_digits_to_name(num):
-    if num <= 0:
-        return 0
-
-    return math.floor(math.log10(num)) + 1
-
-
 def output_json(sync_map, output_dir):
+    if isinstance(sync_map, SyncMap):
+        sync_map.write_json(output_dir)
+        return
+
     for text_path, fragments in sync_map.items():
         text_name = get_name_from_path(text_path)
         file_path = os.path.join(output_dir, f'{drop_extension(text_name)}.json')
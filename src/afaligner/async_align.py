@@ -0,0 +1,228 @@
+"""
+Alignment for asyncio applications.
+
+Usage:
+
+    from afaligner.async_align import align_async
+
+    sync_map = await align_async('book/text/', 'book/audio/', output_dir='book/smil/')
+"""
+import asyncio
+import concurrent.futures
+import shutil
+import subprocess
+
+import numpy as np
+
+from afaligner import (
+    FeatureCache, build_sync_map, get_audio_cache_key, get_audio_mfcc, get_build_parameters,
+    get_decoding_command, get_paths, get_sample_rate, make_tmp_dir,
+    output_sync_map, prepare_text,
+)
+
+
+async def align_async(
+    text_dir, audio_dir, output_dir=None, output_format='smil',
+    sync_map_text_path_prefix='', sync_map_audio_path_prefix='',
+    skip_penalty=None, radius=None, dtw_threads=1, global_alignment=False, coarse_factor=1, vad=False,
+    segment_length=None, executor=None, concurrency=2,
+    feature_cache_dir=None, feature_cache_max_bytes=None,
+    times_as_timedelta=False, language=None, tmp_dir=None, columnar=False, float32_features=False,
+):
+    """
+    Same as align(), but does not block the event loop, so that many calls can run in one loop.
+
+    Audio files are decoded by ffmpeg processes run by asyncio.
+    Synthesis, MFCC extraction, alignment and writing the output are run in `executor`,
+    any concurrent.futures.Executor. If None, the default executor of the event loop is used.
+    Up to `concurrency` text and audio files of the call are prepared at once.
+    Synthesis is not thread-safe, so with a thread executor text files are synthesized one at a time.
+
+    If the call is cancelled, ffmpeg processes are killed, the work that has not started
+    in `executor` is cancelled, and the temporary directory is removed. A file that is being
+    synthesized or aligned in `executor` cannot be interrupted, so the call waits for it first.
+
+    Other parameters are the same as for align(), except that `preprocessing_workers` and `prefetch`
+    are replaced by `executor` and `concurrency`. Metrics and incremental alignment are not supported.
+    """
+    calls = ExecutorCalls(executor)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    feature_cache = None
+    if feature_cache_dir is not None:
+        feature_cache = FeatureCache(feature_cache_dir, max_bytes=feature_cache_max_bytes)
+
+    # Getting the parameters imports aeneas, and listing and creating directories may block too
+    build_parameters = await calls.run(
+        get_build_parameters,
+        sync_map_text_path_prefix, sync_map_audio_path_prefix,
+        skip_penalty, radius, dtw_threads, global_alignment, coarse_factor, vad,
+        segment_length, times_as_timedelta, language, None,
+        float32_features=float32_features,
+    )
+
+    text_paths = await calls.run(get_paths, text_dir)
+    audio_paths = await calls.run(get_paths, audio_dir)
+
+    tmp_dir = await make_tmp_dir_async(text_dir, output_dir, tmp_dir, calls)
+    try:
+        prepared_texts, prepared_audios = await gather_or_cancel(
+            gather_or_cancel(*(
+                prepare_text_async(
+                    path, tmp_dir, build_parameters['language'], calls, semaphore, feature_cache, float32_features,
+                )
+                for path in text_paths
+            )),
+            gather_or_cancel(*(
+                prepare_audio_async(path, calls, semaphore, feature_cache, float32_features)
+                for path in audio_paths
+            )),
+        )
+
+        sync_map = await calls.run(
+            build_sync_map, text_paths, audio_paths, tmp_dir,
+            prepared_texts=prepared_texts, prepared_audios=prepared_audios,
+            **build_parameters,
+        )
+
+        if output_dir is not None:
+            await calls.run(output_sync_map, sync_map, output_dir, output_format)
+    finally:
+        try:
+            await calls.cancel()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return sync_map if columnar else sync_map.to_dict()
+
+
+async def make_tmp_dir_async(text_dir, output_dir, parent_dir, calls):
+    """
+    Runs make_tmp_dir() in the executor of `calls`.
+    If cancelled, waits for the directory to be created and removes it.
+    """
+    future = asyncio.ensure_future(calls.run(make_tmp_dir, text_dir, output_dir, parent_dir))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        try:
+            shutil.rmtree(await future, ignore_errors=True)
+        except Exception:
+            pass
+        raise
+
+
+async def prepare_text_async(
+    text_path, tmp_dir, language, calls, semaphore, feature_cache=None, float32_features=False,
+):
+    """
+    Runs prepare_text() in the executor of `calls`.
+    """
+    async with semaphore:
+        return await calls.run(
+            prepare_text, text_path, tmp_dir, language, feature_cache, float32_features=float32_features,
+        )
+
+
+async def prepare_audio_async(audio_path, calls, semaphore, feature_cache=None, float32_features=False):
+    """
+    Same as prepare_audio(), but decodes audio by decode_audio_async()
+    and extracts MFCCs in the executor of `calls`.
+    """
+    async with semaphore:
+        if feature_cache is not None:
+            cache_key = await calls.run(get_audio_cache_key, audio_path, float32_features)
+            audio_mfcc_sequence = await calls.run(feature_cache.get, cache_key)
+            if audio_mfcc_sequence is not None:
+                return audio_mfcc_sequence
+
+        sample_rate = await calls.run(get_sample_rate)
+        samples = await decode_audio_async(audio_path, sample_rate)
+        audio_mfcc_sequence = await calls.run(get_audio_mfcc, samples, sample_rate, float32_features)
+
+        if feature_cache is not None:
+            await calls.run(feature_cache.put, cache_key, audio_mfcc_sequence)
+
+        return audio_mfcc_sequence
+
+
+async def decode_audio_async(audio_path, sample_rate):
+    """
+    Same as decode_audio(), but runs ffmpeg by asyncio.
+    If cancelled, kills ffmpeg.
+    """
+    command = get_decoding_command(audio_path, sample_rate)
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+    try:
+        stdout, _ = await process.communicate()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    return np.frombuffer(stdout, dtype='<i2')
+
+
+async def gather_or_cancel(*aws):
+    """
+    Same as asyncio.gather(), but if one of `aws` fails or the gathering is cancelled,
+    cancels the others and waits for them to finish.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class ExecutorCalls:
+    """
+    Runs functions in an executor and keeps track of the calls,
+    so that they can be cancelled and waited for.
+
+    `executor` – concurrent.futures.Executor. If None, the default executor of the event loop is used.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.futures = set()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Returns func(*args, **kwargs) called in the executor.
+        """
+        if self.executor is not None:
+            future = self.executor.submit(func, *args, **kwargs)
+        else:
+            future = concurrent.futures.Future()
+
+            def call():
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            asyncio.get_running_loop().run_in_executor(None, call)
+
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return await asyncio.wrap_future(future)
+
+    async def cancel(self):
+        """
+        Cancels the calls that have not started and waits for the running ones.
+        """
+        futures = list(self.futures)
+        for future in futures:
+            future.cancel()
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
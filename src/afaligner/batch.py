@@ -0,0 +1,277 @@
+"""
+Aligns many books in parallel.
+
+Usage:
+
+    python -m afaligner.batch manifest.json --workers 4 --timeout 3600 --summary summary.json
+
+The manifest is a JSON list of jobs, each a dict of align() parameters
+with at least 'text_dir', 'audio_dir' and 'output_dir', e.g.
+[{"text_dir": "book1/text", "audio_dir": "book1/audio", "output_dir": "book1/smil"}, ...]
+
+Every job runs in its own process group, so that it can be killed with the processes it has started.
+Process groups exist only on POSIX systems, so batches cannot be run on Windows.
+"""
+import argparse
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+
+# Written to the output directory of a job when it completes
+COMPLETION_MARKER = '.afaligner-complete'
+
+
+def read_manifest(manifest_path):
+    """
+    Returns the list of jobs from a JSON manifest.
+    """
+    with open(manifest_path) as f:
+        jobs = json.load(f)
+
+    output_dirs = set()
+    for job in jobs:
+        missing = {'text_dir', 'audio_dir', 'output_dir'} - set(job)
+        if missing:
+            raise ValueError(f'Job {job} lacks {sorted(missing)}.')
+        if 'tmp_dir' in job:
+            raise ValueError(f'Job {job} sets tmp_dir. Use scratch_dir instead.')
+        # Jobs with the same output directory would overwrite each other's output and completion marker
+        output_dir = os.path.realpath(job['output_dir'])
+        if output_dir in output_dirs:
+            raise ValueError(f'Job {job} has the output directory of another job.')
+        output_dirs.add(output_dir)
+
+    return jobs
+
+
+def is_completed(job):
+    return os.path.exists(os.path.join(job['output_dir'], COMPLETION_MARKER))
+
+
+def run_batch(jobs, workers=None, timeout=None, resume=True, scratch_dir=None, **align_kwargs):
+    """
+    Runs align() for every job in a separate process, up to `workers` processes at a time.
+    Only POSIX systems are supported.
+
+    `jobs` – list of dicts of align() parameters with at least
+    'text_dir', 'audio_dir' and 'output_dir'. Output directories must differ.
+
+    `workers` – number of jobs to run at once. If None, the number of CPUs is used.
+
+    `timeout` – maximum time of a job in seconds. A job that runs longer is killed
+    together with the processes it has started, e.g. ffmpeg and the synthesizer.
+    If None, jobs are not limited.
+
+    `resume` – if True, jobs completed by a previous run are skipped.
+    A job is completed when align() has aligned all its text files and written the output.
+
+    `scratch_dir` – directory to create jobs' directories for temporary files in.
+    Every job gets its own directory that is removed when the job ends, even if the job is killed.
+    If None, the system temporary directory is used.
+
+    `align_kwargs` – align() parameters common to all jobs. Parameters of a job take precedence.
+
+    Returns a summary of the form: {
+        'jobs': [{
+            'text_dir': ..., 'audio_dir': ..., 'output_dir': ...,
+            'status': 'completed' | 'skipped' | 'failed' | 'timed_out',
+            'time': 12.3,
+            'error': None | 'Traceback ...',
+        }, ...],
+        'completed': 3, 'skipped': 1, 'failed': 0, 'timed_out': 0,
+        'time': 45.6,
+    }
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    batch_start = time.monotonic()
+    results = [None] * len(jobs)
+    pending = []
+    for k, job in enumerate(jobs):
+        if resume and is_completed(job):
+            results[k] = make_job_result(job, 'skipped')
+        else:
+            pending.append(k)
+    pending.reverse()
+
+    context = multiprocessing.get_context('spawn')
+    running = {}    # process sentinel -> (job index, process, connection, scratch directory, start time)
+    messages = {}   # process sentinel -> (status, error) received from the job, or None if it sent nothing
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                k = pending.pop()
+                job = {**align_kwargs, **jobs[k]}
+                job_scratch_dir = tempfile.mkdtemp(prefix='afaligner-job-', dir=scratch_dir)
+                receiver, sender = context.Pipe(duplex=False)
+                # Not a daemon, so that the job can start the preprocessing processes of align()
+                process = context.Process(target=run_job, args=(job, job_scratch_dir, sender))
+                process.start()
+                sender.close()
+                running[process.sentinel] = (k, process, receiver, job_scratch_dir, time.monotonic())
+
+            wait_timeout = None
+            if timeout is not None:
+                now = time.monotonic()
+                wait_timeout = max(min(start + timeout for _, _, _, _, start in running.values()) - now, 0)
+
+            # A job's message is received as soon as it is sent, because a job that sends
+            # a message larger than the pipe buffer cannot exit before it is received
+            receivers = {running[sentinel][2]: sentinel for sentinel in running if sentinel not in messages}
+            ready = wait(list(running) + list(receivers), timeout=wait_timeout)
+            for receiver, sentinel in receivers.items():
+                if receiver in ready or (sentinel in ready and receiver.poll()):
+                    messages[sentinel] = receive_message(receiver)
+
+            for sentinel in list(running):
+                k, process, receiver, job_scratch_dir, start = running[sentinel]
+                elapsed = time.monotonic() - start
+                if sentinel in ready:
+                    status, error = 'failed', f'Process exited with code {process.exitcode}.'
+                    if messages.get(sentinel) is not None:
+                        status, error = messages[sentinel]
+                elif timeout is not None and elapsed >= timeout:
+                    kill_process_group(process)
+                    status, error = 'timed_out', f'Killed after {timeout} s.'
+                else:
+                    continue
+
+                process.join()
+                receiver.close()
+                shutil.rmtree(job_scratch_dir, ignore_errors=True)
+                del running[sentinel]
+                messages.pop(sentinel, None)
+                results[k] = make_job_result(jobs[k], status, elapsed, error)
+    finally:
+        for k, process, receiver, job_scratch_dir, _ in running.values():
+            kill_process_group(process)
+            process.join()
+            receiver.close()
+            shutil.rmtree(job_scratch_dir, ignore_errors=True)
+
+    summary = {'jobs': results}
+    for status in ['completed', 'skipped', 'failed', 'timed_out']:
+        summary[status] = sum(result['status'] == status for result in results)
+    summary['time'] = time.monotonic() - batch_start
+
+    return summary
+
+
+def run_job(job, scratch_dir, connection):
+    """
+    Runs align() for `job` in a worker process and sends (status, error) to `connection`.
+    The job fails if the alignment is terminated before all text files are aligned.
+    The process starts a new process group, so that it can be killed together with its children.
+    """
+    os.setpgrp()
+    from afaligner import align, get_paths
+
+    job = dict(job)
+    output_dir = job['output_dir']
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        marker_path = os.path.join(output_dir, COMPLETION_MARKER)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        sync_map = align(tmp_dir=scratch_dir, **job)
+        text_files_count = len(get_paths(job['text_dir']))
+        if len(sync_map) < text_files_count:
+            connection.send(('failed', f'Only {len(sync_map)} of {text_files_count} text files are aligned.'))
+            return
+        with open(marker_path, 'w') as f:
+            json.dump({key: str(value) for key, value in job.items()}, f)
+    except Exception:
+        connection.send(('failed', traceback.format_exc()))
+    else:
+        connection.send(('completed', None))
+    finally:
+        connection.close()
+
+
+def receive_message(connection):
+    """
+    Returns the message sent by run_job() or None if the job closed `connection` without sending it.
+    """
+    try:
+        return connection.recv()
+    except EOFError:
+        return None
+
+
+def kill_process_group(process):
+    """
+    Kills the process and all processes of its group.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def make_job_result(job, status, time=0.0, error=None):
+    return {
+        'text_dir': job['text_dir'],
+        'audio_dir': job['audio_dir'],
+        'output_dir': job['output_dir'],
+        'status': status,
+        'time': time,
+        'error': error,
+    }
+
+
+def print_summary(summary):
+    for result in summary['jobs']:
+        print(f"{result['status']:<10} {result['time']:>9.1f} s  {result['output_dir']}")
+        if result['error']:
+            print(result['error'])
+    print(
+        f"Completed: {summary['completed']}, skipped: {summary['skipped']}, "
+        f"failed: {summary['failed']}, timed out: {summary['timed_out']}, "
+        f"total time: {summary['time']:.1f} s"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aligns many books in parallel. Runs only on POSIX systems.')
+    parser.add_argument('manifest', help='JSON list of jobs, each a dict of align() parameters')
+    parser.add_argument('--workers', type=int, help='number of jobs to run at once, defaults to the number of CPUs')
+    parser.add_argument('--timeout', type=float, help='maximum time of a job in seconds')
+    parser.add_argument('--no-resume', action='store_true', help='rerun jobs completed by a previous run')
+    parser.add_argument('--scratch-dir', help='directory for temporary files of the jobs')
+    parser.add_argument('--output-format', choices=['smil', 'json'], help='output format of all jobs')
+    parser.add_argument('--summary', help='path to write the JSON summary to')
+    args = parser.parse_args(argv)
+
+    align_kwargs = {}
+    if args.output_format is not None:
+        align_kwargs['output_format'] = args.output_format
+
+    summary = run_batch(
+        read_manifest(args.manifest),
+        workers=args.workers,
+        timeout=args.timeout,
+        resume=not args.no_resume,
+        scratch_dir=args.scratch_dir,
+        **align_kwargs,
+    )
+
+    print_summary(summary)
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    return 0 if summary['failed'] == 0 and summary['timed_out'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import ctypes
+import itertools
 import os.path
 
 import numpy as np
@@ -10,37 +11,181 @@ class FastDTWBDError(Exception):
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Must match DTWBD_MAX_LEVELS in dtwbd.c
+DTWBD_MAX_LEVELS = 32
 
-def c_FastDTWBD(s, t, skip_penalty, radius):
+# Suffixes of the C functions and C types for the supported dtypes of MFCCs
+FEATURE_TYPES = {
+    np.dtype(np.float64): ('', ctypes.c_double),
+    np.dtype(np.float32): ('_float', ctypes.c_float),
+}
+
+
+class FastDTWBDTask(ctypes.Structure):
+    _fields_ = [
+        ('s', ctypes.c_void_p),
+        ('t', ctypes.c_void_p),
+        ('n', ctypes.c_size_t),
+        ('m', ctypes.c_size_t),
+        ('s_strides', ctypes.c_ssize_t * 2),
+        ('t_strides', ctypes.c_ssize_t * 2),
+        ('path_buffer', ctypes.POINTER(ctypes.c_size_t)),
+        ('path_distance', ctypes.c_double),
+        ('path_len', ctypes.c_ssize_t),
+    ]
+
+
+class DTWBDStats(ctypes.Structure):
+    _fields_ = [
+        ('cells', ctypes.c_size_t),
+        ('pruned_cells', ctypes.c_size_t),
+        ('peak_bytes', ctypes.c_size_t),
+        ('level', ctypes.c_size_t),
+        ('level_cells', ctypes.c_size_t * DTWBD_MAX_LEVELS),
+    ]
+
+
+_c_module = None
+
+
+def get_c_module():
     """
-    Wrapper for FastDTWDB C implementation.
+    Loads the C library and declares its functions once per process.
     """
+    global _c_module
+    if _c_module is not None:
+        return _c_module
+
     c_module = ctypes.cdll[os.path.join(BASE_DIR, 'c_modules/dtwbd.so')]
-    c_module.FastDTWBD.argtypes = (
-        ctypes.POINTER(ctypes.c_double),
-        ctypes.POINTER(ctypes.c_double),
-        ctypes.c_size_t,
-        ctypes.c_size_t,
-        ctypes.c_size_t,
-        ctypes.c_double,
-        ctypes.c_int,
-        ctypes.POINTER(ctypes.c_double),
-        ctypes.POINTER(ctypes.c_size_t),
-    )
-    c_module.FastDTWBD.restype = ctypes.c_ssize_t
-    
+    for suffix, c_type in FEATURE_TYPES.values():
+        fast_dtwbd = getattr(c_module, 'FastDTWBD' + suffix)
+        fast_dtwbd.argtypes = (
+            ctypes.POINTER(c_type),
+            ctypes.POINTER(c_type),
+            ctypes.c_size_t,
+            ctypes.c_size_t,
+            ctypes.c_size_t,
+            ctypes.POINTER(ctypes.c_ssize_t),
+            ctypes.POINTER(ctypes.c_ssize_t),
+            ctypes.c_double,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.POINTER(DTWBDStats),
+            ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_size_t),
+        )
+        fast_dtwbd.restype = ctypes.c_ssize_t
+        fast_dtwbd_batch = getattr(c_module, 'FastDTWBD_batch' + suffix)
+        fast_dtwbd_batch.argtypes = (
+            ctypes.POINTER(FastDTWBDTask),
+            ctypes.c_size_t,
+            ctypes.c_size_t,
+            ctypes.c_double,
+            ctypes.c_int,
+            ctypes.c_int,
+        )
+        fast_dtwbd_batch.restype = ctypes.c_int
+    c_module.create_DTWBD_workspace.argtypes = (ctypes.c_size_t,)
+    c_module.create_DTWBD_workspace.restype = ctypes.c_void_p
+    c_module.free_DTWBD_workspace.argtypes = (ctypes.c_void_p,)
+    c_module.free_DTWBD_workspace.restype = None
+    c_module.get_DTWBD_workspace_size.argtypes = (ctypes.c_void_p,)
+    c_module.get_DTWBD_workspace_size.restype = ctypes.c_size_t
+    _c_module = c_module
+    return c_module
+
+
+class DTWBDWorkspace:
+    """
+    Memory that c_FastDTWBD() takes its buffers from.
+
+    Passing the same workspace to consecutive calls saves allocating the buffers
+    on every call. The workspace grows to fit the largest inputs it has been used with.
+    `size` – initial size in bytes.
+
+    A workspace must not be used by several threads at the same time.
+    """
+
+    def __init__(self, size=0):
+        self._c_module = get_c_module()
+        self._handle = self._c_module.create_DTWBD_workspace(size)
+        if not self._handle:
+            raise MemoryError('Cannot allocate FastDTWBD workspace.')
+
+    @property
+    def size(self):
+        """
+        Current size of the workspace in bytes.
+        """
+        return self._c_module.get_DTWBD_workspace_size(self._handle)
+
+    def close(self):
+        if self._handle:
+            self._c_module.free_DTWBD_workspace(self._handle)
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def c_FastDTWBD(s, t, skip_penalty, radius, threads=1, workspace=None, stats=None):
+    """
+    Wrapper for FastDTWDB C implementation.
+
+    `s` and `t` may be any 2D float64 or float32 arrays, e.g. transposed or sliced views.
+    They are passed to the C code without copying.
+    If both are float32, the float variant of the C code is used,
+    which reads half the memory. Path distances are computed in doubles anyway.
+    Otherwise, the sequences are converted to float64.
+
+    `threads` – number of threads to fill the cost matrix with.
+    The resulting path does not depend on it.
+
+    `workspace` – DTWBDWorkspace to take the buffers from.
+    If None, the buffers are allocated for this call only.
+
+    `stats` – if a dict is given, the counters of the work done are added to its values:
+    'cells' – number of cells of the cost matrices inside the windows,
+    'pruned_cells' – number of those cells skipped since they cannot be on the warping path,
+    'level_cells' – list of the numbers of cells at every FastDTWBD level,
+    the first one for the original sequences, the next one for the sequences coarsened twice, etc.
+    'peak_bytes' is set to the maximum number of workspace bytes in use if it is larger.
+    The counters may vary with `threads`.
+
+    The GIL is released while the C code runs,
+    so calls from different Python threads run in parallel.
+    """
+    c_module = get_c_module()
+
+    dtype = get_features_dtype([s, t])
+    suffix, c_type = FEATURE_TYPES[dtype]
+    s, s_strides = get_strided_sequence(s, dtype)
+    t, t_strides = get_strided_sequence(t, dtype)
     n, l = s.shape
     m, _ = t.shape
     path_distance = ctypes.c_double()
     path_buffer = np.empty((n+m, 2), dtype='uintp')
-    path_len = c_module.FastDTWBD(
-        s.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
-        t.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+    c_stats = DTWBDStats()
+    path_len = getattr(c_module, 'FastDTWBD' + suffix)(
+        s.ctypes.data_as(ctypes.POINTER(c_type)),
+        t.ctypes.data_as(ctypes.POINTER(c_type)),
         ctypes.c_size_t(n),
         ctypes.c_size_t(m),
         ctypes.c_size_t(l),
+        s_strides,
+        t_strides,
         ctypes.c_double(skip_penalty),
         radius,
+        threads,
+        workspace._handle if workspace is not None else None,
+        ctypes.byref(c_stats),
         ctypes.byref(path_distance),
         path_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_size_t))
     )
@@ -51,4 +196,99 @@ def c_FastDTWBD(s, t, skip_penalty, radius):
             'See stderr for more details.'
         )
 
-    return path_distance.value, path_buffer[:path_len]
\ No newline at end of file
+    if stats is not None:
+        stats['cells'] = stats.get('cells', 0) + c_stats.cells
+        stats['pruned_cells'] = stats.get('pruned_cells', 0) + c_stats.pruned_cells
+        stats['peak_bytes'] = max(stats.get('peak_bytes', 0), c_stats.peak_bytes)
+        level_cells = list(c_stats.level_cells)
+        while level_cells and level_cells[-1] == 0:
+            level_cells.pop()
+        previous_level_cells = stats.get('level_cells', [])
+        stats['level_cells'] = [
+            a + b for a, b in itertools.zip_longest(previous_level_cells, level_cells, fillvalue=0)
+        ]
+
+    return path_distance.value, path_buffer[:path_len]
+
+
+def c_FastDTWBD_batch(pairs, skip_penalty, radius, threads=None):
+    """
+    Aligns every pair of sequences (s, t) from `pairs` with FastDTWBD.
+    Returns a list of (path_distance, path) in the order of `pairs`.
+
+    Pairs are distributed among `threads` native threads,
+    each pair is aligned by a single thread. Every thread reuses its own workspace.
+    If `threads` is None, the number of CPUs is used.
+
+    If all sequences are float32, the float variant of the C code is used, see c_FastDTWBD().
+    """
+    c_module = get_c_module()
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    dtype = get_features_dtype([sequence for pair in pairs for sequence in pair])
+    suffix, _ = FEATURE_TYPES[dtype]
+
+    # Keep references to the arrays while the C code uses them
+    arrays = []
+    tasks = (FastDTWBDTask * len(pairs))()
+    l = None
+
+    for task, (s, t) in zip(tasks, pairs):
+        s, s_strides = get_strided_sequence(s, dtype)
+        t, t_strides = get_strided_sequence(t, dtype)
+        n, s_l = s.shape
+        m, t_l = t.shape
+        if l is None:
+            l = s_l
+        if s_l != l or t_l != l:
+            raise ValueError('All sequences must have the same number of MFCCs per frame.')
+        path_buffer = np.empty((n+m, 2), dtype='uintp')
+        arrays.append((s, t, path_buffer))
+
+        task.s = s.ctypes.data
+        task.t = t.ctypes.data
+        task.n = n
+        task.m = m
+        task.s_strides[:] = s_strides[:]
+        task.t_strides[:] = t_strides[:]
+        task.path_buffer = path_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_size_t))
+
+    result = getattr(c_module, 'FastDTWBD_batch' + suffix)(
+        tasks, ctypes.c_size_t(len(pairs)), ctypes.c_size_t(l or 0),
+        ctypes.c_double(skip_penalty), radius, threads,
+    )
+
+    if result < 0:
+        raise FastDTWBDError(
+            'The FastDTWDB_batch() C function raised an error. '
+            'See stderr for more details.'
+        )
+
+    return [
+        (task.path_distance, path_buffer[:task.path_len])
+        for task, (_, _, path_buffer) in zip(tasks, arrays)
+    ]
+
+
+def get_features_dtype(sequences):
+    """
+    Returns float32 if all `sequences` are float32 arrays and float64 otherwise.
+    """
+    if sequences and all(getattr(sequence, 'dtype', None) == np.float32 for sequence in sequences):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def get_strided_sequence(sequence, dtype=np.float64):
+    """
+    Returns 2D array of `dtype` with the same data and its strides in elements.
+    The data is copied only if it is not of `dtype` or its strides are not multiples of an element.
+    """
+    sequence = np.asarray(sequence, dtype=dtype)
+    itemsize = sequence.itemsize
+    if any(stride % itemsize for stride in sequence.strides):
+        sequence = np.ascontiguousarray(sequence)
+    strides = (ctypes.c_ssize_t * 2)(*(stride // itemsize for stride in sequence.strides))
+    return sequence, strides
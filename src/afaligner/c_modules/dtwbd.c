@@ -1,24 +1,172 @@
 #include <stdlib.h>
+#include <stddef.h>
 #include <math.h>
 #include <stdbool.h>
 #include <float.h>
 #include <stdio.h>
+#include <string.h>
 
 
 #if defined(_MSC_VER)
 #include <BaseTsd.h>
 typedef SSIZE_T ssize_t;
 
-__declspec(dllimport) size_t FastDTWBD();
-__declspec(dllimport) size_t DTWBD();
+// Functions called from Python are exported from the DLL
+#define DTWBD_EXPORT __declspec(dllexport)
+
+// MSVC has no POSIX threads. Threads cannot be created with these stand-ins,
+// so the calling thread does all the work, as when pthread_create() fails, and locks are not needed.
+typedef int pthread_t;
+typedef int pthread_mutex_t;
+typedef int pthread_cond_t;
+#define pthread_create(thread, attr, start_routine, arg) (-1)
+#define pthread_join(thread, retval) ((void)0)
+#define pthread_mutex_init(mutex, attr) ((void)0)
+#define pthread_mutex_destroy(mutex) ((void)0)
+#define pthread_mutex_lock(mutex) ((void)0)
+#define pthread_mutex_unlock(mutex) ((void)0)
+#define pthread_cond_init(cond, attr) ((void)0)
+#define pthread_cond_destroy(cond) ((void)0)
+#define pthread_cond_wait(cond, mutex) ((void)0)
+#define pthread_cond_broadcast(cond) ((void)0)
+#else
+#include <pthread.h>
+
+#define DTWBD_EXPORT
 #endif
 
 
+// Moves that lead to a cell of the D matrix.
+// Each move takes 2 bits, so four moves are packed into one byte.
+#define MOVE_START 0     // path starts at the cell
+#define MOVE_DIAGONAL 1  // from (i-1, j-1)
+#define MOVE_LEFT 2      // from (i, j-1)
+#define MOVE_UP 3        // from (i-1, j)
+
+
+// DTWBD processes the D matrix in strips of STRIP_HEIGHT rows.
+// Each strip is processed in blocks of BLOCK_WIDTH columns, and a block can be processed
+// as soon as the previous strip has processed the same columns,
+// so different strips can be processed by different threads at the same time.
+#define STRIP_HEIGHT 32
+#define BLOCK_WIDTH 32
+
+
+// Types of MFCCs of the sequences.
+// Floats take half the memory of doubles. Path distances are computed in doubles for both.
+#define FEATURES_DOUBLE 0
+#define FEATURES_FLOAT 1
+
+
+// Number of FastDTWBD() recursion levels DTWBD_stats counts cells of separately.
+#define DTWBD_MAX_LEVELS 32
+
+
+// Workspace allocations are aligned to the cache line size.
+#define WORKSPACE_ALIGNMENT 64
+
+
+// Memory that FastDTWBD() and DTWBD() take all their buffers from.
+// 
+// Buffers are allocated by bumping an offset in a single block and are freed
+// in the reverse order by restoring a previously saved state.
+// If the block is full, buffers are allocated with malloc().
+// When all buffers are freed, the block grows to fit everything allocated since the last growth,
+// so a workspace reused across calls quickly stops calling malloc().
+typedef struct {
+    unsigned char *block;
+    size_t size;
+    size_t used;
+    size_t peak;                // maximum number of bytes in use since the block last grew
+    void **overflow;            // buffers allocated with malloc() because the block was full
+    size_t overflow_count;
+    size_t overflow_capacity;
+    size_t overflow_bytes;
+} DTWBD_workspace;
+
+
 typedef struct {
-    double distance;
-    ssize_t prev_i;
-    ssize_t prev_j;
-} D_matrix_element;
+    size_t used;
+    size_t overflow_count;
+    size_t overflow_bytes;
+} DTWBD_workspace_state;
+
+
+// A pair of sequences to align by FastDTWBD_batch() and the results.
+// MFCCs are doubles for FastDTWBD_batch() and floats for FastDTWBD_batch_float().
+typedef struct {
+    void *s;
+    void *t;
+    size_t n;
+    size_t m;
+    ptrdiff_t s_strides[2];
+    ptrdiff_t t_strides[2];
+    size_t *path_buffer;
+    double path_distance;
+    ssize_t path_len;
+} FastDTWBD_task;
+
+
+typedef struct {
+    FastDTWBD_task *tasks;
+    size_t tasks_count;
+    int features_type;
+    size_t l;
+    double skip_penalty;
+    int radius;
+    size_t next_task;
+    pthread_mutex_t lock;
+} FastDTWBD_batch_context;
+
+
+typedef struct {
+    int features_type;
+    void *s;
+    ptrdiff_t s_strides[2];
+    void *t_transposed;
+    size_t n;
+    size_t m;
+    size_t l;
+    double skip_penalty;
+    size_t *window;
+    size_t *row_offsets;        // moves of row i occupy moves[row_offsets[i]/4:row_offsets[i+1]/4]
+    unsigned char *moves;
+    size_t strips_count;
+    size_t strip_len;           // maximum number of cells in a strip excluding its last row
+    double *last_rows;          // distances of the last row of every strip
+    size_t *last_row_offsets;   // last row of strip k occupies last_rows[last_row_offsets[k]:last_row_offsets[k+1]]
+    size_t *progress;           // strip k has processed all columns < progress[k]
+    size_t next_strip;
+    bool parallel;
+    pthread_mutex_t lock;
+    pthread_cond_t progress_changed;
+    double *min_path_distances; // best path distance found in every strip
+    size_t *end_cells;          // (i, j) of the best path end found in every strip
+    bool *matches;
+    double bound;               // the best path distance found so far in any strip
+    double end_skip;            // lower bound on the penalty for the frames skipped after any path
+    size_t *live_ranges;        // for every row [from, to) such that cells outside it are pruned
+} DTWBD_context;
+
+
+typedef struct {
+    DTWBD_context *context;
+    double *strip_rows;         // distances of the current strip rows except the last one
+    double *distances;          // local distances of a row within a block
+    size_t cells;               // number of cells processed
+    size_t pruned_cells;        // number of cells skipped without computing their local distance
+} DTWBD_worker;
+
+
+// Counters of the work done by FastDTWBD() or DTWBD().
+typedef struct {
+    size_t cells;           // number of cells inside the windows
+    size_t pruned_cells;    // number of cells skipped since they cannot be on the warping path
+    size_t peak_bytes;      // maximum number of workspace bytes in use
+    size_t level;           // recursion level of FastDTWBD() being counted, 0 for the original sequences
+    size_t level_cells[DTWBD_MAX_LEVELS];   // number of cells inside the windows at every level,
+                                            // the last one counts all deeper levels too
+} DTWBD_stats;
 
 
 // This is a fast version of DTWBD algorithm that finds an approximate warping path.
@@ -28,23 +176,79 @@ typedef struct {
 // Writes warping path to the `path_buffer`.
 // 
 // Linear both in time and space.
-ssize_t FastDTWBD(
-    double *s,  // first sequence of MFCC frames – n x l contiguous array
-    double *t,  // second sequence of MFCC frames – m x l contiguous array
+DTWBD_EXPORT ssize_t FastDTWBD(
+    double *s,  // first sequence of MFCC frames – n x l array
+    double *t,  // second sequence of MFCC frames – m x l array
     size_t n,   // number of frames in first sequence
     size_t m,   // number of frames in second sequence
     size_t l,   // number of MFCCs per frame
+    const ptrdiff_t *s_strides, // strides of frames and of MFCCs of `s` in elements, NULL if contiguous
+    const ptrdiff_t *t_strides, // same for `t`
     double skip_penalty,    // penalty for skipping one frame
     int radius,             // radius of path projection
+    int threads,            // number of threads to use
+    DTWBD_workspace *workspace, // workspace to allocate buffers from, NULL to use a temporary one
+    DTWBD_stats *stats,     // place to add the counters to, can be NULL
     double *path_distance,  // place to store warping path distance
     size_t *path_buffer     // buffer to store resulting warping path – (n+m) x 2 contiguous array
 );
 
 
-double *get_coarsed_sequence(double *s, size_t n, size_t l);
+// Same as FastDTWBD() for sequences of floats.
+DTWBD_EXPORT ssize_t FastDTWBD_float(
+    float *s, float *t, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, int radius, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+);
+
 
+// FastDTWBD() for sequences of MFCCs of `features_type`.
+ssize_t FastDTWBD_typed(
+    void *s, void *t, int features_type, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, int radius, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+);
+
+
+// Runs FastDTWBD() for every task using `threads` threads.
+// Tasks are independent, so every task is processed by a single thread.
+// 
+// Returns 0 if all tasks succeeded and -1 otherwise.
+// Writes results to the tasks. Negative `path_len` indicates an error.
+DTWBD_EXPORT int FastDTWBD_batch(
+    FastDTWBD_task *tasks,
+    size_t tasks_count,
+    size_t l,               // number of MFCCs per frame
+    double skip_penalty,    // penalty for skipping one frame
+    int radius,             // radius of path projection
+    int threads             // number of threads to use
+);
+
+
+// Same as FastDTWBD_batch() for sequences of floats.
+DTWBD_EXPORT int FastDTWBD_batch_float(
+    FastDTWBD_task *tasks, size_t tasks_count, size_t l,
+    double skip_penalty, int radius, int threads
+);
+
+
+int FastDTWBD_batch_typed(
+    FastDTWBD_task *tasks, size_t tasks_count, int features_type, size_t l,
+    double skip_penalty, int radius, int threads
+);
+
+
+void *run_FastDTWBD_batch_worker(void *arg);
+
+
+void *get_coarsed_sequence(
+    void *s, int features_type, size_t n, size_t l, const ptrdiff_t *strides, DTWBD_workspace *workspace
+);
 
-size_t *get_window(size_t n, size_t m, size_t *path_buffer, size_t path_len, int radius);
+
+size_t *get_window(size_t n, size_t m, size_t *path_buffer, size_t path_len, int radius, DTWBD_workspace *workspace);
 
 
 void update_window(size_t *window, size_t n, size_t m, ssize_t i, ssize_t j);
@@ -57,35 +261,142 @@ void update_window(size_t *window, size_t n, size_t m, ssize_t i, ssize_t j);
 // The algorithm is able to skip the first and the last few frames of both sequences
 // with the cost of `skip_penalty` for each skipped frame.
 // 
+// If `threads` > 1, strips of the D matrix are processed in parallel.
+// The result does not depend on the number of threads.
+// 
+// Cells whose distance, plus the penalty for the frames that any path skips in the end,
+// exceeds the best path distance found so far cannot be on the warping path.
+// Such cells are pruned, and the local distances are not computed for the cells
+// that can be reached only from the pruned ones. The path is the same as without pruning.
+// FastDTWBD() starts with the distance of the coarse path projected to the window.
+// 
 // Returns warping path length. Negative return value indicates an error.
 // Writes warping path distance to the `path_distance`.
 // Writes warping path to the `path_buffer`.
-ssize_t DTWBD(
-    double *s,  // first sequence of MFCC frames – n x l contiguous array
-    double *t,  // second sequence of MFCC frames – m x l contiguous array
+DTWBD_EXPORT ssize_t DTWBD(
+    double *s,  // first sequence of MFCC frames – n x l array
+    double *t,  // second sequence of MFCC frames – m x l array
     size_t n,   // number of frames in first sequence
     size_t m,   // number of frames in second sequence
     size_t l,   // number of MFCCs per frame
+    const ptrdiff_t *s_strides, // strides of frames and of MFCCs of `s` in elements, NULL if contiguous
+    const ptrdiff_t *t_strides, // same for `t`
     double skip_penalty,    // penalty for skipping one frame
     size_t *window,            // n x 2 contiguous array, for each frame i from first sequence
                             // windows[i] gives range [from, to) of frames from second sequence to evaluate
+    int threads,            // number of threads to use
+    DTWBD_workspace *workspace, // workspace to allocate buffers from, NULL to use a temporary one
+    DTWBD_stats *stats,     // place to add the counters to, can be NULL
     double *path_distance,  // place to store warping path distance
     size_t *path_buffer     // buffer to store resulting warping path – (n+m) x 2 contiguous array
 );
 
 
-double euclid_distance(double *x, double *y, size_t l);
+// Same as DTWBD() for sequences of floats.
+DTWBD_EXPORT ssize_t DTWBD_float(
+    float *s, float *t, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, size_t *window, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+);
+
+
+// DTWBD() for sequences of MFCCs of `features_type`.
+// If `coarse_path` is not NULL, its projection to the original sequences
+// must lie inside the window, and its distance is the initial bound for pruning.
+ssize_t DTWBD_typed(
+    void *s, void *t, int features_type, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, size_t *window, const size_t *coarse_path, size_t coarse_path_len, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+);
+
+
+void *get_transposed_sequence(
+    void *t, int features_type, size_t m, size_t l, const ptrdiff_t *strides, DTWBD_workspace *workspace
+);
+
+
+void get_local_distances(DTWBD_context *c, size_t i, size_t from, size_t to, double *distances);
+
+
+double get_projected_path_distance(DTWBD_context *c, const size_t *coarse_path, size_t coarse_path_len);
+
+
+double get_end_skip(size_t n, size_t m, size_t *window, double skip_penalty);
+
+
+void get_row_distances(
+    double *x, ptrdiff_t x_stride, double *t_transposed, size_t m, size_t l,
+    size_t from, size_t to, double *distances
+);
+
+
+void get_row_distances_float(
+    float *x, ptrdiff_t x_stride, float *t_transposed, size_t m, size_t l,
+    size_t from, size_t to, double *distances
+);
+
+
+void *run_DTWBD_worker(void *arg);
 
 
-double get_distance(D_matrix_element *D_matrix, size_t n, size_t m, size_t *window, size_t i, size_t j);
+void process_strip(DTWBD_worker *worker, size_t k);
 
 
-D_matrix_element get_best_candidate(D_matrix_element *candidates, size_t n);
+double *get_row(DTWBD_worker *worker, size_t k, size_t i);
+
+
+void wait_for_progress(DTWBD_context *context, size_t k, size_t column);
+
+
+void set_progress(DTWBD_context *context, size_t k, size_t column, double *bound);
+
+
+void get_row_window(size_t *window, size_t m, size_t i, size_t *from, size_t *to);
+
+
+size_t *get_row_offsets(size_t n, size_t m, size_t *window, DTWBD_workspace *workspace);
+
+
+double get_distance(double *row, size_t from, size_t to, size_t j);
+
+
+int get_best_move(double *candidates, size_t n);
+
+
+void set_move(unsigned char *moves, size_t k, int move);
+
+
+int get_move(unsigned char *moves, size_t k);
 
 
 void reverse_path(size_t *path, ssize_t path_len);
 
 
+// Creates a workspace with a block of `size` bytes. Returns NULL if allocation fails.
+DTWBD_EXPORT DTWBD_workspace *create_DTWBD_workspace(size_t size);
+
+
+DTWBD_EXPORT void free_DTWBD_workspace(DTWBD_workspace *workspace);
+
+
+// Returns the size of the workspace block in bytes.
+DTWBD_EXPORT size_t get_DTWBD_workspace_size(DTWBD_workspace *workspace);
+
+
+void *workspace_alloc(DTWBD_workspace *workspace, size_t size);
+
+
+void *workspace_calloc(DTWBD_workspace *workspace, size_t count, size_t size);
+
+
+DTWBD_workspace_state get_workspace_state(DTWBD_workspace *workspace);
+
+
+void restore_workspace_state(DTWBD_workspace *workspace, DTWBD_workspace_state state);
+
+
 // This is a fast version of DTWBD algorithm that finds an approximate warping path.
 // 
 // Returns warping path length. Negative return value indicates an error.
@@ -94,47 +405,250 @@ void reverse_path(size_t *path, ssize_t path_len);
 // 
 // Linear both in time and space.
 ssize_t FastDTWBD(
-    double *s,  // first sequence of MFCC frames – n x l contiguous array
-    double *t,  // second sequence of MFCC frames – m x l contiguous array
+    double *s,  // first sequence of MFCC frames – n x l array
+    double *t,  // second sequence of MFCC frames – m x l array
     size_t n,   // number of frames in first sequence
     size_t  m,   // number of frames in second sequence
     size_t  l,   // number of MFCCs per frame
+    const ptrdiff_t *s_strides, // strides of frames and of MFCCs of `s` in elements, NULL if contiguous
+    const ptrdiff_t *t_strides, // same for `t`
     double skip_penalty,    // penalty for skipping one frame
     int radius,             // radius of path projection
+    int threads,            // number of threads to use
+    DTWBD_workspace *workspace, // workspace to allocate buffers from, NULL to use a temporary one
+    DTWBD_stats *stats,     // place to add the counters to, can be NULL
     double *path_distance,  // place to store warping path distance
     size_t *path_buffer     // buffer to store resulting warping path – (n+m) x 2 contiguous array
+) {
+    return FastDTWBD_typed(
+        s, t, FEATURES_DOUBLE, n, m, l, s_strides, t_strides,
+        skip_penalty, radius, threads, workspace, stats, path_distance, path_buffer
+    );
+}
+
+
+// Same as FastDTWBD() for sequences of floats.
+ssize_t FastDTWBD_float(
+    float *s, float *t, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, int radius, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+) {
+    return FastDTWBD_typed(
+        s, t, FEATURES_FLOAT, n, m, l, s_strides, t_strides,
+        skip_penalty, radius, threads, workspace, stats, path_distance, path_buffer
+    );
+}
+
+
+// FastDTWBD() for sequences of MFCCs of `features_type`.
+// Coarsed sequences are of the same type as the original ones.
+ssize_t FastDTWBD_typed(
+    void *s, void *t, int features_type, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, int radius, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
 ) {
     ssize_t path_len;
     size_t min_sequence_len = 2 * (radius + 1) + 1;
 
+    if (workspace == NULL) {
+        workspace = create_DTWBD_workspace(0);
+        if (workspace == NULL) {
+            fprintf(stderr, "ERROR: malloc() failed when allocating workspace\n");
+            return -1;
+        }
+        path_len = FastDTWBD_typed(
+            s, t, features_type, n, m, l, s_strides, t_strides,
+            skip_penalty, radius, threads, workspace, stats, path_distance, path_buffer
+        );
+        free_DTWBD_workspace(workspace);
+        return path_len;
+    }
+
     if (n < min_sequence_len || m < min_sequence_len) {
-        return DTWBD(s, t, n, m, l, skip_penalty, NULL, path_distance, path_buffer);
+        return DTWBD_typed(
+            s, t, features_type, n, m, l, s_strides, t_strides,
+            skip_penalty, NULL, NULL, 0, threads, workspace, stats, path_distance, path_buffer
+        );
     }
 
-    double *coarsed_s = get_coarsed_sequence(s, n, l);
-    double *coarsed_t = get_coarsed_sequence(t, m, l);
+    DTWBD_workspace_state workspace_state = get_workspace_state(workspace);
 
-    path_len = FastDTWBD(coarsed_s, coarsed_t, n/2, m/2, l, skip_penalty, radius, path_distance, path_buffer);
+    void *coarsed_s = get_coarsed_sequence(s, features_type, n, l, s_strides, workspace);
+    void *coarsed_t = get_coarsed_sequence(t, features_type, m, l, t_strides, workspace);
 
-    size_t *window = get_window(n, m, path_buffer, path_len, radius);
+    if (coarsed_s == NULL || coarsed_t == NULL) {
+        restore_workspace_state(workspace, workspace_state);
+        return -1;
+    }
 
-    path_len = DTWBD(s, t, n, m, l, skip_penalty, window, path_distance, path_buffer);
+    if (stats != NULL) {
+        stats->level++;
+    }
 
-    free(coarsed_s);
-    free(coarsed_t);
-    free(window);
+    path_len = FastDTWBD_typed(
+        coarsed_s, coarsed_t, features_type, n/2, m/2, l, NULL, NULL,
+        skip_penalty, radius, threads, workspace, stats, path_distance, path_buffer
+    );
+
+    if (stats != NULL) {
+        stats->level--;
+    }
+
+    restore_workspace_state(workspace, workspace_state);
+
+    if (path_len < 0) {
+        return path_len;
+    }
+
+    size_t *window = get_window(n, m, path_buffer, path_len, radius, workspace);
+
+    if (window == NULL) {
+        return -1;
+    }
+
+    // The coarse path is overwritten only after the D matrix is filled
+    path_len = DTWBD_typed(
+        s, t, features_type, n, m, l, s_strides, t_strides,
+        skip_penalty, window, path_buffer, path_len, threads, workspace, stats, path_distance, path_buffer
+    );
+
+    restore_workspace_state(workspace, workspace_state);
 
     return path_len;
 }
 
 
-double *get_coarsed_sequence(double *s, size_t n, size_t l) {
+// Runs FastDTWBD() for every task using `threads` threads.
+// Tasks are independent, so every task is processed by a single thread.
+// 
+// Returns 0 if all tasks succeeded and -1 otherwise.
+// Writes results to the tasks. Negative `path_len` indicates an error.
+int FastDTWBD_batch(
+    FastDTWBD_task *tasks,
+    size_t tasks_count,
+    size_t l,               // number of MFCCs per frame
+    double skip_penalty,    // penalty for skipping one frame
+    int radius,             // radius of path projection
+    int threads             // number of threads to use
+) {
+    return FastDTWBD_batch_typed(tasks, tasks_count, FEATURES_DOUBLE, l, skip_penalty, radius, threads);
+}
+
+
+// Same as FastDTWBD_batch() for sequences of floats.
+int FastDTWBD_batch_float(
+    FastDTWBD_task *tasks, size_t tasks_count, size_t l,
+    double skip_penalty, int radius, int threads
+) {
+    return FastDTWBD_batch_typed(tasks, tasks_count, FEATURES_FLOAT, l, skip_penalty, radius, threads);
+}
+
+
+int FastDTWBD_batch_typed(
+    FastDTWBD_task *tasks, size_t tasks_count, int features_type, size_t l,
+    double skip_penalty, int radius, int threads
+) {
+    FastDTWBD_batch_context context = {
+        .tasks = tasks,
+        .tasks_count = tasks_count,
+        .features_type = features_type,
+        .l = l,
+        .skip_penalty = skip_penalty,
+        .radius = radius,
+    };
+
+    size_t workers_count = threads < 1 ? 1 : threads;
+    if (workers_count > tasks_count) {
+        workers_count = tasks_count;
+    }
+
+    pthread_mutex_init(&context.lock, NULL);
+
+    // The calling thread is one of the workers.
+    // If a thread cannot be created, its tasks are processed by the other workers.
+    pthread_t *thread_ids = workers_count > 1 ? malloc(workers_count * sizeof(pthread_t)) : NULL;
+    size_t threads_created = 0;
+    for (size_t w = 1; thread_ids != NULL && w < workers_count; w++) {
+        if (pthread_create(&thread_ids[threads_created], NULL, run_FastDTWBD_batch_worker, &context) == 0) {
+            threads_created++;
+        }
+    }
+    run_FastDTWBD_batch_worker(&context);
+    for (size_t w = 0; w < threads_created; w++) {
+        pthread_join(thread_ids[w], NULL);
+    }
+    free(thread_ids);
+
+    pthread_mutex_destroy(&context.lock);
+
+    for (size_t k = 0; k < tasks_count; k++) {
+        if (tasks[k].path_len < 0) {
+            return -1;
+        }
+    }
+
+    return 0;
+}
+
+
+void *run_FastDTWBD_batch_worker(void *arg) {
+    FastDTWBD_batch_context *context = arg;
+
+    // Every worker reuses its own workspace for all its tasks.
+    // If it cannot be created, every task uses a temporary one.
+    DTWBD_workspace *workspace = create_DTWBD_workspace(0);
+
+    while (true) {
+        pthread_mutex_lock(&context->lock);
+        size_t k = context->next_task++;
+        pthread_mutex_unlock(&context->lock);
+
+        if (k >= context->tasks_count) {
+            break;
+        }
+
+        FastDTWBD_task *task = &context->tasks[k];
+        task->path_len = FastDTWBD_typed(
+            task->s, task->t, context->features_type, task->n, task->m, context->l,
+            task->s_strides, task->t_strides,
+            context->skip_penalty, context->radius, 1, workspace, NULL, &task->path_distance, task->path_buffer
+        );
+    }
+
+    free_DTWBD_workspace(workspace);
+
+    return NULL;
+}
+
+
+// Returns a contiguous sequence of n/2 frames, each is the average of two consecutive frames of `s`.
+// MFCCs of the result are of the same type as those of `s`.
+void *get_coarsed_sequence(
+    void *s, int features_type, size_t n, size_t l, const ptrdiff_t *strides, DTWBD_workspace *workspace
+) {
+    ptrdiff_t frame_stride = strides == NULL ? l : strides[0];
+    ptrdiff_t mfcc_stride = strides == NULL ? 1 : strides[1];
     size_t coarsed_sequence_len = n / 2;
-    double *coarsed_sequence = malloc(coarsed_sequence_len * l * sizeof(double));
+    size_t mfcc_size = features_type == FEATURES_FLOAT ? sizeof(float) : sizeof(double);
+    void *coarsed_sequence = workspace_alloc(workspace, coarsed_sequence_len * l * mfcc_size);
+
+    if (coarsed_sequence == NULL) {
+        fprintf(stderr, "ERROR: malloc() failed when allocating coarsed sequence\n");
+        return NULL;
+    }
 
     for (size_t i = 0; 2 * i + 1 < n ; i++) {
         for (size_t j = 0; j < l; j++) {
-            coarsed_sequence[l*i+j] = (s[l*(2*i)+j] + s[l*(2*i+1)+j]) / 2;
+            ptrdiff_t offset = (ptrdiff_t)(2*i) * frame_stride + (ptrdiff_t)j * mfcc_stride;
+            if (features_type == FEATURES_FLOAT) {
+                float *x = (float *)s + offset;
+                ((float *)coarsed_sequence)[l*i+j] = (x[0] + x[frame_stride]) / 2;
+            } else {
+                double *x = (double *)s + offset;
+                ((double *)coarsed_sequence)[l*i+j] = (x[0] + x[frame_stride]) / 2;
+            }
         }
     }
 
@@ -142,8 +656,13 @@ double *get_coarsed_sequence(double *s, size_t n, size_t l) {
 }
 
 
-size_t *get_window(size_t n, size_t m, size_t *path_buffer, size_t path_len, int radius) {
-    size_t *window = malloc(2*n*sizeof(size_t));
+size_t *get_window(size_t n, size_t m, size_t *path_buffer, size_t path_len, int radius, DTWBD_workspace *workspace) {
+    size_t *window = workspace_alloc(workspace, 2*n*sizeof(size_t));
+
+    if (window == NULL) {
+        fprintf(stderr, "ERROR: malloc() failed when allocating window\n");
+        return NULL;
+    }
 
     for (size_t i = 0; i < n; i++) {
         window[2*i] = m;    // maximum value for lower limit
@@ -194,119 +713,765 @@ void update_window(size_t *window, size_t n, size_t m, ssize_t i, ssize_t j) {
 // The algorithm is able to skip the first and the last few frames of both sequences
 // with the cost of `skip_penalty` for each skipped frame.
 // 
+// If `threads` > 1, strips of the D matrix are processed in parallel.
+// The result does not depend on the number of threads.
+// 
+// Cells whose distance, plus the penalty for the frames that any path skips in the end,
+// exceeds the best path distance found so far cannot be on the warping path.
+// Such cells are pruned, and the local distances are not computed for the cells
+// that can be reached only from the pruned ones. The path is the same as without pruning.
+// FastDTWBD() starts with the distance of the coarse path projected to the window.
+// 
 // Returns warping path length. Negative return value indicates an error.
 // Writes warping path distance to the `path_distance`.
 // Writes warping path to the `path_buffer`.
 ssize_t DTWBD(
-    double *s,  // first sequence of MFCC frames – n x l contiguous array
-    double *t,  // second sequence of MFCC frames – m x l contiguous array
+    double *s,  // first sequence of MFCC frames – n x l array
+    double *t,  // second sequence of MFCC frames – m x l array
     size_t n,   // number of frames in first sequence
     size_t m,   // number of frames in second sequence
     size_t l,   // number of MFCCs per frame
+    const ptrdiff_t *s_strides, // strides of frames and of MFCCs of `s` in elements, NULL if contiguous
+    const ptrdiff_t *t_strides, // same for `t`
     double skip_penalty,    // penalty for skipping one frame
     size_t *window,            // n x 2 contiguous array, for each frame i from first sequence
                             // windows[i] gives range [from, to) of frames from second sequence to evaluate
+    int threads,            // number of threads to use
+    DTWBD_workspace *workspace, // workspace to allocate buffers from, NULL to use a temporary one
+    DTWBD_stats *stats,     // place to add the counters to, can be NULL
     double *path_distance,  // place to store warping path distance
     size_t *path_buffer     // buffer to store resulting warping path – (n+m) x 2 contiguous array
 ) {
-    D_matrix_element *D_matrix = malloc(sizeof(D_matrix_element) * n * m);
+    return DTWBD_typed(
+        s, t, FEATURES_DOUBLE, n, m, l, s_strides, t_strides,
+        skip_penalty, window, NULL, 0, threads, workspace, stats, path_distance, path_buffer
+    );
+}
+
+
+// Same as DTWBD() for sequences of floats.
+ssize_t DTWBD_float(
+    float *s, float *t, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, size_t *window, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+) {
+    return DTWBD_typed(
+        s, t, FEATURES_FLOAT, n, m, l, s_strides, t_strides,
+        skip_penalty, window, NULL, 0, threads, workspace, stats, path_distance, path_buffer
+    );
+}
 
-    if (D_matrix == NULL) {
+
+// DTWBD() for sequences of MFCCs of `features_type`.
+// Local distances are computed from MFCCs of that type,
+// while the distances of the D matrix are always doubles.
+ssize_t DTWBD_typed(
+    void *s, void *t, int features_type, size_t n, size_t m, size_t l,
+    const ptrdiff_t *s_strides, const ptrdiff_t *t_strides,
+    double skip_penalty, size_t *window, const size_t *coarse_path, size_t coarse_path_len, int threads,
+    DTWBD_workspace *workspace, DTWBD_stats *stats, double *path_distance, size_t *path_buffer
+) {
+    // An empty sequence has no strips, and nothing can be matched
+    if (n == 0 || m == 0) {
+        return 0;
+    }
+
+    if (workspace == NULL) {
+        workspace = create_DTWBD_workspace(0);
+        if (workspace == NULL) {
+            fprintf(stderr, "ERROR: malloc() failed when allocating workspace\n");
+            return -1;
+        }
+        ssize_t path_len = DTWBD_typed(
+            s, t, features_type, n, m, l, s_strides, t_strides,
+            skip_penalty, window, coarse_path, coarse_path_len, threads, workspace, stats, path_distance, path_buffer
+        );
+        free_DTWBD_workspace(workspace);
+        return path_len;
+    }
+
+    DTWBD_workspace_state workspace_state = get_workspace_state(workspace);
+
+    // Only the distances of the rows being processed are kept.
+    // To restore the path, the move that leads to every cell inside the window is stored.
+    // Moves take 2 bits per cell, so memory is proportional to the window size
+    // rather than to n x m.
+    DTWBD_context context = {
+        .features_type = features_type,
+        .s = s,
+        .s_strides = {s_strides == NULL ? l : s_strides[0], s_strides == NULL ? 1 : s_strides[1]},
+        .n = n,
+        .m = m,
+        .l = l,
+        .skip_penalty = skip_penalty,
+        .window = window,
+        .strips_count = (n + STRIP_HEIGHT - 1) / STRIP_HEIGHT,
+        .bound = skip_penalty * (n + m),
+        .end_skip = get_end_skip(n, m, window, skip_penalty),
+    };
+    size_t strips_count = context.strips_count;
+
+    context.t_transposed = get_transposed_sequence(t, features_type, m, l, t_strides, workspace);
+    context.row_offsets = get_row_offsets(n, m, window, workspace);
+    context.last_row_offsets = workspace_alloc(workspace, (strips_count + 1) * sizeof(size_t));
+    context.progress = workspace_calloc(workspace, strips_count, sizeof(size_t));
+    context.min_path_distances = workspace_alloc(workspace, strips_count * sizeof(double));
+    context.end_cells = workspace_alloc(workspace, 2 * strips_count * sizeof(size_t));
+    context.matches = workspace_alloc(workspace, strips_count * sizeof(bool));
+    context.live_ranges = workspace_alloc(workspace, 2 * n * sizeof(size_t));
+
+    if (context.row_offsets != NULL && context.last_row_offsets != NULL) {
+        context.last_row_offsets[0] = 0;
+        for (size_t k = 0; k < strips_count; k++) {
+            size_t first_row = k * STRIP_HEIGHT;
+            size_t last_row = first_row + STRIP_HEIGHT < n ? first_row + STRIP_HEIGHT - 1 : n - 1;
+            size_t strip_len = context.row_offsets[last_row] - context.row_offsets[first_row];
+            size_t last_row_len = context.row_offsets[last_row+1] - context.row_offsets[last_row];
+            if (strip_len > context.strip_len) {
+                context.strip_len = strip_len;
+            }
+            context.last_row_offsets[k+1] = context.last_row_offsets[k] + last_row_len;
+        }
+        context.moves = workspace_alloc(workspace, context.row_offsets[n] / 4);
+        context.last_rows = workspace_alloc(workspace, context.last_row_offsets[strips_count] * sizeof(double));
+    }
+
+    size_t workers_count = threads < 1 ? 1 : threads;
+    if (workers_count > strips_count) {
+        workers_count = strips_count;
+    }
+    DTWBD_worker *workers = workspace_calloc(workspace, workers_count, sizeof(DTWBD_worker));
+    bool workers_allocated = workers != NULL;
+
+    for (size_t w = 0; workers != NULL && w < workers_count; w++) {
+        workers[w].context = &context;
+        workers[w].strip_rows = workspace_alloc(workspace, context.strip_len * sizeof(double));
+        workers[w].distances = workspace_alloc(workspace, BLOCK_WIDTH * sizeof(double));
+        if ((workers[w].strip_rows == NULL && context.strip_len > 0) || workers[w].distances == NULL) {
+            workers_allocated = false;
+        }
+    }
+
+    if (
+        context.t_transposed == NULL || context.row_offsets == NULL ||
+        context.last_row_offsets == NULL || context.progress == NULL ||
+        context.min_path_distances == NULL || context.end_cells == NULL || context.matches == NULL ||
+        context.live_ranges == NULL ||
+        (context.moves == NULL && context.row_offsets[n] > 0) ||
+        (context.last_rows == NULL && context.last_row_offsets[strips_count] > 0) ||
+        !workers_allocated
+    ) {
         fprintf(stderr, "ERROR: malloc() failed when allocating D_matrix\n");
+        restore_workspace_state(workspace, workspace_state);
         return -1;
     }
 
-    double min_path_distance;
-    double cur_path_distance;
-    size_t end_i, end_j;
-    bool match = false;
+    for (size_t i = 0; i < n; i++) {
+        context.live_ranges[2*i] = m;
+        context.live_ranges[2*i+1] = 0;
+    }
+
+    if (coarse_path != NULL) {
+        context.bound = get_projected_path_distance(&context, coarse_path, coarse_path_len);
+    }
+
+    // All the buffers of this call and of the calling FastDTWBD() levels are allocated by now
+    size_t bytes_in_use = workspace->used + workspace->overflow_bytes;
+    if (stats != NULL && bytes_in_use > stats->peak_bytes) {
+        stats->peak_bytes = bytes_in_use;
+    }
 
-    min_path_distance = skip_penalty * (n + m);
+    context.parallel = workers_count > 1;
 
-    for (size_t i = 0; i < n; i++) {
-        size_t from = window == NULL ? 0 : window[2*i];
-        size_t to = window == NULL ? m : window[2*i+1];
-        for (size_t j = from; j < to; j++) {
-            double d = euclid_distance(s+i*l, t+j*l, l);
-            
-            D_matrix_element candidates[] = {
-                { skip_penalty * (i + j) + d, -1, -1 },
-                { get_distance(D_matrix, n, m, window, i-1, j-1) + d, i-1, j-1 },
-                { get_distance(D_matrix, n, m, window, i, j-1) + d, i, j-1 },
-                { get_distance(D_matrix, n, m, window, i-1, j) + d, i-1, j },
-            };
-
-            D_matrix[i*m+j] = get_best_candidate(candidates, sizeof(candidates)/sizeof(D_matrix_element));
-
-            cur_path_distance = D_matrix[i*m+j].distance + skip_penalty * (n - i + m - j - 2);
-
-            if (cur_path_distance < min_path_distance) {
-                min_path_distance = cur_path_distance;
-                end_i = i;
-                end_j = j;
-                match = true;
+    if (context.parallel) {
+        pthread_mutex_init(&context.lock, NULL);
+        pthread_cond_init(&context.progress_changed, NULL);
+
+        // The calling thread is one of the workers.
+        // If a thread cannot be created, its work is done by the other workers.
+        pthread_t *thread_ids = workspace_alloc(workspace, workers_count * sizeof(pthread_t));
+        size_t threads_created = 0;
+        for (size_t w = 1; thread_ids != NULL && w < workers_count; w++) {
+            if (pthread_create(&thread_ids[threads_created], NULL, run_DTWBD_worker, &workers[w]) == 0) {
+                threads_created++;
             }
         }
+        run_DTWBD_worker(&workers[0]);
+        for (size_t w = 0; w < threads_created; w++) {
+            pthread_join(thread_ids[w], NULL);
+        }
+
+        pthread_mutex_destroy(&context.lock);
+        pthread_cond_destroy(&context.progress_changed);
+    } else {
+        run_DTWBD_worker(&workers[0]);
+    }
+
+    for (size_t w = 0; stats != NULL && w < workers_count; w++) {
+        size_t level = stats->level < DTWBD_MAX_LEVELS ? stats->level : DTWBD_MAX_LEVELS - 1;
+        stats->cells += workers[w].cells;
+        stats->pruned_cells += workers[w].pruned_cells;
+        stats->level_cells[level] += workers[w].cells;
+    }
+
+    // Strips are ordered by rows, so taking the first strip with the smallest distance
+    // gives the same path end as processing the matrix row by row.
+    double min_path_distance = skip_penalty * (n + m);
+    size_t end_i, end_j;
+    bool match = false;
+
+    for (size_t k = 0; k < strips_count; k++) {
+        if (context.matches[k] && context.min_path_distances[k] < min_path_distance) {
+            min_path_distance = context.min_path_distances[k];
+            end_i = context.end_cells[2*k];
+            end_j = context.end_cells[2*k+1];
+            match = true;
+        }
     }
 
     ssize_t path_len = 0;
 
     if (match) {
-        D_matrix_element *e;
         *path_distance = min_path_distance;
-        for (ssize_t i = end_i, j = end_j; i != -1; i = e->prev_i, j = e->prev_j) {
-            e = &D_matrix[i*m+j];
+        size_t i = end_i;
+        size_t j = end_j;
+        while (true) {
             path_buffer[2*path_len] = i;
             path_buffer[2*path_len+1] = j;
             path_len++;
+
+            size_t from, to;
+            get_row_window(window, m, i, &from, &to);
+            int move = get_move(context.moves + context.row_offsets[i] / 4, j-from);
+
+            if (move == MOVE_START) {
+                break;
+            }
+            if (move != MOVE_LEFT) {
+                i--;
+            }
+            if (move != MOVE_UP) {
+                j--;
+            }
         }
         reverse_path(path_buffer, path_len);
     }
 
-    free(D_matrix);
+    restore_workspace_state(workspace, workspace_state);
 
     return path_len;
 }
 
 
-double euclid_distance(double *x, double *y, size_t l) {
-    double sum;
+void *run_DTWBD_worker(void *arg) {
+    DTWBD_worker *worker = arg;
+    DTWBD_context *context = worker->context;
 
-    sum = 0;
-    for (size_t i = 0; i < l; i++) {
-        double v = x[i] - y[i];
-        sum += v * v;
+    while (true) {
+        size_t k;
+
+        // Strips are taken in order, so the strip k-1, which strip k depends on,
+        // is always being processed by some worker.
+        if (context->parallel) {
+            pthread_mutex_lock(&context->lock);
+            k = context->next_strip++;
+            pthread_mutex_unlock(&context->lock);
+        } else {
+            k = context->next_strip++;
+        }
+
+        if (k >= context->strips_count) {
+            break;
+        }
+
+        process_strip(worker, k);
     }
 
-    return sqrt(sum);
+    return NULL;
 }
 
 
-double get_distance(D_matrix_element *D_matrix, size_t n, size_t m, size_t *window, size_t i, size_t j) {
-    if (i < 0 || i >= n || j < 0 || j >= m) {
-        return DBL_MAX;
+void process_strip(DTWBD_worker *worker, size_t k) {
+    DTWBD_context *c = worker->context;
+    size_t n = c->n;
+    size_t m = c->m;
+    double skip_penalty = c->skip_penalty;
+    double end_skip = c->end_skip;
+    size_t first_row = k * STRIP_HEIGHT;
+    size_t end_row = first_row + STRIP_HEIGHT < n ? first_row + STRIP_HEIGHT : n;
+
+    size_t strip_from = m;
+    size_t strip_to = 0;
+
+    for (size_t i = first_row; i < end_row; i++) {
+        size_t from, to;
+        get_row_window(c->window, m, i, &from, &to);
+        if (from < to) {
+            strip_from = from < strip_from ? from : strip_from;
+            strip_to = to > strip_to ? to : strip_to;
+        }
+    }
+
+    double min_path_distance = skip_penalty * (n + m);
+    double cur_path_distance;
+    double bound = min_path_distance;
+    set_progress(c, k, 0, &bound);
+    size_t end_i = 0;
+    size_t end_j = 0;
+    bool match = false;
+
+    for (size_t block_from = strip_from - strip_from % BLOCK_WIDTH; block_from < strip_to; block_from += BLOCK_WIDTH) {
+        size_t block_to = block_from + BLOCK_WIDTH < m ? block_from + BLOCK_WIDTH : m;
+
+        if (k > 0) {
+            wait_for_progress(c, k-1, block_to);
+        }
+
+        for (size_t i = first_row; i < end_row; i++) {
+            size_t from, to, prev_from, prev_to;
+            get_row_window(c->window, m, i, &from, &to);
+
+            size_t j_from = from > block_from ? from : block_from;
+            size_t j_to = to < block_to ? to : block_to;
+
+            if (j_from >= j_to) {
+                continue;
+            }
+
+            double *row = get_row(worker, k, i);
+            double *prev_row = NULL;
+            prev_from = prev_to = 0;
+            if (i > 0) {
+                prev_row = get_row(worker, i == first_row ? k-1 : k, i-1);
+                get_row_window(c->window, m, i-1, &prev_from, &prev_to);
+            }
+            unsigned char *row_moves = c->moves + c->row_offsets[i] / 4;
+
+            // A cell can be on the path only if the path starts at it or
+            // one of the cells it can be reached from is not pruned.
+            // Since distances are not negative, a path cannot start at the cells
+            // where the skip penalty alone exceeds the bound.
+            // Local distances are computed for the cells [eval_from, eval_to)
+            // that can start the path or are next to not pruned cells of the previous row,
+            // and then for the rest of the block if the cell to the left of it is not pruned.
+            size_t *live_range = c->live_ranges + 2*i;
+            size_t prev_live_from = m;
+            size_t prev_live_to = 0;
+            if (i > 0 && i == first_row) {
+                // The previous row belongs to another strip, which may still be updating its range,
+                // so the range is found from the processed columns.
+                for (size_t j = j_from > 0 ? j_from - 1 : 0; j < j_to; j++) {
+                    if (get_distance(prev_row, prev_from, prev_to, j) != DBL_MAX) {
+                        prev_live_from = j < prev_live_from ? j : prev_live_from;
+                        prev_live_to = j + 1;
+                    }
+                }
+            } else if (i > 0) {
+                prev_live_from = c->live_ranges[2*(i-1)];
+                prev_live_to = c->live_ranges[2*(i-1)+1];
+            }
+            size_t eval_from = prev_live_from > j_from ? prev_live_from : j_from;
+            size_t eval_to = prev_live_to + 1 < j_to ? prev_live_to + 1 : j_to;
+
+            if (live_range[1] == j_from || skip_penalty * (i + j_from) <= bound) {
+                eval_from = j_from;
+            }
+            // The column after the last one where the path can start, with a column to spare for rounding
+            double start_to = skip_penalty > 0 ? floor(bound / skip_penalty) - i + 2 : (double)j_to;
+            if (start_to > eval_to) {
+                eval_to = start_to < j_to ? (size_t)start_to : j_to;
+            }
+            if (eval_from >= eval_to) {
+                eval_from = eval_to = j_from;
+            }
+
+            for (size_t j = j_from; j < eval_from; j++) {
+                row[j-from] = DBL_MAX;
+            }
+
+            if (eval_from < eval_to) {
+                get_local_distances(c, i, eval_from, eval_to, worker->distances);
+            }
+
+            size_t distances_from = eval_from;
+            size_t distances_to = eval_to;
+            size_t live_from = live_range[0];
+            size_t live_to = live_range[1];
+            size_t j = eval_from;
+            for (; j < j_to; j++) {
+                if (j == distances_to) {
+                    if (get_distance(row, from, to, j-1) == DBL_MAX) {
+                        break;
+                    }
+                    distances_from = j;
+                    distances_to = j_to;
+                    get_local_distances(c, i, distances_from, distances_to, worker->distances);
+                }
+                double d = worker->distances[j-distances_from];
+
+                double candidates[] = {
+                    skip_penalty * (i + j) + d,
+                    get_distance(prev_row, prev_from, prev_to, j-1) + d,
+                    get_distance(row, from, to, j-1) + d,
+                    get_distance(prev_row, prev_from, prev_to, j) + d,
+                };
+
+                int move = get_best_move(candidates, sizeof(candidates)/sizeof(double));
+
+                // A path through the cell skips at least `end_skip` in the end
+                if (candidates[move] + end_skip > bound) {
+                    row[j-from] = DBL_MAX;
+                    continue;
+                }
+
+                row[j-from] = candidates[move];
+                set_move(row_moves, j-from, move);
+
+                if (live_from > j) {
+                    live_from = j;
+                }
+                live_to = j + 1;
+
+                cur_path_distance = row[j-from] + skip_penalty * (n - i + m - j - 2);
+
+                // Cells are not processed row by row,
+                // so ties are resolved in favour of the first cell in row order.
+                if (
+                    cur_path_distance < min_path_distance ||
+                    (match && cur_path_distance == min_path_distance && (i < end_i || (i == end_i && j < end_j)))
+                ) {
+                    min_path_distance = cur_path_distance;
+                    end_i = i;
+                    end_j = j;
+                    match = true;
+                    if (min_path_distance < bound) {
+                        bound = min_path_distance;
+                    }
+                }
+            }
+
+            live_range[0] = live_from;
+            live_range[1] = live_to;
+
+            worker->cells += j_to - j_from;
+            worker->pruned_cells += (eval_from - j_from) + (j_to - j);
+
+            for (; j < j_to; j++) {
+                row[j-from] = DBL_MAX;
+            }
+        }
+
+        set_progress(c, k, block_to, &bound);
+    }
+
+    set_progress(c, k, m, &bound);
+
+    c->min_path_distances[k] = min_path_distance;
+    c->matches[k] = match;
+    if (match) {
+        c->end_cells[2*k] = end_i;
+        c->end_cells[2*k+1] = end_j;
+    }
+}
+
+
+// Returns distances of the row i, which belongs to the strip k.
+// The last row of every strip is kept until the next strip is processed.
+double *get_row(DTWBD_worker *worker, size_t k, size_t i) {
+    DTWBD_context *c = worker->context;
+    size_t first_row = k * STRIP_HEIGHT;
+
+    if (i == first_row + STRIP_HEIGHT - 1 || i == c->n - 1) {
+        return c->last_rows + c->last_row_offsets[k];
+    }
+
+    return worker->strip_rows + (c->row_offsets[i] - c->row_offsets[first_row]);
+}
+
+
+void wait_for_progress(DTWBD_context *context, size_t k, size_t column) {
+    // Without threads, strips are processed one after another.
+    if (!context->parallel) return;
+
+    pthread_mutex_lock(&context->lock);
+    while (context->progress[k] < column) {
+        pthread_cond_wait(&context->progress_changed, &context->lock);
+    }
+    pthread_mutex_unlock(&context->lock);
+}
+
+
+// Marks columns < `column` of the strip k as processed.
+// Also exchanges the `bound` on the path distance with the other strips:
+// any path distance found is a valid bound for every strip.
+void set_progress(DTWBD_context *context, size_t k, size_t column, double *bound) {
+    if (!context->parallel) {
+        context->bound = *bound < context->bound ? *bound : context->bound;
+        *bound = context->bound;
+        return;
+    }
+
+    pthread_mutex_lock(&context->lock);
+    context->progress[k] = column;
+    context->bound = *bound < context->bound ? *bound : context->bound;
+    *bound = context->bound;
+    pthread_cond_broadcast(&context->progress_changed);
+    pthread_mutex_unlock(&context->lock);
+}
+
+
+// Returns a copy of the m x l sequence `t` stored as l x m contiguous array,
+// so that the same MFCC of consecutive frames is contiguous.
+// MFCCs of the copy are of the same type as those of `t`.
+void *get_transposed_sequence(
+    void *t, int features_type, size_t m, size_t l, const ptrdiff_t *strides, DTWBD_workspace *workspace
+) {
+    ptrdiff_t frame_stride = strides == NULL ? l : strides[0];
+    ptrdiff_t mfcc_stride = strides == NULL ? 1 : strides[1];
+    size_t mfcc_size = features_type == FEATURES_FLOAT ? sizeof(float) : sizeof(double);
+    void *t_transposed = workspace_alloc(workspace, m * l * mfcc_size);
+
+    if (t_transposed == NULL) {
+        return NULL;
+    }
+
+    for (size_t j = 0; j < m; j++) {
+        for (size_t k = 0; k < l; k++) {
+            ptrdiff_t offset = (ptrdiff_t)j * frame_stride + (ptrdiff_t)k * mfcc_stride;
+            if (features_type == FEATURES_FLOAT) {
+                ((float *)t_transposed)[k*m+j] = ((float *)t)[offset];
+            } else {
+                ((double *)t_transposed)[k*m+j] = ((double *)t)[offset];
+            }
+        }
+    }
+
+    return t_transposed;
+}
+
+
+// Computes euclidean distances between the frame i of the first sequence
+// and frames [from, to) of the second sequence of the context `c`.
+// Writes them to `distances[0:to-from]`.
+void get_local_distances(DTWBD_context *c, size_t i, size_t from, size_t to, double *distances) {
+    ptrdiff_t offset = (ptrdiff_t)i * c->s_strides[0];
+
+    if (c->features_type == FEATURES_FLOAT) {
+        get_row_distances_float(
+            (float *)c->s + offset, c->s_strides[1], c->t_transposed, c->m, c->l, from, to, distances
+        );
+    } else {
+        get_row_distances(
+            (double *)c->s + offset, c->s_strides[1], c->t_transposed, c->m, c->l, from, to, distances
+        );
+    }
+}
+
+
+// Returns the distance of the best warping path that follows the projection of `coarse_path`,
+// the warping path of the coarsed sequences, to the original sequences,
+// or skip_penalty * (n + m) if there is no better path.
+// Every step of the coarse path makes two steps of the projection.
+// Distances are summed in the same order as in process_strip(),
+// so the distance of the warping path found by DTWBD() never exceeds the result.
+double get_projected_path_distance(DTWBD_context *c, const size_t *coarse_path, size_t coarse_path_len) {
+    size_t n = c->n;
+    size_t m = c->m;
+    double skip_penalty = c->skip_penalty;
+    double min_path_distance = skip_penalty * (n + m);
+    double distance = DBL_MAX;  // distance of the best path that ends at the current cell
+
+    for (size_t k = 0; k < coarse_path_len; k++) {
+        size_t coarse_i = coarse_path[2*k];
+        size_t coarse_j = coarse_path[2*k+1];
+        // The last cell is followed by a diagonal step
+        size_t next_i = k + 1 < coarse_path_len ? coarse_path[2*(k+1)] : coarse_i + 1;
+        size_t next_j = k + 1 < coarse_path_len ? coarse_path[2*(k+1)+1] : coarse_j + 1;
+        size_t cells[] = {2*coarse_i, 2*coarse_j, coarse_i + next_i, coarse_j + next_j};
+
+        for (size_t x = 0; x < 2; x++) {
+            size_t i = cells[2*x];
+            size_t j = cells[2*x+1];
+            size_t from, to;
+            get_row_window(c->window, m, i, &from, &to);
+
+            if (i >= n || j < from || j >= to) {
+                return min_path_distance;
+            }
+
+            double d;
+            get_local_distances(c, i, j, j+1, &d);
+
+            double start_distance = skip_penalty * (i + j) + d;
+            if (distance == DBL_MAX || start_distance <= distance + d) {
+                distance = start_distance;
+            } else {
+                distance = distance + d;
+            }
+
+            double path_distance = distance + skip_penalty * (n - i + m - j - 2);
+            if (path_distance < min_path_distance) {
+                min_path_distance = path_distance;
+            }
+        }
     }
 
-    if (window == NULL || (j >= window[2*i] && j < window[2*i+1])) {
-        return D_matrix[i*m+j].distance;
+    return min_path_distance;
+}
+
+
+// Returns the penalty for the frames that are skipped after any path inside the window:
+// a path cannot end further than the last cell of the window.
+double get_end_skip(size_t n, size_t m, size_t *window, double skip_penalty) {
+    size_t max_end = 0;     // maximum i + j over the cells of the window
+
+    for (size_t i = 0; i < n; i++) {
+        size_t from, to;
+        get_row_window(window, m, i, &from, &to);
+        if (from < to && i + to - 1 > max_end) {
+            max_end = i + to - 1;
+        }
+    }
+
+    return max_end + 2 < n + m ? skip_penalty * (n + m - 2 - max_end) : 0.0;
+}
+
+
+// Computes euclidean distances between the frame `x`, whose MFCCs are `x_stride` doubles apart,
+// and frames [from, to) of the sequence given by `t_transposed`.
+// Writes them to `distances[0:to-from]`.
+// 
+// Frames are processed in blocks of 8. The innermost loops run over consecutive frames
+// of a block and keep the sums in registers, so the compiler can vectorize them
+// (SSE/AVX on x86, NEON on ARM) while the code itself stays portable.
+// The squares are summed in the same order as in the scalar version,
+// so the results do not depend on whether the loops are vectorized.
+void get_row_distances(
+    double *x, ptrdiff_t x_stride, double *t_transposed, size_t m, size_t l,
+    size_t from, size_t to, double *distances
+) {
+    size_t len = to - from;
+    size_t j = 0;
+
+    for (; j + 8 <= len; j += 8) {
+        double acc[8] = {0};
+        for (size_t k = 0; k < l; k++) {
+            double x_k = x[k * x_stride];
+            const double *t_k = t_transposed + k*m + from + j;
+            for (size_t b = 0; b < 8; b++) {
+                double v = x_k - t_k[b];
+                acc[b] += v * v;
+            }
+        }
+        for (size_t b = 0; b < 8; b++) {
+            distances[j+b] = sqrt(acc[b]);
+        }
     }
 
-    return DBL_MAX;
+    for (; j < len; j++) {
+        double sum = 0;
+        for (size_t k = 0; k < l; k++) {
+            double v = x[k * x_stride] - t_transposed[k*m+from+j];
+            sum += v * v;
+        }
+        distances[j] = sqrt(sum);
+    }
 }
 
 
-D_matrix_element get_best_candidate(D_matrix_element *candidates, size_t n) {
+// Same as get_row_distances() for sequences of floats.
+// 
+// The squares of a frame pair are summed in floats, so the loops process
+// twice as many frames per vector instruction as with doubles.
+// A sum has only l terms, so it loses no more precision than the MFCCs already have.
+// The distances of the D matrix, which add up along the whole path, are doubles.
+// 
+// The innermost loop runs over up to BLOCK_WIDTH consecutive frames.
+// With loops over 8 frames as in get_row_distances(), compilers tend to vectorize
+// the loop over MFCCs instead, which reads `t_transposed` with a stride of m.
+void get_row_distances_float(
+    float *x, ptrdiff_t x_stride, float *t_transposed, size_t m, size_t l,
+    size_t from, size_t to, double *distances
+) {
+    size_t len = to - from;
+
+    for (size_t j = 0; j < len; j += BLOCK_WIDTH) {
+        size_t block_len = len - j < BLOCK_WIDTH ? len - j : BLOCK_WIDTH;
+        float sums[BLOCK_WIDTH] = {0};
+        for (size_t k = 0; k < l; k++) {
+            float x_k = x[k * x_stride];
+            const float *t_k = t_transposed + k*m + from + j;
+            for (size_t b = 0; b < block_len; b++) {
+                float v = x_k - t_k[b];
+                sums[b] += v * v;
+            }
+        }
+        for (size_t b = 0; b < block_len; b++) {
+            distances[j+b] = sqrt(sums[b]);
+        }
+    }
+}
+
+
+void get_row_window(size_t *window, size_t m, size_t i, size_t *from, size_t *to) {
+    *from = window == NULL ? 0 : window[2*i];
+    *to = window == NULL ? m : window[2*i+1];
+}
+
+
+size_t *get_row_offsets(size_t n, size_t m, size_t *window, DTWBD_workspace *workspace) {
+    size_t *row_offsets = workspace_alloc(workspace, (n+1)*sizeof(size_t));
+
+    if (row_offsets == NULL) {
+        return NULL;
+    }
+
+    row_offsets[0] = 0;
+    for (size_t i = 0; i < n; i++) {
+        size_t from, to;
+        get_row_window(window, m, i, &from, &to);
+        size_t row_len = to > from ? to - from : 0;
+        // round up to a multiple of 4 so that every row starts at a byte boundary
+        row_offsets[i+1] = row_offsets[i] + (row_len + 3) / 4 * 4;
+    }
+
+    return row_offsets;
+}
+
+
+double get_distance(double *row, size_t from, size_t to, size_t j) {
+    if (j < from || j >= to) {
+        return DBL_MAX;
+    }
+
+    return row[j-from];
+}
+
+
+int get_best_move(double *candidates, size_t n) {
     double min_distance = DBL_MAX;
-    D_matrix_element best_candidate;
+    int best_move = MOVE_START;
 
     for (size_t i = 0; i < n; i++) {
-        if (candidates[i].distance < min_distance) {
-            min_distance = candidates[i].distance;
-            best_candidate = candidates[i];
+        if (candidates[i] < min_distance) {
+            min_distance = candidates[i];
+            best_move = i;
         }
     }
 
-    return best_candidate;
+    return best_move;
+}
+
+
+void set_move(unsigned char *moves, size_t k, int move) {
+    int shift = 2 * (k % 4);
+    moves[k/4] = (moves[k/4] & ~(3 << shift)) | (move << shift);
+}
+
+
+int get_move(unsigned char *moves, size_t k) {
+    return (moves[k/4] >> (2 * (k % 4))) & 3;
 }
 
 
@@ -320,3 +1485,129 @@ void reverse_path(size_t *path, ssize_t path_len) {
         path[2*j+1] = tmp_t;
     }
 }
+
+
+// Creates a workspace with a block of `size` bytes. Returns NULL if allocation fails.
+DTWBD_workspace *create_DTWBD_workspace(size_t size) {
+    DTWBD_workspace *workspace = calloc(1, sizeof(DTWBD_workspace));
+
+    if (workspace == NULL) {
+        return NULL;
+    }
+
+    size = (size + WORKSPACE_ALIGNMENT - 1) / WORKSPACE_ALIGNMENT * WORKSPACE_ALIGNMENT;
+    if (size > 0) {
+        workspace->block = malloc(size);
+        if (workspace->block == NULL) {
+            free(workspace);
+            return NULL;
+        }
+        workspace->size = size;
+    }
+
+    return workspace;
+}
+
+
+void free_DTWBD_workspace(DTWBD_workspace *workspace) {
+    if (workspace == NULL) return;
+
+    for (size_t k = 0; k < workspace->overflow_count; k++) {
+        free(workspace->overflow[k]);
+    }
+    free(workspace->overflow);
+    free(workspace->block);
+    free(workspace);
+}
+
+
+// Returns the size of the workspace block in bytes.
+size_t get_DTWBD_workspace_size(DTWBD_workspace *workspace) {
+    return workspace->size;
+}
+
+
+// Returns a buffer of `size` bytes that lives until the workspace state
+// saved before the allocation is restored. Returns NULL if allocation fails.
+void *workspace_alloc(DTWBD_workspace *workspace, size_t size) {
+    void *buffer;
+
+    // Never return NULL for zero size, so that callers can check the result alone.
+    size = size == 0 ? WORKSPACE_ALIGNMENT : (size + WORKSPACE_ALIGNMENT - 1) / WORKSPACE_ALIGNMENT * WORKSPACE_ALIGNMENT;
+
+    if (workspace->size - workspace->used >= size) {
+        buffer = workspace->block + workspace->used;
+        workspace->used += size;
+    } else {
+        if (workspace->overflow_count == workspace->overflow_capacity) {
+            size_t capacity = workspace->overflow_capacity == 0 ? 16 : 2 * workspace->overflow_capacity;
+            void **overflow = realloc(workspace->overflow, capacity * sizeof(void *));
+            if (overflow == NULL) {
+                return NULL;
+            }
+            workspace->overflow = overflow;
+            workspace->overflow_capacity = capacity;
+        }
+        buffer = malloc(size);
+        if (buffer == NULL) {
+            return NULL;
+        }
+        workspace->overflow[workspace->overflow_count++] = buffer;
+        workspace->overflow_bytes += size;
+    }
+
+    if (workspace->used + workspace->overflow_bytes > workspace->peak) {
+        workspace->peak = workspace->used + workspace->overflow_bytes;
+    }
+
+    return buffer;
+}
+
+
+void *workspace_calloc(DTWBD_workspace *workspace, size_t count, size_t size) {
+    void *buffer = workspace_alloc(workspace, count * size);
+
+    if (buffer != NULL) {
+        memset(buffer, 0, count * size);
+    }
+
+    return buffer;
+}
+
+
+DTWBD_workspace_state get_workspace_state(DTWBD_workspace *workspace) {
+    DTWBD_workspace_state state = {
+        .used = workspace->used,
+        .overflow_count = workspace->overflow_count,
+        .overflow_bytes = workspace->overflow_bytes,
+    };
+    return state;
+}
+
+
+// Frees all buffers allocated since the `state` was saved.
+// If no buffers are left, grows the block to fit the peak usage.
+void restore_workspace_state(DTWBD_workspace *workspace, DTWBD_workspace_state state) {
+    for (size_t k = state.overflow_count; k < workspace->overflow_count; k++) {
+        free(workspace->overflow[k]);
+    }
+    workspace->overflow_count = state.overflow_count;
+    workspace->overflow_bytes = state.overflow_bytes;
+    workspace->used = state.used;
+
+    if (workspace->used > 0 || workspace->overflow_count > 0 || workspace->peak <= workspace->size) {
+        return;
+    }
+
+    // Grow at least twice, so that slowly growing inputs do not cause reallocation on every call.
+    size_t size = workspace->peak > 2 * workspace->size ? workspace->peak : 2 * workspace->size;
+    unsigned char *block = malloc(size);
+
+    // If the block cannot grow, the old one is kept and the rest is allocated with malloc().
+    if (block != NULL) {
+        free(workspace->block);
+        workspace->block = block;
+        workspace->size = size;
+    }
+    workspace->peak = 0;
+}
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump when the format or the meaning of cached arrays changes.
+CACHE_VERSION = 2
+
+
+class FeatureCache:
+    """
+    On-disk cache of feature arrays, e.g. sequences of MFCC frames.
+
+    Arrays are stored as .npy files named by their keys and are returned memory-mapped.
+    If `max_bytes` is given, the least recently used arrays are evicted
+    to keep the total size of the cache within it.
+    Recency is tracked by files' modification times, so the cache can be shared
+    between processes and runs.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        Returns the array stored under `key` or None if there is no such array.
+        A file that cannot be loaded, e.g. truncated or corrupted, is removed and treated as missing.
+        """
+        path = self._get_path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError, EOFError):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return array
+
+    def put(self, key, array):
+        """
+        Stores `array` under `key` and evicts least recently used arrays if necessary.
+        """
+        path = self._get_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            # The array replaces the one stored under the same key, if any
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if self.max_bytes is None:
+            return
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._list_entries())
+        else:
+            self._size += os.path.getsize(path) - replaced_size
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used arrays until the cache fits into `max_bytes`.
+        """
+        entries = sorted(self._list_entries(), key=lambda e: e[2])
+        size = sum(size for _, size, _ in entries)
+
+        for path, entry_size, _ in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
+    def _list_entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+
+def get_cache_key(*parts):
+    """
+    Returns a key identifying an array computed from `parts`.
+    Parts must be JSON-serializable.
+    """
+    data = json.dumps([CACHE_VERSION, *parts], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def hash_file(path):
+    """
+    Returns SHA-256 hex digest of the file contents.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
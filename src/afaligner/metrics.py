@@ -0,0 +1,140 @@
+import contextlib
+import json
+import time
+
+
+class Metrics:
+    """
+    Timings and counters of the stages of align().
+
+    `stages` – list of dicts, one per run of a stage, with the keys:
+    'stage' – stage name, 'wall_time' and 'cpu_time' – in seconds,
+    and the labels the stage was measured with, e.g. 'file'.
+    CPU time is the time of the whole process, including the threads the stage runs.
+
+    `alignments` – list of dicts, one per warping path found, with the keys:
+    'text_file', 'audio_file', 'n' and 'm' – numbers of text and audio frames aligned,
+    and the counters returned by c_FastDTWBD(): 'cells', 'pruned_cells', 'level_cells', 'peak_bytes'.
+
+    `counters` – dict of event counts, e.g. 'text_tail_realignments'.
+
+    The metrics can be exported as JSON by to_json() or
+    in the Prometheus text exposition format by to_prometheus().
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.alignments = []
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        """
+        Context manager that measures the wall and CPU time of a stage.
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                'stage': name,
+                **labels,
+                'wall_time': time.perf_counter() - wall_start,
+                'cpu_time': time.process_time() - cpu_start,
+            })
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_alignment(self, **values):
+        self.alignments.append(values)
+
+    def collect(self, measured_results):
+        """
+        Yields the results of call_measured() and adds the stages measured in them.
+        """
+        for result, stages in measured_results:
+            self.stages.extend(stages)
+            yield result
+
+    def to_dict(self):
+        return {
+            'stages': self.stages,
+            'alignments': self.alignments,
+            'counters': self.counters,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='afaligner'):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        Times of a stage are summed per its labels, counters of alignments are summed over all alignments,
+        and 'peak_bytes' is the maximum.
+        """
+        lines = []
+
+        def add_metric(name, metric_type, samples):
+            lines.append(f'# TYPE {prefix}_{name} {metric_type}')
+            for labels, value in samples.items():
+                lines.append(f'{prefix}_{name}{format_labels(labels)} {value}')
+
+        for time_name in ['wall_time', 'cpu_time']:
+            samples = {}
+            for stage in self.stages:
+                labels = tuple((k, v) for k, v in stage.items() if k not in {'wall_time', 'cpu_time'})
+                samples[labels] = samples.get(labels, 0) + stage[time_name]
+            add_metric(f'stage_{time_name.replace("_time", "")}_seconds_total', 'counter', samples)
+
+        level_cells = {}
+        for alignment in self.alignments:
+            for level, cells in enumerate(alignment.get('level_cells', [])):
+                level_cells[(('level', level),)] = level_cells.get((('level', level),), 0) + cells
+        add_metric('dtw_cells_total', 'counter', level_cells)
+        add_metric('dtw_pruned_cells_total', 'counter', {
+            (): sum(alignment.get('pruned_cells', 0) for alignment in self.alignments)
+        })
+        add_metric('dtw_frames_total', 'counter', {
+            (('sequence', 'text'),): sum(alignment['n'] for alignment in self.alignments),
+            (('sequence', 'audio'),): sum(alignment['m'] for alignment in self.alignments),
+        })
+        add_metric('dtw_peak_bytes', 'gauge', {
+            (): max((alignment.get('peak_bytes', 0) for alignment in self.alignments), default=0)
+        })
+
+        for name, value in self.counters.items():
+            add_metric(f'{name}_total', 'counter', {(): value})
+
+        return '\n'.join(lines) + '\n'
+
+
+def call_measured(func, *args, **kwargs):
+    """
+    Calls func(*args, metrics=metrics, **kwargs) with new Metrics
+    and returns the result together with the stages measured.
+    The result can be passed between processes, so that the stages
+    measured in a worker process are collected by Metrics.collect().
+    """
+    metrics = Metrics()
+    return func(*args, metrics=metrics, **kwargs), metrics.stages
+
+
+def measure(metrics, name, **labels):
+    """
+    Returns metrics.stage(name, **labels) or a context manager that does nothing if `metrics` is None.
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name, **labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
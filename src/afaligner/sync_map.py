@@ -0,0 +1,377 @@
+from collections.abc import Mapping
+from datetime import timedelta
+import functools
+import json
+import math
+import os.path
+import re
+
+import numpy as np
+
+
+# Number of fragments formatted at once by the writers. Bounds memory used by the string arrays.
+WRITE_CHUNK_SIZE = 10000
+
+# Characters escaped by json.dumps() in ASCII strings
+JSON_ESCAPED = re.compile(r'[\x00-\x1f"\\]')
+
+
+class SyncMap(Mapping):
+    """
+    Sync map stored as arrays with a row per fragment instead of a dict per fragment.
+
+    `text_files`, `audio_files` – lists of text and audio file names as they appear in the sync map.
+
+    `text_indices`, `audio_indices` – arrays of indices into `text_files` and `audio_files`.
+    Rows are ordered by text file, and fragments of a text file are in the order they were mapped.
+
+    `fragment_ids` – array of fragment ids.
+
+    `begin_times`, `end_times` – arrays of times in milliseconds.
+
+    `times_as_timedelta` – same as for align(), affects the dicts returned.
+
+    A SyncMap is a read-only mapping of the same form as a sync map returned by align():
+    sync_map['text.xhtml'] is the dict of the fragments of the text file.
+    The dict is built when the text file is first accessed.
+    to_dict() converts the whole sync map, and write_json() and write_smil()
+    write the same files as output_json() and output_smil() without building dicts.
+    """
+
+    def __init__(
+        self, text_files, audio_files,
+        text_indices, fragment_ids, audio_indices, begin_times, end_times,
+        times_as_timedelta=False,
+    ):
+        self.text_files = list(text_files)
+        self.audio_files = list(audio_files)
+        self.text_indices = np.asarray(text_indices, dtype=np.int32)
+        self.fragment_ids = np.asarray(fragment_ids, dtype=str)
+        self.audio_indices = np.asarray(audio_indices, dtype=np.int32)
+        self.begin_times = np.asarray(begin_times, dtype=np.int64)
+        self.end_times = np.asarray(end_times, dtype=np.int64)
+        self.times_as_timedelta = times_as_timedelta
+        # Rows of the k-th text file are text_offsets[k]:text_offsets[k+1]
+        self.text_offsets = np.searchsorted(self.text_indices, np.arange(len(self.text_files) + 1))
+        self._text_keys = {text_file: k for k, text_file in enumerate(self.text_files)}
+        self._fragment_maps = {}
+
+    @classmethod
+    def from_dict(cls, sync_map):
+        """
+        Returns a SyncMap with the contents of a sync map of the form returned by align().
+        """
+        text_files = list(sync_map)
+        audio_keys = {}
+        text_indices = []
+        fragment_ids = []
+        audio_indices = []
+        begin_times = []
+        end_times = []
+        times_as_timedelta = False
+        for k, fragments in enumerate(sync_map.values()):
+            for fragment_id, info in fragments.items():
+                text_indices.append(k)
+                fragment_ids.append(fragment_id)
+                audio_indices.append(audio_keys.setdefault(info['audio_file'], len(audio_keys)))
+                begin_times.append(parse_time(info['begin_time']))
+                end_times.append(parse_time(info['end_time']))
+                times_as_timedelta = isinstance(info['begin_time'], timedelta)
+
+        return cls(
+            text_files, list(audio_keys),
+            text_indices, np.array(fragment_ids, dtype=str), audio_indices, begin_times, end_times,
+            times_as_timedelta,
+        )
+
+    @classmethod
+    def concatenate(cls, sync_maps, times_as_timedelta=False):
+        """
+        Returns a SyncMap of the text files of all `sync_maps` in order.
+        Text files must not repeat.
+        """
+        text_files = []
+        audio_keys = {}
+        text_indices = []
+        audio_indices = []
+        for sync_map in sync_maps:
+            audio_map = np.array(
+                [audio_keys.setdefault(a, len(audio_keys)) for a in sync_map.audio_files], dtype=np.int32
+            )
+            text_indices.append(sync_map.text_indices + len(text_files))
+            audio_indices.append(audio_map[sync_map.audio_indices])
+            text_files.extend(sync_map.text_files)
+
+        def concatenate_column(name, dtype):
+            return np.concatenate([np.empty(0, dtype=dtype)] + [getattr(s, name) for s in sync_maps])
+
+        return cls(
+            text_files, list(audio_keys),
+            np.concatenate([np.empty(0, dtype=np.int32)] + text_indices),
+            concatenate_column('fragment_ids', str),
+            np.concatenate([np.empty(0, dtype=np.int32)] + audio_indices),
+            concatenate_column('begin_times', np.int64),
+            concatenate_column('end_times', np.int64),
+            times_as_timedelta,
+        )
+
+    def select(self, text_files):
+        """
+        Returns a SyncMap of `text_files` only.
+        """
+        keys = np.array([self._text_keys[text_file] for text_file in text_files], dtype=np.intp)
+        rows = np.concatenate([np.empty(0, dtype=np.intp)] + [
+            np.arange(self.text_offsets[k], self.text_offsets[k+1]) for k in keys
+        ])
+        return SyncMap(
+            text_files, self.audio_files,
+            np.repeat(np.arange(len(keys)), self.text_offsets[keys + 1] - self.text_offsets[keys]),
+            self.fragment_ids[rows], self.audio_indices[rows],
+            self.begin_times[rows], self.end_times[rows],
+            self.times_as_timedelta,
+        )
+
+    def __getitem__(self, text_file):
+        fragment_map = self._fragment_maps.get(text_file)
+        if fragment_map is None:
+            rows = self._get_rows(text_file)
+            fragment_map = self._fragment_maps[text_file] = self._build_fragment_map(rows)
+        return fragment_map
+
+    def __iter__(self):
+        return iter(self.text_files)
+
+    def __len__(self):
+        return len(self.text_files)
+
+    def __repr__(self):
+        return f'<SyncMap of {len(self.text_files)} text files, {len(self.fragment_ids)} fragments>'
+
+    def to_dict(self):
+        """
+        Returns the sync map as a dict of dicts, as align() does.
+        """
+        return {
+            text_file: self._build_fragment_map(self._get_rows(text_file))
+            for text_file in self.text_files
+        }
+
+    def write_json(self, output_dir):
+        """
+        Writes the same files as output_json().
+        """
+        audio_files = np.array([json.dumps(a) for a in self.audio_files] or [''])
+        for text_file in self.text_files:
+            rows = self._get_rows(text_file)
+            with open(self._get_output_path(output_dir, text_file, 'json'), 'w') as f:
+                if rows.stop == rows.start:
+                    f.write('{}')
+                    continue
+                f.write('{\n')
+                for start in range(rows.start, rows.stop, WRITE_CHUNK_SIZE):
+                    chunk = slice(start, min(start + WRITE_CHUNK_SIZE, rows.stop))
+                    entries = concatenate_strings(
+                        '  ', quote_json(self.fragment_ids[chunk]),
+                        ': {\n    "audio_file": ', audio_files[self.audio_indices[chunk]],
+                        ',\n    "begin_time": "', format_times(self.begin_times[chunk]),
+                        '",\n    "end_time": "', format_times(self.end_times[chunk]),
+                        '"\n  }',
+                    )
+                    if start > rows.start:
+                        f.write(',\n')
+                    f.write(',\n'.join(entries.tolist()))
+                f.write('\n}')
+
+    def write_smil(self, output_dir):
+        """
+        Writes the same files as output_smil().
+        """
+        audio_files = np.array([escape_xml(a) for a in self.audio_files] or [''])
+        for text_file in self.text_files:
+            rows = self._get_rows(text_file)
+            text_path = escape_xml(text_file)
+            n = get_number_of_digits_to_name(rows.stop - rows.start)
+            with open(self._get_output_path(output_dir, text_file, 'smil'), 'w') as f:
+                f.write(
+                    '<smil xmlns="http://www.w3.org/ns/SMIL" xmlns:epub="http://www.idpf.org/2007/ops" version="3.0">\n'
+                    '  <body>\n'
+                    f'    <seq id="seq1" epub:textref="{text_path}">'
+                )
+                for start in range(rows.start, rows.stop, WRITE_CHUNK_SIZE):
+                    chunk = slice(start, min(start + WRITE_CHUNK_SIZE, rows.stop))
+                    # EPUB3 standard requires clipBegin < clipEnd
+                    nonempty = self.begin_times[chunk] != self.end_times[chunk]
+                    if not nonempty.any():
+                        continue
+                    numbers = np.arange(start - rows.start + 1, chunk.stop - rows.start + 1)[nonempty]
+                    parallels = concatenate_strings(
+                        '\n      <par id="par', np.char.zfill(numbers.astype(str), n),
+                        f'">\n        <text src="{text_path}#', escape_xml(self.fragment_ids[chunk][nonempty]),
+                        '"/>\n        <audio src="', audio_files[self.audio_indices[chunk][nonempty]],
+                        '" clipBegin="', format_times(self.begin_times[chunk][nonempty]),
+                        '" clipEnd="', format_times(self.end_times[chunk][nonempty]),
+                        '"/>\n      </par>',
+                    )
+                    f.write(''.join(parallels.tolist()))
+                f.write(
+                    '\n    </seq>\n'
+                    '  </body>\n'
+                    '</smil>'
+                )
+
+    def _get_rows(self, text_file):
+        k = self._text_keys[text_file]
+        return slice(self.text_offsets[k], self.text_offsets[k+1])
+
+    def _build_fragment_map(self, rows):
+        if self.times_as_timedelta:
+            begin_times = [timedelta(milliseconds=t) for t in self.begin_times[rows].tolist()]
+            end_times = [timedelta(milliseconds=t) for t in self.end_times[rows].tolist()]
+        else:
+            begin_times = format_times(self.begin_times[rows]).tolist()
+            end_times = format_times(self.end_times[rows]).tolist()
+        return {
+            f: {
+                'audio_file': self.audio_files[a],
+                'begin_time': bt,
+                'end_time': et,
+            }
+            for f, a, bt, et in zip(
+                self.fragment_ids[rows].tolist(), self.audio_indices[rows].tolist(), begin_times, end_times
+            )
+        }
+
+    @staticmethod
+    def _get_output_path(output_dir, text_file, extension):
+        text_name = os.path.basename(text_file)
+        return os.path.join(output_dir, f'{os.path.splitext(text_name)[0]}.{extension}')
+
+
+class SyncMapBuilder:
+    """
+    Collects the fragments mapped by build_sync_map() and returns them as a SyncMap.
+
+    `text_files` – text file names of the sync map, append to it as text files are processed.
+
+    `audio_files` – audio file names of the sync map.
+
+    If a fragment is added more than once, the last times are kept, as dict.update() does.
+    """
+
+    def __init__(self, text_files, audio_files, times_as_timedelta=False):
+        self.text_files = list(text_files)
+        self.audio_files = list(audio_files)
+        self.times_as_timedelta = times_as_timedelta
+        self._columns = []
+
+    def add(self, text_indices, fragment_ids, audio_indices, begin_times, end_times):
+        """
+        Adds fragments. Indices can be arrays or numbers, times are in seconds.
+        """
+        fragment_ids = np.asarray(fragment_ids, dtype=str)
+        size = len(fragment_ids)
+        self._columns.append((
+            np.broadcast_to(np.asarray(text_indices, dtype=np.int32), size),
+            fragment_ids,
+            np.broadcast_to(np.asarray(audio_indices, dtype=np.int32), size),
+            seconds_to_ms(begin_times),
+            seconds_to_ms(end_times),
+        ))
+
+    def build(self):
+        if not self._columns:
+            return SyncMap(self.text_files, self.audio_files, [], [], [], [], [], self.times_as_timedelta)
+
+        text_indices, fragment_ids, audio_indices, begin_times, end_times = (
+            np.concatenate(column) for column in zip(*self._columns)
+        )
+
+        # Order the rows by text file, a repeated fragment takes the place of its first row
+        # and the values of its last row
+        order = np.lexsort((np.arange(len(fragment_ids)), fragment_ids, text_indices))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (
+            (text_indices[order][1:] != text_indices[order][:-1]) |
+            (fragment_ids[order][1:] != fragment_ids[order][:-1])
+        )
+        group_starts = np.flatnonzero(first)
+        first_rows = order[group_starts]
+        last_rows = order[np.append(group_starts[1:], len(order)) - 1]
+        rows_order = np.lexsort((first_rows, text_indices[first_rows]))
+        rows = last_rows[rows_order]
+
+        return SyncMap(
+            self.text_files, self.audio_files,
+            text_indices[rows], fragment_ids[rows], audio_indices[rows],
+            begin_times[rows], end_times[rows],
+            self.times_as_timedelta,
+        )
+
+
+def seconds_to_ms(times):
+    """
+    Converts times in seconds to milliseconds rounding them as format_time() does.
+    """
+    microseconds = np.rint(np.asarray(times, dtype=np.float64) * 1e6).astype(np.int64)
+    return np.atleast_1d(microseconds // 1000)
+
+
+def format_times(times):
+    """
+    Returns the array of times in milliseconds formatted as format_time() does.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if times.size == 0:
+        return np.empty(times.shape, dtype=str)
+    return concatenate_strings(
+        (times // 3600000).astype(str),
+        ':', np.char.zfill((times // 60000 % 60).astype(str), 2),
+        ':', np.char.zfill((times // 1000 % 60).astype(str), 2),
+        '.', np.char.zfill((times % 1000).astype(str), 3),
+    )
+
+
+def parse_time(t):
+    """
+    Returns a time returned by format_time() in milliseconds.
+    """
+    if isinstance(t, timedelta):
+        return t // timedelta(milliseconds=1)
+    hours, minutes, seconds = t.split(':')
+    seconds, ms = seconds.split('.')
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(ms)
+
+
+def concatenate_strings(*parts):
+    return functools.reduce(np.char.add, parts)
+
+
+def quote_json(strings):
+    """
+    Returns the array of strings encoded as JSON strings.
+    """
+    joined = ''.join(strings.tolist())
+    if joined.isascii() and JSON_ESCAPED.search(joined) is None:
+        return concatenate_strings('"', strings, '"')
+    return np.array([json.dumps(s) for s in strings.tolist()] or [''])[:len(strings)]
+
+
+def escape_xml(strings):
+    """
+    Escapes a string or an array of strings as the SMIL template does.
+    """
+    if isinstance(strings, str):
+        return (
+            strings.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            .replace('"', '&#34;').replace("'", '&#39;')
+        )
+    for char, escaped in [('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&#34;'), ("'", '&#39;')]:
+        strings = np.char.replace(strings, char, escaped)
+    return strings
+
+
+def get_number_of_digits_to_name(num):
+    if num <= 0:
+        return 0
+
+    return math.floor(math.log10(num)) + 1
@@ -1,11 +1,33 @@
 from datetime import timedelta
 import os
+import shutil
+import subprocess
+import sys
 
-from afaligner import align
+import numpy as np
+import pytest
+
+import afaligner
+from afaligner import Aligner, align, align_incremental, align_stream, align_sweep, get_file_hashes, get_path
+from afaligner.sync_map import SyncMap
 
 from . import RESOURCES_DIR
 
 
+def assert_sync_maps_close(actual, expected, tolerance):
+    """
+    Fragments are mapped to the same audio files, and their times differ by less than `tolerance`.
+    """
+    assert actual.keys() == expected.keys()
+    for text, fragment_map in expected.items():
+        assert actual[text].keys() == fragment_map.keys()
+        for fragment, info in fragment_map.items():
+            actual_info = actual[text][fragment]
+            assert actual_info['audio_file'] == info['audio_file']
+            assert abs(actual_info['begin_time'] - info['begin_time']) < tolerance
+            assert abs(actual_info['end_time'] - info['end_time']) < tolerance
+
+
 def test_complete_sync(complete_sync_map):
     """
     Three audio files perfectly map to three text files.
@@ -33,6 +55,257 @@ def test_text_extra_head():
     )
 
 
-    
+def test_preprocessing_workers(complete_sync_map):
+    """
+    Preparing files in a process pool does not change the result.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        preprocessing_workers=2,
+        prefetch=1,
+    )
+    assert sync_map == complete_sync_map
+
+
+def test_fragment_cache(tmp_path, monkeypatch):
+    """
+    With a feature cache, only the edited fragment is synthesized again,
+    and the result is the same as without the cached fragments.
+    """
+    text_dir = tmp_path / 'text'
+    shutil.copytree(os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'), text_dir)
+    audio_dir = os.path.join(RESOURCES_DIR, 'shakespeare/audio/')
+
+    synthesized_fragments = []
+    original_synthesize = afaligner.synthesize
+
+    def synthesize(textfile, *args, **kwargs):
+        synthesized_fragments.extend(f.identifier for f in textfile.fragments)
+        return original_synthesize(textfile, *args, **kwargs)
+
+    monkeypatch.setattr(afaligner, 'synthesize', synthesize)
+    feature_cache_dir = str(tmp_path / 'cache')
+    align(str(text_dir), audio_dir, times_as_timedelta=True, feature_cache_dir=feature_cache_dir)
+
+    text_path = text_dir / 'p001.xhtml'
+    text_path.write_text(
+        text_path.read_text(encoding='utf-8').replace('bear his memory', 'bear his memories'),
+        encoding='utf-8',
+    )
+    synthesized_fragments.clear()
+    sync_map = align(str(text_dir), audio_dir, times_as_timedelta=True, feature_cache_dir=feature_cache_dir)
+    assert synthesized_fragments == ['f005']
+
+    assert sync_map == align(
+        str(text_dir), audio_dir, times_as_timedelta=True, feature_cache_dir=str(tmp_path / 'cold_cache'),
+    )
+
+
+def test_incremental_alignment(complete_sync_map):
+    """
+    Groups of unchanged files keep their mapping, changed groups are realigned.
+    """
+    text_dir = os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/')
+    audio_dir = os.path.join(RESOURCES_DIR, 'shakespeare/audio/')
+    file_hashes = get_file_hashes(text_dir, audio_dir)
+
+    sync_map = align_incremental(
+        text_dir, audio_dir, complete_sync_map, file_hashes, times_as_timedelta=True
+    )
+    assert sync_map == complete_sync_map
+
+    changed_text = sorted(file_hashes['text'])[1]
+    file_hashes['text'][changed_text] = 'changed'
+    sync_map = align_incremental(
+        text_dir, audio_dir, complete_sync_map, file_hashes, times_as_timedelta=True
+    )
+    assert sync_map == complete_sync_map
+
+
+
+def test_incremental_alignment_checks_file_hashes():
+    text_dir = os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/')
+    audio_dir = os.path.join(RESOURCES_DIR, 'shakespeare/audio/')
+    for file_hashes in [None, {}, {'text': {}}]:
+        with pytest.raises(ValueError):
+            align_incremental(text_dir, audio_dir, {}, file_hashes)
+
+def test_global_alignment(complete_sync_map):
+    """
+    Aligning all files at once maps fragments to the same audio files at close times.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        global_alignment=True,
+    )
+    assert_sync_maps_close(sync_map, complete_sync_map, timedelta(seconds=1))
+
+
+def test_coarse_alignment(complete_sync_map):
+    """
+    Aligning at a lower frame rate and refining the anchors gives close times.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        coarse_factor=4,
+    )
+    assert_sync_maps_close(sync_map, complete_sync_map, timedelta(seconds=0.5))
+
+
+def test_vad(complete_sync_map):
+    """
+    Shortening pauses before the alignment maps fragments to close times.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        vad=True,
+    )
+    assert_sync_maps_close(sync_map, complete_sync_map, timedelta(seconds=1))
+
+
+def test_segmented_alignment(complete_sync_map):
+    """
+    Aligning in overlapping segments gives times close to the unsegmented alignment.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        segment_length=20,
+    )
+    assert_sync_maps_close(sync_map, complete_sync_map, timedelta(seconds=0.5))
+
+
+def test_segmented_path_of_long_audio(monkeypatch):
+    """
+    Long audio is aligned in segments even if the text is shorter than a segment.
+    """
+    rng = np.random.default_rng(0)
+    audio_mfcc_sequence = np.cumsum(rng.normal(scale=0.1, size=(3000, 13)), axis=0)
+    text_mfcc_sequence = audio_mfcc_sequence[1000:1300] + rng.normal(scale=0.05, size=(300, 13))
+    path = get_path(text_mfcc_sequence, audio_mfcc_sequence, skip_penalty=0.75, radius=10)
 
+    segmented_calls = []
+    original_get_segmented_path = afaligner.get_segmented_path
 
+    def get_segmented_path(*args, **kwargs):
+        segmented_calls.append(args)
+        return original_get_segmented_path(*args, **kwargs)
+
+    monkeypatch.setattr(afaligner, 'get_segmented_path', get_segmented_path)
+    segmented_path = get_path(
+        text_mfcc_sequence, audio_mfcc_sequence, skip_penalty=0.75, radius=10, segment_frames=400,
+    )
+    assert len(segmented_calls) == 1
+    np.testing.assert_equal(segmented_path, path)
+
+
+def test_sweep(complete_sync_map):
+    """
+    Every setting of a sweep gives the same result as align() with it.
+    """
+    results = align_sweep(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        [{}, {'skip_penalty': 0.75, 'radius': 50}, {'skip_penalty': None, 'radius': None}],
+        times_as_timedelta=True,
+    )
+    assert len(results) == 3
+    sync_map, stats = results[0]
+    assert sync_map == complete_sync_map
+    assert stats['matched_fragments'] == stats['fragments']
+    assert 0 < stats['matched_audio_time'] <= stats['audio_time']
+    sync_map, stats = results[1]
+    assert sync_map == align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        radius=50,
+    )
+    assert stats['path_cost'] > 0
+    sync_map, _ = results[2]
+    assert sync_map == complete_sync_map
+
+
+def test_aligner(complete_sync_map):
+    """
+    An Aligner gives the same result on every call.
+    """
+    with Aligner() as aligner:
+        aligner.preload()
+        for _ in range(2):
+            sync_map = aligner.align(
+                os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+                os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+                times_as_timedelta=True,
+            )
+            assert sync_map == complete_sync_map
+
+
+def test_columnar(complete_sync_map, tmp_path):
+    """
+    A columnar sync map has the same contents and output as the dict.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        output_dir=tmp_path,
+        output_format='json',
+        times_as_timedelta=True,
+        columnar=True,
+    )
+    assert isinstance(sync_map, SyncMap)
+    assert sync_map == complete_sync_map
+    assert sync_map.to_dict() == complete_sync_map
+    assert sorted(os.listdir(tmp_path)) == ['p001.json', 'p002.json', 'p003.json']
+
+
+def test_stream(complete_sync_map, tmp_path):
+    """
+    Sync maps of text files are yielded one by one after their output is written
+    and merged give the result of align().
+    """
+    sync_map = {}
+    for text_sync_map in align_stream(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        output_dir=tmp_path,
+        output_format='json',
+        times_as_timedelta=True,
+    ):
+        [text_file] = text_sync_map
+        assert os.path.exists(tmp_path / text_file.replace('.xhtml', '.json'))
+        sync_map.update(text_sync_map)
+    assert sync_map == complete_sync_map
+
+
+def test_float32_features(complete_sync_map):
+    """
+    Aligning float32 MFCCs gives the same result as float64 ones.
+    """
+    sync_map = align(
+        os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        times_as_timedelta=True,
+        float32_features=True,
+    )
+    assert sync_map == complete_sync_map
+
+
+def test_lazy_imports():
+    """
+    Importing afaligner does not import aeneas and jinja2.
+    """
+    code = (
+        'import sys, afaligner; '
+        'assert not [m for m in sys.modules if m.startswith(("aeneas", "jinja2"))]'
+    )
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -0,0 +1,50 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from afaligner.async_align import ExecutorCalls, align_async
+
+from . import RESOURCES_DIR
+
+
+def test_align_async(complete_sync_map):
+    async def align_books():
+        return await asyncio.gather(*(
+            align_async(
+                os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+                os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+                times_as_timedelta=True,
+            )
+            for _ in range(2)
+        ))
+
+    for sync_map in asyncio.run(align_books()):
+        assert sync_map == complete_sync_map
+
+
+def test_cancel_executor_calls():
+    """
+    Calls that have not started are cancelled, and running calls are waited for.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    finished = []
+
+    def work(k):
+        started.set()
+        release.wait()
+        finished.append(k)
+
+    async def run_and_cancel(calls):
+        tasks = [asyncio.ensure_future(calls.run(work, k)) for k in range(3)]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        for task in tasks:
+            task.cancel()
+        asyncio.get_running_loop().call_later(0.1, release.set)
+        await calls.cancel()
+        assert not calls.futures
+
+    with ThreadPoolExecutor(1) as executor:
+        asyncio.run(run_and_cancel(ExecutorCalls(executor)))
+    assert finished == [0]
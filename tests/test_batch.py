@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from afaligner.batch import COMPLETION_MARKER, read_manifest, run_batch
+
+from . import RESOURCES_DIR
+
+
+def test_read_manifest(tmp_path):
+    manifest_path = tmp_path / 'manifest.json'
+    manifest_path.write_text(json.dumps([{'text_dir': 'text', 'audio_dir': 'audio'}]))
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest_path))
+
+    job = {'text_dir': 'text', 'audio_dir': 'audio', 'output_dir': 'smil', 'tmp_dir': 'tmp'}
+    manifest_path.write_text(json.dumps([job]))
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest_path))
+
+    jobs = [{'text_dir': f'text{k}', 'audio_dir': f'audio{k}', 'output_dir': 'smil'} for k in range(2)]
+    manifest_path.write_text(json.dumps(jobs))
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest_path))
+
+
+def test_run_batch(tmp_path):
+    """
+    Jobs run in parallel with separate temporary files, completed jobs are skipped on rerun.
+    """
+    jobs = [
+        {
+            'text_dir': os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+            'audio_dir': os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+            'output_dir': str(tmp_path / f'output{k}'),
+        }
+        for k in range(2)
+    ]
+    scratch_dir = tmp_path / 'scratch'
+    scratch_dir.mkdir()
+
+    summary = run_batch(
+        jobs, workers=2, scratch_dir=str(scratch_dir), output_format='json', preprocessing_workers=2,
+    )
+    assert summary['completed'] == 2
+    for job in jobs:
+        assert os.path.exists(os.path.join(job['output_dir'], COMPLETION_MARKER))
+        assert os.path.exists(os.path.join(job['output_dir'], 'p001.json'))
+    assert os.listdir(scratch_dir) == []
+
+    summary = run_batch(jobs, workers=2, scratch_dir=str(scratch_dir))
+    assert summary['skipped'] == 2
+
+
+def test_terminated_job_fails(tmp_path):
+    """
+    A job whose alignment is terminated is not marked completed, so it is rerun.
+    """
+    job = {
+        'text_dir': os.path.join(RESOURCES_DIR, 'shakespeare/text_complete/'),
+        'audio_dir': os.path.join(RESOURCES_DIR, 'shakespeare/audio/'),
+        'output_dir': str(tmp_path / 'output'),
+        'skip_penalty': 0,
+    }
+
+    summary = run_batch([job], workers=1)
+    assert summary['failed'] == 1
+    assert not os.path.exists(os.path.join(job['output_dir'], COMPLETION_MARKER))
+
+    summary = run_batch([job], workers=1)
+    assert summary['skipped'] == 0
+
+
+def test_long_error(tmp_path):
+    """
+    A job that fails with an error larger than the pipe buffer does not hang the batch.
+    """
+    job = {
+        'text_dir': str(tmp_path / ('x' * 200000)),
+        'audio_dir': str(tmp_path),
+        'output_dir': str(tmp_path / 'output'),
+    }
+
+    summary = run_batch([job], workers=1)
+    assert summary['failed'] == 1
+    assert len(summary['jobs'][0]['error']) > 200000
@@ -1,7 +1,7 @@
 import pytest
 import numpy as np
 
-from afaligner.c_dtwbd_wrapper import c_FastDTWBD
+from afaligner.c_dtwbd_wrapper import DTWBDWorkspace, c_FastDTWBD, c_FastDTWBD_batch
 
 
 def test_perfect_match():
@@ -21,6 +21,15 @@ def test_no_match():
     assert len(path) == 0
 
 
+def test_empty_sequence():
+    x = np.arange(10, dtype='float64').reshape(-1,1)
+    empty = np.zeros((0, 1))
+    for s, t in [(empty, x), (x, empty), (empty, empty)]:
+        for threads in [1, 2]:
+            distance, path = c_FastDTWBD(s, t, skip_penalty=0.5, radius=10, threads=threads)
+            assert len(path) == 0
+
+
 def test_all_to_one_match():
     s = 5 * np.ones(10, dtype='float64').reshape(-1,1)
     t = np.array([[5]], dtype='float64')
@@ -42,6 +51,148 @@ def test_perfect_match_in_the_middle():
     np.testing.assert_equal(path[:,1], np.arange(20, 80))
 
 
+def test_perfect_match_in_the_middle_with_small_radius():
+    skip_penalty = 0.5
+    t = np.random.default_rng(0).normal(size=(1000, 12))
+    s = t[200:800].copy()
+    distance, path = c_FastDTWBD(s, t, skip_penalty=skip_penalty, radius=5)
+    assert distance == pytest.approx((len(t) - len(s)) * skip_penalty)
+    np.testing.assert_equal(path[:,0], np.arange(600))
+    np.testing.assert_equal(path[:,1], np.arange(200, 800))
+
+
+def test_threads_do_not_change_path():
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.normal(scale=0.1, size=(3000, 12)), axis=0)
+    s = t[500:2500] + rng.normal(scale=0.05, size=(2000, 12))
+    distance, path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=10)
+    for threads in [2, 3, 8]:
+        threads_distance, threads_path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=10, threads=threads)
+        assert threads_distance == distance
+        np.testing.assert_equal(threads_path, path)
+
+
+def test_strided_input():
+    rng = np.random.default_rng(0)
+    t_mfcc = np.cumsum(rng.normal(scale=0.1, size=(13, 3000)), axis=1)
+    s_mfcc = t_mfcc[:, 500:2500] + rng.normal(scale=0.05, size=(13, 2000))
+    s, t = s_mfcc.T[:, 1:], t_mfcc.T[:, 1:]
+    distance, path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=10)
+    contiguous_distance, contiguous_path = c_FastDTWBD(
+        np.ascontiguousarray(s), np.ascontiguousarray(t), skip_penalty=0.75, radius=10
+    )
+    assert distance == contiguous_distance
+    np.testing.assert_equal(path, contiguous_path)
+
+
+def test_batch():
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.normal(scale=0.1, size=(1000, 12)), axis=0)
+    pairs = [
+        (t[k:k+500] + rng.normal(scale=0.05, size=(500, 12)), t)
+        for k in range(0, 500, 100)
+    ]
+    results = c_FastDTWBD_batch(pairs, skip_penalty=0.75, radius=10, threads=3)
+    assert len(results) == len(pairs)
+    for (s, t), (distance, path) in zip(pairs, results):
+        single_distance, single_path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=10)
+        assert distance == single_distance
+        np.testing.assert_equal(path, single_path)
+
+
+def test_float32():
+    """
+    float32 sequences are aligned by the float variant, which finds the same path.
+    """
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.normal(scale=0.1, size=(3000, 12)), axis=0)
+    s = t[500:2500] + rng.normal(scale=0.05, size=(2000, 12))
+    s32, t32 = s.astype('float32'), t.astype('float32')
+    distance, path = c_FastDTWBD(s32.astype('float64'), t32.astype('float64'), skip_penalty=0.75, radius=10)
+    stats = {}
+    float_distance, float_path = c_FastDTWBD(s32, t32, skip_penalty=0.75, radius=10, stats=stats)
+    assert float_distance == pytest.approx(distance, rel=1e-6)
+    np.testing.assert_equal(float_path, path)
+
+    float64_stats = {}
+    c_FastDTWBD(s, t, skip_penalty=0.75, radius=10, stats=float64_stats)
+    assert stats['peak_bytes'] < float64_stats['peak_bytes']
+
+    # Sequences of different dtypes are aligned as float64
+    mixed_distance, mixed_path = c_FastDTWBD(s32, t32.astype('float64'), skip_penalty=0.75, radius=10)
+    assert mixed_distance == distance
+    np.testing.assert_equal(mixed_path, path)
+
+
+def test_float32_strided_batch():
+    rng = np.random.default_rng(0)
+    t_mfcc = np.cumsum(rng.normal(scale=0.1, size=(13, 1000)), axis=1).astype('float32')
+    t = t_mfcc.T[:, 1:]
+    pairs = [
+        (t[k:k+500] + rng.normal(scale=0.05, size=(500, 12)).astype('float32'), t)
+        for k in range(0, 500, 100)
+    ]
+    results = c_FastDTWBD_batch(pairs, skip_penalty=0.75, radius=10, threads=3)
+    for (s, t), (distance, path) in zip(pairs, results):
+        single_distance, single_path = c_FastDTWBD(
+            np.ascontiguousarray(s), np.ascontiguousarray(t), skip_penalty=0.75, radius=10
+        )
+        assert distance == single_distance
+        np.testing.assert_equal(path, single_path)
+
+
+def test_workspace():
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.normal(scale=0.1, size=(3000, 12)), axis=0)
+    with DTWBDWorkspace() as workspace:
+        for n in [500, 2000, 1000]:
+            s = t[500:500+n] + rng.normal(scale=0.05, size=(n, 12))
+            distance, path = c_FastDTWBD(s, t, skip_penalty=0.75, radius=10)
+            workspace_distance, workspace_path = c_FastDTWBD(
+                s, t, skip_penalty=0.75, radius=10, workspace=workspace
+            )
+            assert workspace_distance == distance
+            np.testing.assert_equal(workspace_path, path)
+        size = workspace.size
+        assert size > 0
+        c_FastDTWBD(s, t, skip_penalty=0.75, radius=10, workspace=workspace)
+        assert workspace.size == size
+
+
+def test_pruning():
+    """
+    Cells of the unmatched head of a long sequence cannot be on the path and are pruned.
+    With a window, the projected coarse path bounds the path distance from the start,
+    so most cells of the window are pruned.
+    """
+    skip_penalty = 0.5
+    t = np.random.default_rng(0).normal(size=(1000, 12))
+    s = t[800:].copy()
+    for radius, min_pruned_share in [(1000, 0.05), (10, 0.5)]:
+        stats = {}
+        distance, path = c_FastDTWBD(s, t, skip_penalty=skip_penalty, radius=radius, stats=stats)
+        assert distance == pytest.approx((len(t) - len(s)) * skip_penalty)
+        np.testing.assert_equal(path[:,0], np.arange(200))
+        np.testing.assert_equal(path[:,1], np.arange(800, 1000))
+        assert min_pruned_share * stats['cells'] < stats['pruned_cells'] < stats['cells']
+    assert stats['level_cells'][0] < len(s) * len(t)
+
+
+def test_level_stats():
+    """
+    Cells are counted at every FastDTWBD level, each level has about half the cells of the previous one.
+    """
+    t = np.random.default_rng(0).normal(size=(4000, 12))
+    s = t[1000:3000].copy()
+    stats = {}
+    c_FastDTWBD(s, t, skip_penalty=0.5, radius=10, stats=stats)
+    level_cells = stats['level_cells']
+    assert sum(level_cells) == stats['cells']
+    assert len(level_cells) > 1
+    assert all(a > b for a, b in zip(level_cells, level_cells[1:]))
+    assert stats['peak_bytes'] > 0
+
+
 def test_allocate_large_matrix():
     s = np.arange(100000, dtype='float64').reshape(-1,1)
     t = np.arange(100000, dtype='float64').reshape(-1,1)
@@ -0,0 +1,71 @@
+import os
+import time
+
+import numpy as np
+
+from afaligner.feature_cache import FeatureCache, get_cache_key
+
+
+def test_get_put(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    key = get_cache_key('audio_mfcc', 'hash', {'mfcc_size': '13'})
+    array = np.arange(24, dtype='float64').reshape(-1, 12)
+
+    assert cache.get(key) is None
+    cache.put(key, array)
+    np.testing.assert_equal(cache.get(key), array)
+
+
+def test_cache_key_depends_on_parameters():
+    assert get_cache_key('audio_mfcc', 'hash', {'mfcc_size': '13'}) != \
+        get_cache_key('audio_mfcc', 'hash', {'mfcc_size': '12'})
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    array = np.zeros((100, 12), dtype='float64')
+    entry_size = array.nbytes + 128
+    cache = FeatureCache(str(tmp_path), max_bytes=int(2.5 * entry_size))
+
+    cache.put('a', array)
+    cache.put('b', array)
+    # make 'a' the most recently used one
+    past = time.time() - 100
+    os.utime(os.path.join(str(tmp_path), 'b.npy'), (past, past))
+    assert cache.get('a') is not None
+    cache.put('c', array)
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+def test_put_replaces_entry(tmp_path):
+    """
+    Storing an array under an existing key does not count the replaced array in the cache size.
+    """
+    array = np.zeros((100, 12), dtype='float64')
+    entry_size = array.nbytes + 128
+    cache = FeatureCache(str(tmp_path), max_bytes=10 * entry_size)
+
+    cache.put('a', array)
+    cache.put('b', array)
+    for _ in range(3):
+        cache.put('b', array)
+
+    assert cache._size == 2 * entry_size
+    assert cache.get('a') is not None
+    assert cache.get('b') is not None
+
+
+def test_corrupted_entry_is_missing(tmp_path):
+    """
+    A truncated file is a cache miss and is removed.
+    """
+    cache = FeatureCache(str(tmp_path))
+    cache.put('a', np.zeros((100, 12), dtype='float64'))
+    path = os.path.join(str(tmp_path), 'a.npy')
+    with open(path, 'r+b') as f:
+        f.truncate(200)
+
+    assert cache.get('a') is None
+    assert not os.path.exists(path)
@@ -0,0 +1,47 @@
+import json
+
+from afaligner.metrics import Metrics, call_measured, measure
+
+
+def test_stages():
+    metrics = Metrics()
+    with metrics.stage('alignment', text_file='p001.xhtml'):
+        pass
+    with measure(None, 'alignment'):
+        pass
+    assert len(metrics.stages) == 1
+    stage = metrics.stages[0]
+    assert stage['stage'] == 'alignment'
+    assert stage['text_file'] == 'p001.xhtml'
+    assert stage['wall_time'] >= 0 and stage['cpu_time'] >= 0
+
+
+def test_collect():
+    def prepare(path, metrics):
+        with metrics.stage('audio_mfcc', file=path):
+            return path.upper()
+
+    metrics = Metrics()
+    results = list(metrics.collect(call_measured(prepare, path) for path in ['a', 'b']))
+    assert results == ['A', 'B']
+    assert [stage['file'] for stage in metrics.stages] == ['a', 'b']
+
+
+def test_export():
+    metrics = Metrics()
+    with metrics.stage('output', file='a"b'):
+        pass
+    metrics.add_alignment(text_file='t', audio_file='a', n=10, m=20, cells=30, pruned_cells=5,
+                          peak_bytes=100, level_cells=[20, 10])
+    metrics.count('text_tail_realignments')
+
+    data = json.loads(metrics.to_json())
+    assert data['counters'] == {'text_tail_realignments': 1}
+    assert data['alignments'][0]['level_cells'] == [20, 10]
+
+    lines = metrics.to_prometheus().splitlines()
+    assert 'afaligner_stage_wall_seconds_total{stage="output",file="a\\"b"}' in ' '.join(lines)
+    assert 'afaligner_dtw_cells_total{level="1"} 10' in lines
+    assert 'afaligner_dtw_frames_total{sequence="audio"} 20' in lines
+    assert 'afaligner_dtw_peak_bytes 100' in lines
+    assert 'afaligner_text_tail_realignments_total 1' in lines
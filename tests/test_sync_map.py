@@ -1,3 +1,8 @@
+import numpy as np
+
+import afaligner.sync_map
+from afaligner import format_time, output_json, output_smil
+from afaligner.sync_map import SyncMap, SyncMapBuilder, format_times, seconds_to_ms
 
 
 def test_sync_map(complete_sync_map):
@@ -15,3 +20,67 @@ def test_sync_map(complete_sync_map):
             assert 'end_time' in fragment_map
 
             assert fragment_map['begin_time'] < fragment_map['end_time']
+
+
+def make_sync_map():
+    return {
+        '../text/p001.xhtml': {
+            'f001': {'audio_file': '../audio/p001.mp3', 'begin_time': '0:00:00.000', 'end_time': '0:00:02.600'},
+            'f002': {'audio_file': '../audio/p001.mp3', 'begin_time': '0:00:02.600', 'end_time': '0:00:02.600'},
+            'f003': {'audio_file': '../audio/p001.mp3', 'begin_time': '0:00:02.600', 'end_time': '1:02:05.880'},
+        },
+        '../text/p002.xhtml': {},
+        '../text/p&<"\'.xhtml': {
+            'f"0\\4é': {'audio_file': '../audio/p&2.mp3', 'begin_time': '0:00:00.040', 'end_time': '0:00:03.040'},
+        },
+    }
+
+
+def test_columnar_sync_map():
+    sync_map = make_sync_map()
+    columnar = SyncMap.from_dict(sync_map)
+    assert columnar == sync_map
+    assert columnar.to_dict() == sync_map
+    assert list(columnar['../text/p001.xhtml']) == ['f001', 'f002', 'f003']
+
+    selected = columnar.select(['../text/p&<"\'.xhtml', '../text/p001.xhtml'])
+    assert selected.to_dict() == {k: sync_map[k] for k in ['../text/p&<"\'.xhtml', '../text/p001.xhtml']}
+    assert SyncMap.concatenate([columnar.select(['../text/p001.xhtml']), selected.select(['../text/p&<"\'.xhtml'])]) == {
+        k: sync_map[k] for k in ['../text/p001.xhtml', '../text/p&<"\'.xhtml']
+    }
+
+    times = np.arange(0, 200000) * 0.040
+    assert format_times(seconds_to_ms(times)).tolist() == [format_time(t) for t in times]
+
+    timedelta_map = SyncMap.from_dict(sync_map)
+    timedelta_map.times_as_timedelta = True
+    assert timedelta_map['../text/p001.xhtml']['f003']['end_time'] == format_time(3725.88, as_timedelta=True)
+
+
+def test_sync_map_builder():
+    builder = SyncMapBuilder(['t1', 't2'], ['a1', 'a2'])
+    builder.add(0, ['f1', 'f2'], 0, [0.0, 1.0], [1.0, 2.0])
+    builder.add([0, 1], ['f2', 'f3'], [1, 1], [0.04, 0.08], [0.08, 0.12])
+    assert builder.build().to_dict() == {
+        't1': {
+            'f1': {'audio_file': 'a1', 'begin_time': '0:00:00.000', 'end_time': '0:00:01.000'},
+            'f2': {'audio_file': 'a2', 'begin_time': '0:00:00.040', 'end_time': '0:00:00.080'},
+        },
+        't2': {
+            'f3': {'audio_file': 'a2', 'begin_time': '0:00:00.080', 'end_time': '0:00:00.120'},
+        },
+    }
+
+
+def test_columnar_output(tmp_path, monkeypatch):
+    sync_map = make_sync_map()
+    columnar = SyncMap.from_dict(sync_map)
+    monkeypatch.setattr(afaligner.sync_map, 'WRITE_CHUNK_SIZE', 2)
+    for output in [output_json, output_smil]:
+        dict_dir, columnar_dir = tmp_path / output.__name__ / 'dict', tmp_path / output.__name__ / 'columnar'
+        dict_dir.mkdir(parents=True)
+        columnar_dir.mkdir()
+        output(sync_map, dict_dir)
+        output(columnar, columnar_dir)
+        for path in dict_dir.iterdir():
+            assert (columnar_dir / path.name).read_text() == path.read_text()